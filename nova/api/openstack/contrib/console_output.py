@@ -0,0 +1,95 @@
+#   Copyright 2011 OpenStack, LLC.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+"""The console output extension.
+
+POST /servers/<id>/action with
+
+    {"os-getConsoleOutput": {"length": 50}}
+
+returns the last 50 lines of the server's console log.  length is
+optional and all of the log is returned without it.  Either way the
+libvirt driver returns no more than the last --console_output_max_bytes
+(64KB by default) of the log.
+
+"""
+
+from webob import exc
+
+from nova import compute
+from nova import exception
+from nova import log as logging
+from nova.api.openstack import extensions as exts
+from nova.api.openstack import faults
+
+
+LOG = logging.getLogger("nova.api.contrib.console_output")
+
+
+class Console_output(exts.ExtensionDescriptor):
+    """Console log output of servers for the OpenStack API."""
+    def __init__(self):
+        super(Console_output, self).__init__()
+        self.compute_api = compute.API()
+
+    def _get_console_output(self, input_dict, req, instance_id):
+        """Return the console output of an instance."""
+        context = req.environ["nova.context"]
+        length = (input_dict['os-getConsoleOutput'] or {}).get('length')
+        if length is not None:
+            try:
+                length = int(length)
+            except (TypeError, ValueError):
+                length = -1
+            if length < 0:
+                return faults.Fault(exc.HTTPBadRequest(
+                        explanation=_("length must be a non-negative "
+                                      "integer")))
+
+        try:
+            instance = self.compute_api.get(context, instance_id)
+            output = self.compute_api.get_console_output(context,
+                    instance['id'], length=length)
+        except exception.NotFound:
+            return faults.Fault(exc.HTTPNotFound())
+        except Exception:
+            LOG.exception(_("Failed to get console output of %s"),
+                          instance_id)
+            return faults.Fault(exc.HTTPInternalServerError())
+
+        return {'output': output}
+
+    def get_name(self):
+        return "ConsoleOutput"
+
+    def get_alias(self):
+        return "os-console-output"
+
+    def get_description(self):
+        return "Console log output of servers"
+
+    def get_namespace(self):
+        return "http://docs.openstack.org/ext/os-console-output/api/v1.1"
+
+    def get_updated(self):
+        return "2011-10-18T00:00:00+00:00"
+
+    def get_actions(self):
+        """Return the actions the extension adds, as required by contract."""
+        actions = [
+                exts.ActionExtension("servers", "os-getConsoleOutput",
+                                     self._get_console_output),
+        ]
+
+        return actions
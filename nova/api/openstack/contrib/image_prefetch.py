@@ -0,0 +1,111 @@
+# Copyright (c) 2011 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""The image prefetch admin extension.
+
+POST /os-image-prefetch with
+
+    {"prefetch": {"images": [...], "hosts": [...],
+                  "availability_zone": "...", "flavor_id": "..."}}
+
+has compute hosts fetch the images into their image cache, so the first
+boot of an image on a host does not wait for the download.  hosts,
+availability_zone and flavor_id are optional.  GET
+/os-image-prefetch/<host> shows the progress of a host's prefetches.
+
+"""
+
+import webob.exc
+
+from nova import compute
+from nova import exception
+from nova import flags
+from nova import log as logging
+from nova.api.openstack import extensions
+from nova.compute import instance_types
+
+
+LOG = logging.getLogger("nova.api.openstack.contrib.image_prefetch")
+FLAGS = flags.FLAGS
+
+
+class ImagePrefetchController(object):
+    """The image prefetch API controller for the OpenStack API."""
+
+    def __init__(self):
+        self.compute_api = compute.API()
+        super(ImagePrefetchController, self).__init__()
+
+    @extensions.admin_only
+    def create(self, req, body):
+        context = req.environ['nova.context']
+        try:
+            prefetch = body['prefetch']
+            image_ids = prefetch['images']
+        except (KeyError, TypeError):
+            raise webob.exc.HTTPBadRequest(
+                    explanation=_("Missing list of images to prefetch"))
+        if not image_ids or not isinstance(image_ids, list):
+            raise webob.exc.HTTPBadRequest(
+                    explanation=_("Missing list of images to prefetch"))
+
+        instance_type_id = None
+        flavor_id = prefetch.get('flavor_id')
+        if flavor_id is not None:
+            try:
+                instance_type = instance_types.get_instance_type_by_flavor_id(
+                        flavor_id)
+            except exception.FlavorNotFound:
+                raise webob.exc.HTTPBadRequest(
+                        explanation=_("Invalid flavor_id %s") % flavor_id)
+            instance_type_id = instance_type['id']
+
+        hosts = prefetch.get('hosts')
+        availability_zone = prefetch.get('availability_zone')
+        LOG.audit(_("Prefetching images %(image_ids)s on hosts %(hosts)s "
+                    "in availability zone %(availability_zone)s") % locals(),
+                  context=context)
+        targets = self.compute_api.prefetch_images(context, image_ids,
+                hosts=hosts, availability_zone=availability_zone,
+                instance_type_id=instance_type_id)
+        return {'prefetch': {'images': image_ids, 'hosts': targets}}
+
+    @extensions.admin_only
+    def show(self, req, id):
+        context = req.environ['nova.context']
+        images = self.compute_api.get_prefetch_status(context, host=id)
+        return {'prefetch': {'host': id, 'images': images}}
+
+
+class Image_prefetch(extensions.ExtensionDescriptor):
+    def get_name(self):
+        return "ImagePrefetch"
+
+    def get_alias(self):
+        return "os-image-prefetch"
+
+    def get_description(self):
+        return "Prefetch images into the image cache of compute hosts"
+
+    def get_namespace(self):
+        return "http://docs.openstack.org/ext/image-prefetch/api/v1.1"
+
+    def get_updated(self):
+        return "2011-10-18T00:00:00+00:00"
+
+    def get_resources(self):
+        resources = [extensions.ResourceExtension('os-image-prefetch',
+                ImagePrefetchController())]
+        return resources
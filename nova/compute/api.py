@@ -48,6 +48,11 @@ FLAGS = flags.FLAGS
 flags.DECLARE('vncproxy_topic', 'nova.vnc')
 flags.DEFINE_integer('find_host_timeout', 30,
                      'Timeout after NN seconds when looking for a host.')
+flags.DEFINE_boolean('compute_send_lock_state', True,
+                     'Send the lock state of instances along with lock'
+                     ' checked compute calls, so compute nodes need not'
+                     ' read it again.  Turn off while compute nodes that'
+                     ' predate it are still running.')
 
 
 def generate_default_hostname(instance):
@@ -790,7 +795,8 @@ class API(base.Base):
                         deleted_at=utils.utcnow())
 
             self._cast_compute_message('power_off_instance', context,
-                                       instance_id, host)
+                                       instance_id, host,
+                                       self._lock_state(instance))
         else:
             LOG.warning(_("No host for instance %s, deleting immediately"),
                         instance_id)
@@ -805,7 +811,8 @@ class API(base.Base):
                         progress=0)
 
             self._cast_compute_message('terminate_instance', context,
-                                       instance['id'], host)
+                                       instance['id'], host,
+                                       self._lock_state(instance))
         else:
             self.db.instance_destroy(context, instance['id'])
 
@@ -840,7 +847,7 @@ class API(base.Base):
                         instance_id,
                         task_state=task_states.POWERING_ON)
             self._cast_compute_message('power_on_instance', context,
-                    instance_id, host)
+                    instance_id, host, self._lock_state(instance))
 
     @scheduler_api.reroute_compute("force_delete")
     def force_delete(self, context, instance_id):
@@ -871,7 +878,7 @@ class API(base.Base):
         host = instance['host']
         if host:
             self._cast_compute_message('stop_instance', context,
-                    instance_id, host)
+                    instance_id, host, self._lock_state(instance))
 
     def start(self, context, instance_id):
         """Start an instance."""
@@ -1021,12 +1028,24 @@ class API(base.Base):
 
         return self.db.instance_get_all_by_filters(context, filters)
 
+    def _lock_state(self, instance):
+        """Return the rpc args that carry instance's lock state to compute.
+
+        Empty unless --compute_send_lock_state is set, as older compute
+        nodes reject the extra argument.
+        """
+        if not FLAGS.compute_send_lock_state:
+            return {}
+        return {'instance_locked': instance['locked']}
+
     def _cast_compute_message(self, method, context, instance_id, host=None,
-                              params=None):
+                              params=None, check_lock=False):
         """Generic handler for RPC casts to compute.
 
         :param params: Optional dictionary of arguments to be passed to the
                        compute worker
+        :param check_lock: Send the lock state of the instance looked up
+                           here along for the compute worker's lock check
 
         :returns: None
         """
@@ -1035,17 +1054,21 @@ class API(base.Base):
         if not host:
             instance = self.get(context, instance_id)
             host = instance['host']
+            if check_lock:
+                params.update(self._lock_state(instance))
         queue = self.db.queue_get_for(context, FLAGS.compute_topic, host)
         params['instance_id'] = instance_id
         kwargs = {'method': method, 'args': params}
         rpc.cast(context, queue, kwargs)
 
     def _call_compute_message(self, method, context, instance_id, host=None,
-                              params=None):
+                              params=None, check_lock=False):
         """Generic handler for RPC calls to compute.
 
         :param params: Optional dictionary of arguments to be passed to the
                        compute worker
+        :param check_lock: Send the lock state of the instance looked up
+                           here along for the compute worker's lock check
 
         :returns: Result returned by compute worker
         """
@@ -1054,6 +1077,8 @@ class API(base.Base):
         if not host:
             instance = self.get(context, instance_id)
             host = instance['host']
+            if check_lock:
+                params.update(self._lock_state(instance))
         queue = self.db.queue_get_for(context, FLAGS.compute_topic, host)
         params['instance_id'] = instance_id
         kwargs = {'method': method, 'args': params}
@@ -1150,7 +1175,7 @@ class API(base.Base):
                     vm_state=vm_states.ACTIVE,
                     task_state=task_states.REBOOTING)
         self._cast_compute_message('reboot_instance', context, instance_id,
-                params={'reboot_type': reboot_type})
+                params={'reboot_type': reboot_type}, check_lock=True)
 
     @scheduler_api.reroute_compute("rebuild")
     def rebuild(self, context, instance_id, image_href, admin_password,
@@ -1186,7 +1211,8 @@ class API(base.Base):
         self._cast_compute_message('rebuild_instance',
                                    context,
                                    instance_id,
-                                   params=rebuild_params)
+                                   params=rebuild_params,
+                                   check_lock=True)
 
     @scheduler_api.reroute_compute("revert_resize")
     def revert_resize(self, context, instance_id):
@@ -1293,13 +1319,15 @@ class API(base.Base):
         """Add fixed_ip from specified network to given instance."""
         self._cast_compute_message('add_fixed_ip_to_instance', context,
                                    instance_id,
-                                   params=dict(network_id=network_id))
+                                   params=dict(network_id=network_id),
+                                   check_lock=True)
 
     @scheduler_api.reroute_compute("remove_fixed_ip")
     def remove_fixed_ip(self, context, instance_id, address):
         """Remove fixed_ip from specified network to given instance."""
         self._cast_compute_message('remove_fixed_ip_from_instance', context,
-                                   instance_id, params=dict(address=address))
+                                   instance_id, params=dict(address=address),
+                                   check_lock=True)
 
     #TODO(tr3buchet): how to run this in the correct zone?
     def add_network_to_project(self, context, project_id):
@@ -1318,7 +1346,8 @@ class API(base.Base):
                     instance_id,
                     vm_state=vm_states.ACTIVE,
                     task_state=task_states.PAUSING)
-        self._cast_compute_message('pause_instance', context, instance_id)
+        self._cast_compute_message('pause_instance', context, instance_id,
+                                   check_lock=True)
 
     @scheduler_api.reroute_compute("unpause")
     def unpause(self, context, instance_id):
@@ -1327,7 +1356,8 @@ class API(base.Base):
                     instance_id,
                     vm_state=vm_states.PAUSED,
                     task_state=task_states.UNPAUSING)
-        self._cast_compute_message('unpause_instance', context, instance_id)
+        self._cast_compute_message('unpause_instance', context, instance_id,
+                                   check_lock=True)
 
     def _call_compute_message_for_host(self, action, context, host, params):
         """Call method deliberately designed to make host/service only calls"""
@@ -1340,6 +1370,33 @@ class API(base.Base):
         return self._call_compute_message_for_host("set_host_enabled", context,
                 host=host, params={"enabled": enabled})
 
+    def prefetch_images(self, context, image_ids, hosts=None,
+                        availability_zone=None, instance_type_id=None):
+        """Fetch images into the image cache of compute hosts.
+
+        The images go to the given hosts, or else to every compute host in
+        availability_zone, or else to every compute host.  Returns the
+        hosts asked to fetch them.
+        """
+        services = self.db.service_get_all_by_topic(context.elevated(),
+                                                    FLAGS.compute_topic)
+        targets = [service['host'] for service in services
+                   if (not hosts or service['host'] in hosts) and
+                      (not availability_zone or
+                       service['availability_zone'] == availability_zone)]
+        for host in targets:
+            rpc.cast(context,
+                     self.db.queue_get_for(context, FLAGS.compute_topic, host),
+                     {"method": "prefetch_images",
+                      "args": {"image_ids": image_ids,
+                               "instance_type_id": instance_type_id}})
+        return targets
+
+    def get_prefetch_status(self, context, host):
+        """Return the progress of image prefetches on a compute host."""
+        return self._call_compute_message_for_host("get_prefetch_status",
+                context, host=host, params={})
+
     def host_power_action(self, context, host, action):
         """Reboots, shuts down or powers up the host."""
         return self._call_compute_message_for_host("host_power_action",
@@ -1363,7 +1420,8 @@ class API(base.Base):
                     instance_id,
                     vm_state=vm_states.ACTIVE,
                     task_state=task_states.SUSPENDING)
-        self._cast_compute_message('suspend_instance', context, instance_id)
+        self._cast_compute_message('suspend_instance', context, instance_id,
+                                   check_lock=True)
 
     @scheduler_api.reroute_compute("resume")
     def resume(self, context, instance_id):
@@ -1372,7 +1430,8 @@ class API(base.Base):
                     instance_id,
                     vm_state=vm_states.SUSPENDED,
                     task_state=task_states.RESUMING)
-        self._cast_compute_message('resume_instance', context, instance_id)
+        self._cast_compute_message('resume_instance', context, instance_id,
+                                   check_lock=True)
 
     @scheduler_api.reroute_compute("rescue")
     def rescue(self, context, instance_id, rescue_password=None):
@@ -1386,7 +1445,7 @@ class API(base.Base):
             "rescue_password": rescue_password
         }
         self._cast_compute_message('rescue_instance', context, instance_id,
-                                    params=rescue_params)
+                                    params=rescue_params, check_lock=True)
 
     @scheduler_api.reroute_compute("unrescue")
     def unrescue(self, context, instance_id):
@@ -1395,7 +1454,8 @@ class API(base.Base):
                     instance_id,
                     vm_state=vm_states.RESCUED,
                     task_state=task_states.UNRESCUING)
-        self._cast_compute_message('unrescue_instance', context, instance_id)
+        self._cast_compute_message('unrescue_instance', context, instance_id,
+                                   check_lock=True)
 
     @scheduler_api.reroute_compute("set_admin_password")
     def set_admin_password(self, context, instance_id, password=None):
@@ -1409,7 +1469,8 @@ class API(base.Base):
 
     def inject_file(self, context, instance_id):
         """Write a file to the given instance."""
-        self._cast_compute_message('inject_file', context, instance_id)
+        self._cast_compute_message('inject_file', context, instance_id,
+                                   check_lock=True)
 
     def get_ajax_console(self, context, instance_id):
         """Get a url to an AJAX Console."""
@@ -1442,11 +1503,21 @@ class API(base.Base):
                        'hostignore',
                        'portignore')}
 
-    def get_console_output(self, context, instance_id):
-        """Get console output for an an instance."""
+    def get_console_output(self, context, instance_id, length=None):
+        """Get console output for an an instance.
+
+        Only the last length lines are returned if length is given.  The
+        libvirt driver also caps the output at the last
+        --console_output_max_bytes of the log, with or without length.
+        """
+        params = {}
+        # Left out when unset, for compute hosts that predate it.
+        if length is not None:
+            params['length'] = length
         return self._call_compute_message('get_console_output',
                                           context,
-                                          instance_id)
+                                          instance_id,
+                                          params=params)
 
     def lock(self, context, instance_id):
         """Lock the given instance."""
@@ -1463,11 +1534,13 @@ class API(base.Base):
 
     def reset_network(self, context, instance_id):
         """Reset networking on the instance."""
-        self._cast_compute_message('reset_network', context, instance_id)
+        self._cast_compute_message('reset_network', context, instance_id,
+                                   check_lock=True)
 
     def inject_network_info(self, context, instance_id):
         """Inject network info for the instance."""
-        self._cast_compute_message('inject_network_info', context, instance_id)
+        self._cast_compute_message('inject_network_info', context, instance_id,
+                                   check_lock=True)
 
     def attach_volume(self, context, instance_id, volume_id, device):
         """Attach an existing volume to an existing instance."""
@@ -1477,12 +1550,14 @@ class API(base.Base):
         self.volume_api.check_attach(context, volume_id=volume_id)
         instance = self.get(context, instance_id)
         host = instance['host']
+        args = {"volume_id": volume_id,
+                "instance_id": instance_id,
+                "mountpoint": device}
+        args.update(self._lock_state(instance))
         rpc.cast(context,
                  self.db.queue_get_for(context, FLAGS.compute_topic, host),
                  {"method": "attach_volume",
-                  "args": {"volume_id": volume_id,
-                           "instance_id": instance_id,
-                           "mountpoint": device}})
+                  "args": args})
 
     def detach_volume(self, context, volume_id):
         """Detach a volume from an instance."""
@@ -41,7 +41,9 @@ import sys
 import tempfile
 import time
 
+import eventlet
 from eventlet import greenthread
+from eventlet import semaphore
 
 import nova.context
 from nova import block_device
@@ -54,6 +56,8 @@ from nova import network
 from nova import rpc
 from nova import utils
 from nova import volume
+from nova.compute import instance_types
+from nova.compute import pipeline
 from nova.compute import power_state
 from nova.compute import task_states
 from nova.compute import vm_states
@@ -85,6 +89,31 @@ flags.DEFINE_integer("resize_confirm_window", 0,
                      " Set to 0 to disable.")
 flags.DEFINE_integer('host_state_interval', 120,
                      'Interval in seconds for querying the host status')
+flags.DEFINE_integer('update_resources_interval', 3600,
+                     'Interval in seconds for refreshing the resources'
+                     ' this host reports to the scheduler')
+flags.DEFINE_integer('sync_power_state_interval', 600,
+                     'Interval in seconds for a full reconcile of power'
+                     ' states with the hypervisor. Changes in between'
+                     ' are picked up from driver events.')
+flags.DEFINE_integer('image_cache_manager_interval', 2400,
+                     'Interval in seconds for removing unused images from'
+                     ' the local image cache. Set to -1 to disable.')
+flags.DEFINE_boolean('image_cache_dry_run', False,
+                     'Only log the images the image cache manager would'
+                     ' remove')
+flags.DEFINE_integer('max_concurrent_builds', 10,
+                     'Maximum instance builds to run at once on this host.'
+                     ' Set to 0 for no limit.')
+flags.DEFINE_integer('image_prefetch_concurrency', 2,
+                     'Images prefetched into the image cache at once on'
+                     ' this host')
+flags.DEFINE_integer('image_prefetch_status_ttl', 3600,
+                     'Seconds the outcome of a finished image prefetch is'
+                     ' kept for get_prefetch_status')
+flags.DEFINE_integer('max_concurrent_snapshots', 3,
+                     'Maximum snapshots to run at once on this host.'
+                     ' Set to 0 for no limit.')
 
 LOG = logging.getLogger('nova.compute.manager')
 
@@ -94,40 +123,76 @@ def publisher_id(host=None):
 
 
 def checks_instance_lock(function):
-    """Decorator to prevent action against locked instances for non-admins."""
+    """Decorator to prevent action against locked instances for non-admins.
+
+    The compute API sends the lock state it has already read along as
+    instance_locked, so it is only read here when that is missing, as on
+    calls from older API nodes or other managers.
+    """
     @functools.wraps(function)
     def decorated_function(self, context, instance_id, *args, **kwargs):
         #TODO(anyone): this being called instance_id is forcing a slightly
         # confusing convention of pushing instance_uuids
         # through an "instance_id" key in the queue args dict when
         # casting through the compute API
-        LOG.info(_("check_instance_lock: decorating: |%s|"), function,
-                 context=context)
-        LOG.info(_("check_instance_lock: arguments: |%(self)s| |%(context)s|"
-                " |%(instance_id)s|") % locals(), context=context)
-        locked = self.get_lock(context, instance_id)
-        admin = context.is_admin
-        LOG.info(_("check_instance_lock: locked: |%s|"), locked,
-                 context=context)
-        LOG.info(_("check_instance_lock: admin: |%s|"), admin,
-                 context=context)
-
-        # if admin or unlocked call function otherwise log error
-        if admin or not locked:
-            LOG.info(_("check_instance_lock: executing: |%s|"), function,
-                     context=context)
-            function(self, context, instance_id, *args, **kwargs)
-        else:
-            LOG.error(_("check_instance_lock: not executing |%s|"),
-                      function, context=context)
-            return False
+        locked = kwargs.pop('instance_locked', None)
+        if not context.is_admin:
+            if locked is None:
+                locked = self.get_lock(context, instance_id)
+            if locked:
+                LOG.error(_("check_instance_lock: not executing |%s|"),
+                          function.__name__, context=context)
+                return False
+        LOG.debug(_("check_instance_lock: executing: |%s|"),
+                  function.__name__, context=context)
+        function(self, context, instance_id, *args, **kwargs)
 
     return decorated_function
 
 
+class HostSnapshot(object):
+    """This host's instances in the database and on the hypervisor.
+
+    One is made per periodic cycle and shared by that cycle's tasks, so
+    each list is fetched at most once a cycle, and only if a task wants it.
+
+    """
+
+    def __init__(self, compute_manager, context):
+        self._manager = compute_manager
+        self._context = context
+        self._lock = semaphore.Semaphore()
+        self._db_instances = None
+        self._driver_instances = None
+
+    @property
+    def db_instances(self):
+        """The host's instances from instance_get_all_by_host."""
+        with self._lock:
+            if self._db_instances is None:
+                self._db_instances = self._manager.db.instance_get_all_by_host(
+                        self._context, self._manager.host)
+        return self._db_instances
+
+    @property
+    def driver_instances(self):
+        """InstanceInfo from list_instances_detail, by instance name."""
+        with self._lock:
+            if self._driver_instances is None:
+                infos = self._manager.driver.list_instances_detail()
+                self._driver_instances = dict((info.name, info)
+                                              for info in infos)
+        return self._driver_instances
+
+
 class ComputeManager(manager.SchedulerDependentManager):
     """Manages the running instances from creation to destruction."""
 
+    rpc_priority_methods = ('get_console_output', 'get_ajax_console',
+                            'get_vnc_console', 'get_diagnostics',
+                            'get_lock', 'get_console_topic',
+                            'get_console_pool_info')
+
     def __init__(self, compute_driver=None, *args, **kwargs):
         """Load configuration options and connect to the hypervisor."""
         # TODO(vish): sync driver creation logic with the rest of the system
@@ -145,18 +210,32 @@ class ComputeManager(manager.SchedulerDependentManager):
 
         self.network_api = network.API()
         self.network_manager = utils.import_object(FLAGS.network_manager)
-        self._last_host_check = 0
-        self._last_bw_usage_poll = 0
+        # instance name -> (instance id, power_state last written to the db)
+        self._power_states = {}
+        self._host_snapshot = None
+        self._boot_pipeline = pipeline.BootPipeline()
+        self._prefetch_pool = eventlet.GreenPool(
+                FLAGS.image_prefetch_concurrency)
+        # image id -> progress of its last prefetch
+        self._prefetches = {}
+        self.rpc_method_concurrency = {
+                'run_instance': FLAGS.max_concurrent_builds,
+                'snapshot_instance': FLAGS.max_concurrent_snapshots}
         super(ComputeManager, self).__init__(service_name="compute",
                                              *args, **kwargs)
 
     def _instance_update(self, context, instance_id, **kwargs):
         """Update an instance in the database using kwargs as value."""
-        return self.db.instance_update(context, instance_id, kwargs)
+        instance_ref = self.db.instance_update(context, instance_id, kwargs)
+        if 'power_state' in kwargs:
+            self._power_states[instance_ref['name']] = (instance_ref['id'],
+                                                        kwargs['power_state'])
+        return instance_ref
 
     def init_host(self):
         """Initialization for a standalone compute service."""
         self.driver.init_host(host=self.host)
+        self.driver.register_event_listener(self._handle_power_state_event)
         context = nova.context.get_admin_context()
         instances = self.db.instance_get_all_by_host(context, self.host)
         for instance in instances:
@@ -423,14 +502,20 @@ class ComputeManager(manager.SchedulerDependentManager):
         instance['admin_pass'] = kwargs.get('admin_password', None)
 
         is_vpn = instance['image_ref'] == str(FLAGS.vpn_image_id)
-        network_info = _make_network_info()
+        # Each stage admits a limited number of boots at once, so boots
+        # queue for the stage they are in rather than all fetching images
+        # or spawning together.
+        boot = self._boot_pipeline
+        timings = {}
+        network_info = boot.run('network', timings, _make_network_info)
         try:
             self._instance_update(context,
                                   instance_id,
                                   vm_state=vm_states.BUILDING,
                                   task_state=task_states.BLOCK_DEVICE_MAPPING)
 
-            block_device_info = _make_block_device_info()
+            block_device_info = boot.run('volumes', timings,
+                                         _make_block_device_info)
 
             self._instance_update(context,
                                   instance_id,
@@ -439,8 +524,10 @@ class ComputeManager(manager.SchedulerDependentManager):
 
             # TODO(vish) check to make sure the availability zone matches
             try:
-                self.driver.spawn(context, instance,
-                                  network_info, block_device_info)
+                boot.run('image', timings, self.driver.cache_image,
+                         context, instance, block_device_info)
+                boot.run('spawn', timings, self.driver.spawn, context,
+                         instance, network_info, block_device_info)
             except Exception as error:  # pylint: disable=W0702
                 LOG.exception(_("Instance '%(instance_id)s' failed to spawn. "
                                 "Details: %(error)s") % locals())
@@ -449,6 +536,10 @@ class ComputeManager(manager.SchedulerDependentManager):
                                       vm_state=vm_states.ERROR)
                 _deallocate_network()
                 return
+            LOG.info(_("instance %(instance_id)s: built in %(timings)s"),
+                     {'instance_id': instance_id,
+                      'timings': pipeline.format_timings(timings)},
+                     context=context)
 
             current_power_state = self._get_power_state(context, instance)
             self._instance_update(context,
@@ -494,6 +585,81 @@ class ComputeManager(manager.SchedulerDependentManager):
     def run_instance(self, context, instance_id, **kwargs):
         self._run_instance(context, instance_id, **kwargs)
 
+    def get_boot_pipeline_stats(self, context):
+        """Return the queue lengths and timings of each boot stage."""
+        return self._boot_pipeline.get_stats()
+
+    def prefetch_images(self, context, image_ids, instance_type_id=None):
+        """Fetch images into the image cache ahead of booting them.
+
+        Images are fetched in the background, at most
+        --image_prefetch_concurrency at once.  Fetches take the same
+        per-image locks as spawn, so a boot of an image being prefetched
+        waits for it rather than downloading it again.
+        """
+        context = context.elevated()
+        self._expire_prefetches()
+        if instance_type_id is None:
+            instance_type = instance_types.get_default_instance_type()
+        else:
+            instance_type = instance_types.get_instance_type(
+                    instance_type_id)
+        for image_id in image_ids:
+            progress = self._prefetches.get(image_id)
+            if progress and progress['state'] in ('queued', 'fetching'):
+                continue
+            self._prefetches[image_id] = {'state': 'queued',
+                                          'queued_at': utils.isotime(),
+                                          'started_at': None,
+                                          'finished_at': None,
+                                          'error': None}
+            self._prefetch_pool.spawn_n(self._prefetch_image, context,
+                                        image_id, instance_type)
+
+    def _prefetch_image(self, context, image_href, instance_type):
+        progress = self._prefetches[image_href]
+        progress['state'] = 'fetching'
+        progress['started_at'] = utils.isotime()
+        try:
+            image_service, image_id = nova.image.get_image_service(
+                    context, image_href)
+            properties = image_service.show(context,
+                                            image_id).get('properties', {})
+            kernel_id = properties.get('kernel_id')
+            ramdisk_id = properties.get('ramdisk_id')
+            if kernel_id == str(FLAGS.null_kernel):
+                kernel_id = None
+                ramdisk_id = None
+            instance = {'image_ref': image_href,
+                        'kernel_id': kernel_id,
+                        'ramdisk_id': ramdisk_id,
+                        'instance_type_id': instance_type['id'],
+                        'user_id': context.user_id,
+                        'project_id': context.project_id}
+            self.driver.cache_image(context, instance)
+        except Exception, e:
+            LOG.exception(_("Failed to prefetch image %s"), image_href)
+            progress['state'] = 'error'
+            progress['error'] = unicode(e)
+        else:
+            progress['state'] = 'done'
+        progress['finished_at'] = utils.isotime()
+
+    def _expire_prefetches(self):
+        """Forget prefetches that finished over the status ttl ago."""
+        expire_before = utils.utcnow() - datetime.timedelta(
+                seconds=FLAGS.image_prefetch_status_ttl)
+        for image_id, progress in self._prefetches.items():
+            finished_at = progress['finished_at']
+            if finished_at and \
+               utils.parse_isotime(finished_at) < expire_before:
+                del self._prefetches[image_id]
+
+    def get_prefetch_status(self, context):
+        """Return the progress of recent image prefetches by image id."""
+        self._expire_prefetches()
+        return self._prefetches
+
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     @checks_instance_lock
     def start_instance(self, context, instance_id):
@@ -1301,13 +1467,19 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.inject_network_info(instance, network_info)
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
-    def get_console_output(self, context, instance_id):
-        """Send the console output for the given instance."""
+    def get_console_output(self, context, instance_id, length=None):
+        """Send the console output for the given instance.
+
+        Only the last length lines are sent if length is given.
+        """
         context = context.elevated()
         instance_ref = self.db.instance_get(context, instance_id)
         LOG.audit(_("Get console output for instance %s"), instance_id,
                   context=context)
-        output = self.driver.get_console_output(instance_ref)
+        output = self.driver.get_console_output(instance_ref, length)
+        if length is not None:
+            lines = output.splitlines(True)
+            output = ''.join(lines[max(len(lines) - length, 0):])
         return output.decode('utf-8', 'replace').encode('ascii', 'replace')
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
@@ -1774,95 +1946,80 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.destroy(instance_ref, network_info,
                             block_device_info, True)
 
-    def periodic_tasks(self, context=None):
-        """Tasks to be run at a periodic interval."""
-        error_list = super(ComputeManager, self).periodic_tasks(context)
-        if error_list is None:
-            error_list = []
+    def run_periodic_tasks(self, context, wait=False):
+        """Run due periodic tasks against a fresh HostSnapshot.
 
-        try:
-            if FLAGS.reboot_timeout > 0:
-                self.driver.poll_rebooting_instances(FLAGS.reboot_timeout)
-        except Exception as ex:
-            LOG.warning(_("Error during poll_rebooting_instances: %s"),
-                    unicode(ex))
-            error_list.append(ex)
-
-        try:
-            if FLAGS.rescue_timeout > 0:
-                self.driver.poll_rescued_instances(FLAGS.rescue_timeout)
-        except Exception as ex:
-            LOG.warning(_("Error during poll_rescued_instances: %s"),
-                    unicode(ex))
-            error_list.append(ex)
-
-        try:
-            if FLAGS.resize_confirm_window > 0:
-                self.driver.poll_unconfirmed_resizes(
-                        FLAGS.resize_confirm_window)
-        except Exception as ex:
-            LOG.warning(_("Error during poll_unconfirmed_resizes: %s"),
-                    unicode(ex))
-            error_list.append(ex)
-
-        try:
-            self._report_driver_status()
-        except Exception as ex:
-            LOG.warning(_("Error during report_driver_status(): %s"),
-                    unicode(ex))
-            error_list.append(ex)
-
-        try:
-            self._sync_power_states(context)
-        except Exception as ex:
-            LOG.warning(_("Error during power_state sync: %s"), unicode(ex))
-            error_list.append(ex)
+        The snapshot is dropped once the cycle's tasks have finished, so
+        it is never handed out after the cycle it was made for.
 
+        """
+        if not wait:
+            eventlet.spawn_n(self.run_periodic_tasks, context, True)
+            return []
+        snapshot = self._host_snapshot = HostSnapshot(self, context)
         try:
-            self._reclaim_queued_deletes(context)
-        except Exception as ex:
-            LOG.warning(_("Error during reclamation of queued deletes: %s"),
-                        unicode(ex))
-            error_list.append(ex)
+            return super(ComputeManager, self).run_periodic_tasks(context,
+                                                                  wait)
+        finally:
+            # A later cycle may have replaced it already.
+            if self._host_snapshot is snapshot:
+                self._host_snapshot = None
+
+    def _get_host_snapshot(self, context):
+        """The current cycle's HostSnapshot, or a new one outside a cycle."""
+        return self._host_snapshot or HostSnapshot(self, context)
+
+    @manager.periodic_task
+    def _poll_rebooting_instances(self, context):
+        if FLAGS.reboot_timeout > 0:
+            self.driver.poll_rebooting_instances(FLAGS.reboot_timeout)
+
+    @manager.periodic_task
+    def _poll_rescued_instances(self, context):
+        if FLAGS.rescue_timeout > 0:
+            self.driver.poll_rescued_instances(FLAGS.rescue_timeout)
+
+    @manager.periodic_task
+    def _poll_unconfirmed_resizes(self, context):
+        if FLAGS.resize_confirm_window > 0:
+            self.driver.poll_unconfirmed_resizes(FLAGS.resize_confirm_window)
+
+    @manager.periodic_task(interval_flag='bandwith_poll_interval')
+    def _poll_bandwidth_usage(self, context):
+        start = utils.current_audit_period()[1]
         try:
-            start = utils.current_audit_period()[1]
             self._update_bandwidth_usage(context, start)
         except NotImplementedError:
             # Not all hypervisors have bandwidth polling implemented yet.
             # If they don't id doesn't break anything, they just don't get the
             # info in the usage events. (mdragon)
             pass
-        except Exception as ex:
-            LOG.warning(_("Error updating bandwidth usage: %s"),
-                        unicode(ex))
-            error_list.append(ex)
-
-        return error_list
 
     def _update_bandwidth_usage(self, context, start_time, stop_time=None):
-        curr_time = time.time()
-        if curr_time - self._last_bw_usage_poll > FLAGS.bandwith_poll_interval:
-            self._last_bw_usage_poll = curr_time
-            LOG.info(_("Updating bandwidth usage cache"))
-            bw_usage = self.driver.get_all_bw_usage(start_time, stop_time)
-            for usage in bw_usage:
-                vif = usage['virtual_interface']
-                self.db.bw_usage_update(context,
-                                        vif.instance_id,
-                                        vif.network.label,
-                                        start_time,
-                                        usage['bw_in'], usage['bw_out'])
-
-    def _report_driver_status(self):
-        curr_time = time.time()
-        if curr_time - self._last_host_check > FLAGS.host_state_interval:
-            self._last_host_check = curr_time
-            LOG.info(_("Updating host status"))
-            # This will grab info about the host and queue it
-            # to be sent to the Schedulers.
-            self.update_service_capabilities(
-                self.driver.get_host_stats(refresh=True))
-
+        LOG.info(_("Updating bandwidth usage cache"))
+        bw_usage = self.driver.get_all_bw_usage(start_time, stop_time)
+        usages = []
+        for usage in bw_usage:
+            vif = usage['virtual_interface']
+            usages.append({'instance_id': vif.instance_id,
+                           'network_label': vif.network.label,
+                           'bw_in': usage['bw_in'],
+                           'bw_out': usage['bw_out']})
+        self.db.bw_usage_update_bulk(context, start_time, usages)
+
+    @manager.periodic_task(interval_flag='host_state_interval')
+    def _report_driver_status(self, context):
+        LOG.info(_("Updating host status"))
+        # This will grab info about the host and queue it
+        # to be sent to the Schedulers.
+        self.update_service_capabilities(
+            self.driver.get_host_stats(refresh=True))
+
+    @manager.periodic_task(interval_flag='update_resources_interval')
+    def _update_available_resource(self, context):
+        self.update_available_resource(context)
+
+    @manager.periodic_task(interval_flag='sync_power_state_interval')
     def _sync_power_states(self, context):
         """Align power states between the database and the hypervisor.
 
@@ -1872,10 +2029,13 @@ class ComputeManager(manager.SchedulerDependentManager):
         then it will be set to power_state.NOSTATE, because it doesn't exist
         on the hypervisor.
 
+        Changes are normally picked up as driver events, so this only runs
+        every sync_power_state_interval seconds to catch missed events.
+
         """
-        vm_instances = self.driver.list_instances_detail()
-        vm_instances = dict((vm.name, vm) for vm in vm_instances)
-        db_instances = self.db.instance_get_all_by_host(context, self.host)
+        snapshot = self._get_host_snapshot(context)
+        vm_instances = snapshot.driver_instances
+        db_instances = snapshot.db_instances
 
         num_vm_instances = len(vm_instances)
         num_db_instances = len(db_instances)
@@ -1884,6 +2044,7 @@ class ComputeManager(manager.SchedulerDependentManager):
             LOG.info(_("Found %(num_db_instances)s in the database and "
                        "%(num_vm_instances)s on the hypervisor.") % locals())
 
+        self._power_states = {}
         for db_instance in db_instances:
             name = db_instance["name"]
             db_power_state = db_instance['power_state']
@@ -1894,6 +2055,7 @@ class ComputeManager(manager.SchedulerDependentManager):
             else:
                 vm_power_state = vm_instance.state
 
+            self._power_states[name] = (db_instance["id"], db_power_state)
             if vm_power_state == db_power_state:
                 continue
 
@@ -1901,10 +2063,57 @@ class ComputeManager(manager.SchedulerDependentManager):
                                   db_instance["id"],
                                   power_state=vm_power_state)
 
+    def _handle_power_state_event(self, name, state):
+        """Record a power state change reported by the driver."""
+        known = self._power_states.get(name)
+        if known is None:
+            # Not one of ours, or created since the last full sync; the
+            # next sync will pick it up.
+            LOG.debug(_('Ignoring power state event for unknown instance '
+                        '%s'), name)
+            return
+        instance_id, db_power_state = known
+        if state == db_power_state:
+            return
+        LOG.debug(_('Power state of %(name)s changed from '
+                    '%(db_power_state)s to %(state)s'), locals())
+        context = nova.context.get_admin_context()
+        try:
+            self._instance_update(context, instance_id, power_state=state)
+        except exception.NotFound:
+            self._power_states.pop(name, None)
+
+    @manager.periodic_task(interval_flag='image_cache_manager_interval')
+    def _run_image_cache_manager_pass(self, context):
+        """Remove images that no instance uses from the local cache."""
+        instances = self._get_host_snapshot(context).db_instances
+        self.driver.manage_image_cache(context, instances,
+                                       dry_run=FLAGS.image_cache_dry_run)
+
+    def get_hypervisor_call_stats(self, context):
+        """Return the latency counters of the driver's hypervisor calls."""
+        return self.driver.get_call_stats()
+
+    def get_migration_progress(self, context):
+        """Return the progress of the driver's running migrations."""
+        return self.driver.get_migration_progress()
+
+    def get_nbd_stats(self, context):
+        """Return the counters of the driver's nbd device pool."""
+        return self.driver.get_nbd_stats()
+
+    def get_image_cache_report(self, context):
+        """Return what an image cache pass would remove right now."""
+        context = context.elevated()
+        instances = self.db.instance_get_all_by_host(context, self.host)
+        return self.driver.manage_image_cache(context, instances,
+                                              dry_run=True)
+
+    @manager.periodic_task
     def _reclaim_queued_deletes(self, context):
         """Reclaim instances that are queued for deletion."""
 
-        instances = self.db.instance_get_all_by_host(context, self.host)
+        instances = self._get_host_snapshot(context).db_instances
 
         queue_time = datetime.timedelta(
                          seconds=FLAGS.reclaim_instance_interval)
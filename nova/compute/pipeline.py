@@ -0,0 +1,137 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Staged instance boot pipeline.
+
+A boot goes through the network, volumes, image and spawn stages in
+turn.  Each stage admits a limited number of boots at once and queues
+the rest, so a burst of boots on one host overlaps across stages instead
+of, say, downloading fifty images at the same time.
+
+"""
+
+import time
+
+from eventlet import semaphore
+
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.compute.pipeline')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('boot_network_concurrency', 10,
+                     'Boots allocating networks at once on this host.'
+                     ' Set to 0 for no limit.')
+flags.DEFINE_integer('boot_volumes_concurrency', 5,
+                     'Boots setting up block devices at once on this host.'
+                     ' Set to 0 for no limit.')
+flags.DEFINE_integer('boot_image_concurrency', 2,
+                     'Boots fetching images at once on this host.'
+                     ' Set to 0 for no limit.')
+flags.DEFINE_integer('boot_spawn_concurrency', 4,
+                     'Boots spawning on the hypervisor at once on this host.'
+                     ' Set to 0 for no limit.')
+
+STAGES = ('network', 'volumes', 'image', 'spawn')
+
+
+class Stage(object):
+    """Admits a limited number of callers at once and times them."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._semaphore = limit and semaphore.Semaphore(limit) or None
+        self.waiting = 0
+        self.running = 0
+        self.calls = 0
+        self.failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def run(self, func, *args, **kwargs):
+        """Call func once the stage has room, returning (result, seconds).
+
+        seconds includes the time spent queued for the stage.
+        """
+        queued_at = time.time()
+        self.waiting += 1
+        if self._semaphore:
+            self._semaphore.acquire()
+        self.waiting -= 1
+        started_at = time.time()
+        self.running += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.running -= 1
+            if self._semaphore:
+                self._semaphore.release()
+            finished_at = time.time()
+            self.calls += 1
+            wait = started_at - queued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            run = finished_at - started_at
+            self.run_total += run
+            self.run_max = max(self.run_max, run)
+        return result, finished_at - queued_at
+
+    def get_stats(self):
+        return {'limit': self.limit,
+                'waiting': self.waiting,
+                'running': self.running,
+                'calls': self.calls,
+                'failures': self.failures,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+                'run_total': self.run_total,
+                'run_max': self.run_max}
+
+
+class BootPipeline(object):
+    """The boot stages of one compute host."""
+
+    def __init__(self):
+        self.stages = {
+            'network': Stage('network', FLAGS.boot_network_concurrency),
+            'volumes': Stage('volumes', FLAGS.boot_volumes_concurrency),
+            'image': Stage('image', FLAGS.boot_image_concurrency),
+            'spawn': Stage('spawn', FLAGS.boot_spawn_concurrency)}
+
+    def run(self, stage, timings, func, *args, **kwargs):
+        """Run func in stage, adding its time to timings[stage]."""
+        result, seconds = self.stages[stage].run(func, *args, **kwargs)
+        timings[stage] = seconds
+        return result
+
+    def get_stats(self):
+        """Return the counters and timings of each stage by name."""
+        return dict((name, stage.get_stats())
+                    for name, stage in self.stages.iteritems())
+
+
+def format_timings(timings):
+    """Format per-stage seconds in pipeline order for logging."""
+    return ', '.join('%s %.2fs' % (name, timings[name])
+                     for name in STAGES if name in timings)
@@ -1460,6 +1460,17 @@ def bw_usage_update(context,
                                 session=None)
 
 
+def bw_usage_update_bulk(context, start_period, usages):
+    """Update cached bw usage for many instances and networks at once.
+
+    usages is a list of dicts with instance_id, network_label, bw_in and
+    bw_out.  Creates new records as needed and leaves records whose
+    counters haven't changed untouched, all in one transaction.  Of
+    usages repeated for an instance and network, the last one is kept.
+    """
+    return IMPL.bw_usage_update_bulk(context, start_period, usages)
+
+
 ####################
 
 
@@ -3668,6 +3668,48 @@ def bw_usage_update(context,
         bwusage.save(session=session)
 
 
+@require_context
+def bw_usage_update_bulk(context, start_period, usages):
+    session = get_session()
+    with session.begin():
+        instance_ids = set(usage['instance_id'] for usage in usages)
+        existing = {}
+        if instance_ids:
+            rows = session.query(models.BandwidthUsage).\
+                           filter_by(start_period=start_period).\
+                           filter(models.BandwidthUsage.instance_id.in_(
+                                  instance_ids)).\
+                           all()
+            for row in rows:
+                existing[(row.instance_id, row.network_label)] = row
+
+        # The last usage given for an instance and network wins, so a
+        # pair repeated in one batch is inserted once.
+        merged = {}
+        for usage in usages:
+            merged[(usage['instance_id'], usage['network_label'])] = usage
+
+        now = utils.utcnow()
+        new_rows = []
+        for key, usage in merged.iteritems():
+            row = existing.get(key)
+            if row is None:
+                new_rows.append({'instance_id': usage['instance_id'],
+                                 'network_label': usage['network_label'],
+                                 'start_period': start_period,
+                                 'last_refreshed': now,
+                                 'bw_in': usage['bw_in'],
+                                 'bw_out': usage['bw_out']})
+            elif row.bw_in != usage['bw_in'] or row.bw_out != usage['bw_out']:
+                row.update({'last_refreshed': now,
+                            'bw_in': usage['bw_in'],
+                            'bw_out': usage['bw_out']})
+        if new_rows:
+            # One executemany insert rather than an insert per object.
+            session.execute(models.BandwidthUsage.__table__.insert(),
+                            new_rows)
+
+
 ####################
 
 
@@ -289,6 +289,11 @@ class SourceHostUnavailable(Invalid):
     message = _("Original compute host is unavailable at this time.")
 
 
+class HypervisorCallTimeout(NovaException):
+    message = _("Hypervisor call %(method)s did not return within "
+                "%(timeout)d seconds")
+
+
 class InvalidHypervisorType(Invalid):
     message = _("The supplied hypervisor type of is invalid.")
 
@@ -332,6 +337,11 @@ class ImageUnacceptable(Invalid):
     message = _("Image %(image_id)s is unacceptable") + ": %(reason)s"
 
 
+class SnapshotNotStreamable(Invalid):
+    message = _("Snapshot %(name)s of %(path)s cannot be streamed") + \
+              ": %(reason)s"
+
+
 class InstanceUnacceptable(Invalid):
     message = _("Instance %(instance_id)s is unacceptable") + ": %(reason)s"
 
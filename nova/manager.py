@@ -47,35 +47,209 @@ level(FlatNetwork vs VlanNetwork), and different implementations at the driver
 level(LinuxNetDriver vs CiscoNetDriver).
 
 Managers will often provide methods for initial setup of a host or periodic
-tasksto a wrapping service.
+tasksto a wrapping service.  Periodic tasks are methods decorated with
+periodic_task; the service calls run_periodic_tasks on every tick and
+each task runs when its own interval is up.
 
 This module provides Manager, a base class for managers.
 
 """
 
+import copy
+import random
+import time
+
+import eventlet
+
 from nova import flags
 from nova import log as logging
 from nova import utils
 from nova.db import base
+from nova.rpc import common as rpc_common
+from nova.rpc import metrics
 from nova.scheduler import api
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('capability_snapshot_interval', 10,
+                     'Send schedulers a full capability snapshot every N '
+                     'updates, and only the changed keys in between')
+flags.DEFINE_integer('periodic_task_jitter', 60,
+                     'Delay the first run of each periodic task by up to '
+                     'this many seconds, so that hosts started together '
+                     'do not all run their tasks at the same moment')
+flags.DEFINE_list('periodic_task_intervals', [],
+                  'Periodic task intervals overriding the defaults, as '
+                  'task=seconds, e.g. _sync_power_states=300. A negative '
+                  'interval disables the task.')
 
 
 LOG = logging.getLogger('nova.manager')
 
 
+def periodic_task(*args, **kwargs):
+    """Decorator that makes a manager method a periodic task.
+
+    A bare @periodic_task runs the method on every periodic tick;
+    @periodic_task(interval=N) runs it at most every N seconds and
+    @periodic_task(interval_flag='name') every FLAGS.name seconds.  The
+    method is called with an admin context.
+
+    """
+    def decorator(f):
+        f._periodic_task = True
+        f._periodic_interval = kwargs.get('interval', 0)
+        f._periodic_interval_flag = kwargs.get('interval_flag')
+        return f
+
+    if kwargs:
+        return decorator
+    return decorator(args[0])
+
+
+class PeriodicTask(object):
+    """Schedule and run time statistics of one periodic task."""
+
+    def __init__(self, name, interval=0, interval_flag=None):
+        self.name = name
+        self._interval = interval
+        self._interval_flag = interval_flag
+        self._bad_override = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skips = 0
+        self.last_run = None
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        jitter = FLAGS.periodic_task_jitter
+        if self.interval > 0:
+            jitter = min(jitter, self.interval)
+        self.next_run = time.time() + random.uniform(0, max(jitter, 0))
+
+    @property
+    def interval(self):
+        for override in FLAGS.periodic_task_intervals:
+            name, _sep, interval = override.partition('=')
+            if name.strip() != self.name:
+                continue
+            try:
+                return float(interval)
+            except ValueError:
+                # Warn once per bad value, as this is read every tick
+                if override != self._bad_override:
+                    self._bad_override = override
+                    LOG.warning(_("Ignoring invalid periodic task interval "
+                                  "%s, using the default"), override)
+        if self._interval_flag:
+            return getattr(FLAGS, self._interval_flag)
+        return self._interval
+
+    def is_due(self, now):
+        return self.interval >= 0 and now >= self.next_run
+
+    def started(self, now):
+        self.running = True
+        self.last_run = now
+        self.next_run = now + self.interval
+
+    def finished(self, duration, failed=False):
+        self.running = False
+        self.runs += 1
+        if failed:
+            self.failures += 1
+        self.last_duration = duration
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+    def to_dict(self):
+        return {'interval': self.interval,
+                'running': self.running,
+                'runs': self.runs,
+                'failures': self.failures,
+                'skips': self.skips,
+                'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'max_duration': self.max_duration,
+                'total_duration': self.total_duration}
+
+
 class Manager(base.Base):
+    # Rpc methods that run from a reserved thread pool, ahead of slow
+    # operations queued in the main one.
+    rpc_priority_methods = ()
+
+    # Most handlers of an rpc method that may run at once, by method name.
+    rpc_method_concurrency = {}
+
     def __init__(self, host=None, db_driver=None):
         if not host:
             host = FLAGS.host
         self.host = host
+        self._periodic_tasks = self._find_periodic_tasks()
         super(Manager, self).__init__(db_driver)
 
+    def _find_periodic_tasks(self):
+        tasks = {}
+        for cls in reversed(type(self).__mro__):
+            for name, value in vars(cls).iteritems():
+                if getattr(value, '_periodic_task', False):
+                    tasks[name] = PeriodicTask(name,
+                                               value._periodic_interval,
+                                               value._periodic_interval_flag)
+        return tasks
+
+    def _run_periodic_task(self, task, context):
+        start = time.time()
+        try:
+            getattr(self, task.name)(context)
+        except Exception as ex:
+            LOG.warning(_("Error during %(name)s: %(ex)s"),
+                        {'name': task.name, 'ex': unicode(ex)})
+            task.finished(time.time() - start, failed=True)
+            return ex
+        task.finished(time.time() - start)
+
+    def run_periodic_tasks(self, context, wait=False):
+        """Start each periodic task that is due in its own greenthread.
+
+        A task still running from an earlier tick is skipped this time.
+        If wait is True, waits for the tasks started here and returns the
+        exceptions they raised.
+
+        """
+        now = time.time()
+        threads = []
+        for name in sorted(self._periodic_tasks):
+            task = self._periodic_tasks[name]
+            if not task.is_due(now):
+                continue
+            if task.running:
+                LOG.debug(_('Skipping periodic task %s, still running'),
+                          name)
+                task.skips += 1
+                continue
+            task.started(now)
+            threads.append(eventlet.spawn(self._run_periodic_task, task,
+                                          context))
+        if not wait:
+            return []
+        errors = [thread.wait() for thread in threads]
+        return [error for error in errors if error is not None]
+
     def periodic_tasks(self, context=None):
-        """Tasks to be run at a periodic interval."""
-        pass
+        """Run the periodic tasks that are due and wait for them.
+
+        Returns the exceptions raised by tasks.
+
+        """
+        return self.run_periodic_tasks(context, wait=True)
+
+    def get_periodic_task_stats(self, context):
+        """Return run time statistics of the periodic tasks by name."""
+        return dict((name, task.to_dict())
+                    for name, task in self._periodic_tasks.iteritems())
 
     def init_host(self):
         """Handle initialization if this is a standalone service.
@@ -85,6 +259,14 @@ class Manager(base.Base):
         """
         pass
 
+    def get_rpc_metrics(self, context):
+        """Return the rpc latency histograms recorded in this process."""
+        return metrics.get_metrics()
+
+    def get_rpc_dispatch_stats(self, context):
+        """Return the rpc backlog and wait times of this process by method."""
+        return rpc_common.get_dispatch_stats()
+
 
 class SchedulerDependentManager(Manager):
     """Periodically send capability updates to the Scheduler services.
@@ -94,22 +276,62 @@ class SchedulerDependentManager(Manager):
     manager.Manager directly. Updates are only sent after
     update_service_capabilities is called with non-None values.
 
+    Updates carry a sequence number and, except for a full snapshot every
+    capability_snapshot_interval updates, only the keys that changed since
+    the previous one.  A scheduler that misses an update asks for a
+    snapshot with resync_service_capabilities.
+
     """
 
     def __init__(self, host=None, db_driver=None, service_name='undefined'):
         self.last_capabilities = None
         self.service_name = service_name
+        self._published_capabilities = None
+        self._capability_seq = 0
+        self._updates_since_snapshot = 0
         super(SchedulerDependentManager, self).__init__(host, db_driver)
 
     def update_service_capabilities(self, capabilities):
         """Remember these capabilities to send on next periodic update."""
         self.last_capabilities = capabilities
+        if capabilities is None:
+            # Whatever the schedulers have will go stale, so start over
+            # with a snapshot if we publish again.
+            self._published_capabilities = None
 
-    def periodic_tasks(self, context=None):
-        """Pass data back to the scheduler at a periodic interval."""
-        if self.last_capabilities:
+    def resync_service_capabilities(self, context=None):
+        """Send a full snapshot on the next periodic update."""
+        self._published_capabilities = None
+
+    def _publish_service_capabilities(self, context):
+        capabilities = copy.deepcopy(self.last_capabilities)
+        published = self._published_capabilities
+        self._capability_seq += 1
+        snapshot_interval = FLAGS.capability_snapshot_interval
+        if (published is None or
+            self._updates_since_snapshot >= snapshot_interval):
             LOG.debug(_('Notifying Schedulers of capabilities ...'))
             api.update_service_capabilities(context, self.service_name,
-                                self.host, self.last_capabilities)
+                                self.host, capabilities,
+                                seq=self._capability_seq)
+            self._updates_since_snapshot = 0
+        else:
+            changed = dict((key, value)
+                           for key, value in capabilities.iteritems()
+                           if key not in published or
+                              published[key] != value)
+            removed = [key for key in published if key not in capabilities]
+            LOG.debug(_('Notifying Schedulers of %d changed capabilities'),
+                      len(changed) + len(removed))
+            api.update_service_capabilities(context, self.service_name,
+                                self.host, changed,
+                                seq=self._capability_seq, delta=True,
+                                removed=removed)
+            self._updates_since_snapshot += 1
+        self._published_capabilities = capabilities
 
-        super(SchedulerDependentManager, self).periodic_tasks(context)
+    @periodic_task
+    def _report_capabilities(self, context):
+        """Pass data back to the scheduler at a periodic interval."""
+        if self.last_capabilities:
+            self._publish_service_capabilities(context)
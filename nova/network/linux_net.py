@@ -22,6 +22,10 @@ import calendar
 import inspect
 import netaddr
 import os
+import time
+
+from eventlet import event
+from eventlet import greenthread
 
 from nova import db
 from nova import exception
@@ -70,6 +74,13 @@ flags.DEFINE_bool('send_arp_for_ha', False,
 flags.DEFINE_bool('use_single_default_gateway',
                    False, 'Use single default gateway. Only first nic of vm'
                           ' will get default gateway from dhcp server')
+flags.DEFINE_integer('iptables_resync_interval', 3600,
+                     'Seconds between full restores of the iptables tables'
+                     ' that catch rules changed behind our back. Set to 0'
+                     ' to only restore in full when a change fails.')
+flags.DEFINE_float('iptables_apply_delay', 0.1,
+                   'Seconds to gather iptables changes for before applying'
+                   ' them together')
 binary_name = os.path.basename(inspect.stack()[-1][1])
 
 
@@ -205,6 +216,26 @@ class IptablesTable(object):
         for rule in chained_rules:
             self.rules.remove(rule)
 
+    def get_state(self):
+        """Return the table's rules, to tell what changed between applies.
+
+        Returns the rules of each wrapped chain by wrapped chain name, and
+        the unwrapped chains and rules, which share chains with other
+        components and with rules nova does not manage.
+
+        """
+        chains = dict(('%s-%s' % (binary_name, name), [])
+                      for name in self.chains)
+        unwrapped_rules = []
+        for rule in self.rules:
+            if rule.wrap:
+                chain = '%s-%s' % (binary_name, rule.chain)
+                chains.setdefault(chain, []).append(str(rule))
+            else:
+                unwrapped_rules.append((str(rule), rule.top))
+        return chains, (frozenset(self.unwrapped_chains),
+                        tuple(unwrapped_rules))
+
 
 class IptablesManager(object):
     """Wrapper for iptables.
@@ -288,6 +319,16 @@ class IptablesManager(object):
         self.ipv4['nat'].add_chain('floating-snat')
         self.ipv4['nat'].add_rule('snat', '-j $floating-snat')
 
+        # The state of each table as of the last apply, by (command,
+        # table name).
+        self._applied = {}
+        self._resynced_at = 0
+        self._pending_apply = None
+
+    def resync(self):
+        """Make the next apply restore every table in full."""
+        self._applied = {}
+
     @utils.synchronized('iptables', external=True)
     def apply(self):
         """Apply the current in-memory set of iptables rules.
@@ -296,23 +337,115 @@ class IptablesManager(object):
         same component of Nova, and replace them with our current set of
         rules. This happens atomically, thanks to iptables-restore.
 
+        Tables that have not changed since the last apply are left alone.
+        When only wrapped chains changed, just those chains are restored.
+        The rest of a table is only saved and restored in full the first
+        time, when unwrapped rules change, when restoring the changed
+        chains fails because the rules were changed behind our back, and
+        every --iptables_resync_interval seconds.
+
         """
+        if FLAGS.iptables_resync_interval and \
+           time.time() - self._resynced_at > FLAGS.iptables_resync_interval:
+            self._applied = {}
+            self._resynced_at = time.time()
+
         s = [('iptables', self.ipv4)]
         if FLAGS.use_ipv6:
             s += [('ip6tables', self.ipv6)]
 
         for cmd, tables in s:
             for table in tables:
-                current_table, _ = self.execute('%s-save' % (cmd,),
-                                                '-t', '%s' % (table,),
-                                                run_as_root=True,
-                                                attempts=5)
-                current_lines = current_table.split('\n')
-                new_filter = self._modify_rules(current_lines,
-                                                tables[table])
-                self.execute('%s-restore' % (cmd,), run_as_root=True,
-                             process_input='\n'.join(new_filter),
-                             attempts=5)
+                state = tables[table].get_state()
+                applied = self._applied.get((cmd, table))
+                if state == applied:
+                    continue
+                # Forget the table until it is applied, so that if this
+                # apply fails the next one restores it in full.
+                self._applied.pop((cmd, table), None)
+                if applied is None or state[1] != applied[1]:
+                    self._apply_table(cmd, table, tables[table])
+                else:
+                    try:
+                        self._apply_chains(cmd, table, state[0], applied[0])
+                    except exception.ProcessExecutionError:
+                        LOG.warn(_('Failed to update the changed chains of '
+                                   'the %(table)s table with %(cmd)s, '
+                                   'restoring it in full'), locals())
+                        self._apply_table(cmd, table, tables[table])
+                self._applied[(cmd, table)] = state
+
+    def defer_apply(self, wait=False):
+        """Apply the rules within --iptables_apply_delay seconds.
+
+        The changes of every caller in the meantime are applied together
+        by a single apply.  With wait, returns once that apply is done,
+        raising what it raised; otherwise its errors are only logged.
+
+        """
+        if self._pending_apply is None:
+            self._pending_apply = event.Event()
+            greenthread.spawn_after(FLAGS.iptables_apply_delay,
+                                    self._apply_pending)
+        if wait:
+            self._pending_apply.wait()
+
+    def _apply_pending(self):
+        # Changes made from here on wait for the next apply, since this
+        # one may already have looked at their tables.
+        pending, self._pending_apply = self._pending_apply, None
+        try:
+            self.apply()
+        except Exception, e:
+            LOG.exception(_('Failed to apply iptables rules'))
+            pending.send_exception(e)
+        else:
+            pending.send()
+
+    def _apply_table(self, cmd, table, iptables_table):
+        """Replace our rules in table with those of iptables_table."""
+        current_table, _ = self.execute('%s-save' % (cmd,),
+                                        '-t', '%s' % (table,),
+                                        run_as_root=True,
+                                        attempts=5)
+        current_lines = current_table.split('\n')
+        new_filter = self._modify_rules(current_lines, iptables_table)
+        self.execute('%s-restore' % (cmd,), run_as_root=True,
+                     process_input='\n'.join(new_filter),
+                     attempts=5)
+
+    def _apply_chains(self, cmd, table, chains, applied_chains):
+        """Restore only the wrapped chains that changed since the last apply.
+
+        With --noflush, declaring a chain flushes it and leaves every other
+        chain of the table as it is.
+
+        """
+        changed = [name for name in sorted(chains)
+                   if chains[name] != applied_chains.get(name)]
+        removed = sorted(set(applied_chains) - set(chains))
+        lines = ['*%s' % (table,)]
+        lines += [':%s - [0:0]' % (name,) for name in changed + removed]
+        for name in changed:
+            lines += self._weed_out_duplicates(chains[name])
+        lines += ['-X %s' % (name,) for name in removed]
+        lines += ['COMMIT', '']
+        LOG.debug(_('Updating chains %(changed)s and removing chains '
+                    '%(removed)s of the %(table)s table'), locals())
+        self.execute('%s-restore' % (cmd,), '--noflush', run_as_root=True,
+                     process_input='\n'.join(lines))
+
+    @staticmethod
+    def _weed_out_duplicates(rules):
+        """Drop repeated rules, letting the *last* occurrence stay."""
+        seen = set()
+        kept = []
+        for rule in reversed(rules):
+            if rule.strip() not in seen:
+                seen.add(rule.strip())
+                kept.append(rule)
+        kept.reverse()
+        return kept
 
     def _modify_rules(self, current_lines, table, binary=None):
         unwrapped_chains = table.unwrapped_chains
@@ -378,7 +511,7 @@ def metadata_forward():
                                           '-p tcp -m tcp --dport 80 -j DNAT '
                                           '--to-destination %s:%s' % \
                                           (FLAGS.ec2_dmz_host, FLAGS.ec2_port))
-    iptables_manager.apply()
+    iptables_manager.defer_apply()
 
 
 def metadata_accept():
@@ -389,7 +522,7 @@ def metadata_accept():
                                              '-j ACCEPT' % \
                                              (FLAGS.ec2_dmz_host,
                                               FLAGS.ec2_port))
-    iptables_manager.apply()
+    iptables_manager.defer_apply()
 
 
 def init_host():
@@ -409,7 +542,7 @@ def init_host():
                                           '-s %(range)s -d %(range)s '
                                           '-j ACCEPT' % \
                                           {'range': FLAGS.fixed_range})
-    iptables_manager.apply()
+    iptables_manager.defer_apply()
 
 
 def bind_floating_ip(floating_ip, check_exit_code=True):
@@ -450,21 +583,21 @@ def ensure_vpn_forward(public_ip, port, private_ip):
                                           "-d %s -p udp "
                                           "--dport %s -j DNAT --to %s:1194" %
                                           (public_ip, port, private_ip))
-    iptables_manager.apply()
+    iptables_manager.defer_apply(wait=True)
 
 
 def ensure_floating_forward(floating_ip, fixed_ip):
     """Ensure floating ip forwarding rule."""
     for chain, rule in floating_forward_rules(floating_ip, fixed_ip):
         iptables_manager.ipv4['nat'].add_rule(chain, rule)
-    iptables_manager.apply()
+    iptables_manager.defer_apply(wait=True)
 
 
 def remove_floating_forward(floating_ip, fixed_ip):
     """Remove forwarding for floating ip."""
     for chain, rule in floating_forward_rules(floating_ip, fixed_ip):
         iptables_manager.ipv4['nat'].remove_rule(chain, rule)
-    iptables_manager.apply()
+    iptables_manager.defer_apply(wait=True)
 
 
 def floating_forward_rules(floating_ip, fixed_ip):
@@ -562,7 +695,7 @@ def _add_dnsmasq_accept_rules(dev):
             table.add_rule('INPUT',
                            '-i %(dev)s -p %(proto)s -m %(proto)s '
                            '--dport %(port)s -j ACCEPT' % args)
-    iptables_manager.apply()
+    iptables_manager.defer_apply()
 
 
 def get_dhcp_opts(context, network_ref):
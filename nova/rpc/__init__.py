@@ -55,3 +55,8 @@ def fanout_cast(context, topic, msg):
 
 def multicall(context, topic, msg):
     return get_impl().multicall(context, topic, msg)
+
+
+def scatter_gather(context, topics, msg, timeout=None, target_timeout=None):
+    return get_impl().scatter_gather(context, topics, msg, timeout=timeout,
+                                     target_timeout=target_timeout)
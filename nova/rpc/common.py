@@ -1,13 +1,31 @@
+import collections
+import time
+import weakref
+
+import eventlet
+from eventlet import queue
+
 from nova import exception
 from nova import flags
 from nova import log as logging
 
 LOG = logging.getLogger('nova.rpc')
 
+FLAGS = flags.FLAGS
 flags.DEFINE_integer('rpc_thread_pool_size', 1024,
                              'Size of RPC thread pool')
 flags.DEFINE_integer('rpc_conn_pool_size', 30,
                              'Size of RPC connection pool')
+flags.DEFINE_integer('rpc_priority_pool_size', 64,
+                             'Size of the RPC thread pool reserved for '
+                             'priority methods')
+flags.DEFINE_integer('rpc_backlog_size', 256,
+                             'Messages that may wait for an RPC thread in '
+                             'each lane before further ones are handed back '
+                             'to the queue')
+flags.DEFINE_integer('rpc_scatter_gather_timeout', 60,
+                             'Seconds to wait for all replies to a '
+                             'scatter_gather before giving up')
 
 
 class RemoteError(exception.NovaException):
@@ -26,3 +44,242 @@ class RemoteError(exception.NovaException):
         self.value = value
         self.traceback = traceback
         super(RemoteError, self).__init__(**self.__dict__)
+
+
+class Timeout(exception.NovaException):
+    """Signifies that a target did not reply before its deadline."""
+    message = _("Timeout while waiting on RPC response from %(target)s.")
+
+    def __init__(self, target=None):
+        self.target = target
+        super(Timeout, self).__init__(target=target)
+
+
+class ScatterGatherWaiter(object):
+    """Collects the replies to one message sent to many topics.
+
+    Every target replies on the same msg_id queue and tags its replies
+    with its own topic as 'reply_key'.  Iterating over the waiter yields
+    a (topic, result) tuple for each target as soon as that target is
+    finished.  The result is the last value the target replied with, a
+    RemoteError if it raised, or a Timeout if it missed its deadline.
+    Targets that timed out are also listed in the timed_out attribute.
+
+    'timeout' bounds the whole gather and 'target_timeout' bounds each
+    target.  The latter may be a number or a dict of topic to seconds.
+
+    Iterating to the end closes the waiter.  Callers that stop early, or
+    never iterate at all, must call close() to release its connection.
+    Implementations feed raw reply dicts in by calling the waiter and
+    override close() to release their connection.
+
+    """
+
+    def __init__(self, topics, timeout=None, target_timeout=None):
+        if timeout is None:
+            timeout = FLAGS.rpc_scatter_gather_timeout
+        start = time.time()
+        self._deadlines = {}
+        for topic in topics:
+            if isinstance(target_timeout, dict):
+                limit = target_timeout.get(topic, timeout)
+            elif target_timeout is not None:
+                limit = target_timeout
+            else:
+                limit = timeout
+            self._deadlines[topic] = start + min(limit, timeout)
+        self._results = {}
+        self._replies = queue.Queue()
+        self.timed_out = []
+        self._done = False
+
+    def close(self):
+        """Stop waiting for replies.  Safe to call more than once."""
+        self._done = True
+
+    def __call__(self, data):
+        """The consumer callback will call this.  Queue the reply."""
+        self._replies.put(data)
+
+    def _expire(self):
+        now = time.time()
+        for topic, deadline in self._deadlines.items():
+            if deadline <= now:
+                del self._deadlines[topic]
+                self._results.pop(topic, None)
+                self.timed_out.append(topic)
+                LOG.warn(_('Timed out waiting for reply from %s'), topic)
+                yield topic, Timeout(target=topic)
+
+    def __iter__(self):
+        if self._done:
+            return
+        try:
+            while self._deadlines:
+                for expired in self._expire():
+                    yield expired
+                if not self._deadlines:
+                    break
+                wait = min(self._deadlines.values()) - time.time()
+                try:
+                    data = self._replies.get(timeout=max(wait, 0))
+                except queue.Empty:
+                    continue
+                topic = data.get('reply_key')
+                if topic not in self._deadlines:
+                    # Late or stray reply for a target that is done already
+                    continue
+                if data['failure']:
+                    del self._deadlines[topic]
+                    self._results.pop(topic, None)
+                    yield topic, RemoteError(*data['failure'])
+                elif data['result'] is None:
+                    del self._deadlines[topic]
+                    yield topic, self._results.pop(topic, None)
+                else:
+                    self._results[topic] = data['result']
+        finally:
+            self.close()
+
+
+class DispatchPool(object):
+    """Runs rpc handlers in priority lanes with per-method limits.
+
+    Methods named in the proxy's rpc_priority_methods get a thread pool
+    of their own, so they never wait behind long running handlers that
+    fill the main pool.  rpc_method_concurrency maps a method name to
+    the most handlers of it that may run at once (0 for no limit).
+
+    Messages that can't run yet wait in their lane's backlog without
+    holding a thread.  Once rpc_backlog_size messages are waiting in a
+    lane, dispatch() turns further messages for that lane away and the
+    consumer hands them back to the queue to be delivered again later.
+    dispatch() never blocks, so the consumer keeps reading priority
+    messages however full the normal backlog is.
+
+    All the consumers of a proxy should share one pool, from
+    get_dispatch_pool(), so that the limits hold across them.
+
+    """
+
+    PRIORITY = 'priority'
+    NORMAL = 'normal'
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self._priority_methods = None
+        self._limits = None
+        self.sizes = {self.PRIORITY: FLAGS.rpc_priority_pool_size,
+                      self.NORMAL: FLAGS.rpc_thread_pool_size}
+        self.active = {self.PRIORITY: 0, self.NORMAL: 0}
+        self.backlog = {self.PRIORITY: collections.deque(),
+                        self.NORMAL: collections.deque()}
+        self.backlog_size = FLAGS.rpc_backlog_size
+        self.running = {}
+        self.stats = {}
+
+    @property
+    def priority_methods(self):
+        # Looked up on first use, as the proxy may not be ready to answer
+        # when the consumer is created.
+        if self._priority_methods is None:
+            self._priority_methods = set(getattr(self.proxy,
+                                                 'rpc_priority_methods', ()))
+        return self._priority_methods
+
+    @property
+    def limits(self):
+        if self._limits is None:
+            self._limits = dict(getattr(self.proxy,
+                                        'rpc_method_concurrency', {}))
+        return self._limits
+
+    def _method_stats(self, method):
+        if method not in self.stats:
+            self.stats[method] = {'queued': 0,
+                                  'calls': 0,
+                                  'wait_total': 0.0,
+                                  'wait_max': 0.0}
+        return self.stats[method]
+
+    def dispatch(self, method, func, *args):
+        """Run func(*args) in a greenthread once method may run.
+
+        Returns False without taking the message if the lane's backlog is
+        full, in which case the consumer should requeue it.
+
+        """
+        if method in self.priority_methods:
+            lane = self.PRIORITY
+        else:
+            lane = self.NORMAL
+        if len(self.backlog[lane]) >= self.backlog_size:
+            LOG.debug(_('RPC %(lane)s backlog full, requeueing %(method)s'),
+                      locals())
+            return False
+        self.backlog[lane].append((time.time(), method, func, args))
+        self._method_stats(method)['queued'] += 1
+        self._dispatch(lane)
+        return True
+
+    def _dispatch(self, lane):
+        """Start whatever the lane and method limits allow, oldest first."""
+        backlog = self.backlog[lane]
+        for item in list(backlog):
+            if self.active[lane] >= self.sizes[lane]:
+                break
+            queued_at, method, func, args = item
+            limit = self.limits.get(method)
+            if limit and self.running.get(method, 0) >= limit:
+                continue
+            backlog.remove(item)
+            wait = time.time() - queued_at
+            stats = self._method_stats(method)
+            stats['queued'] -= 1
+            stats['calls'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            self.active[lane] += 1
+            self.running[method] = self.running.get(method, 0) + 1
+            eventlet.spawn_n(self._run, lane, method, func, args)
+
+    def _run(self, lane, method, func, args):
+        try:
+            func(*args)
+        finally:
+            self.active[lane] -= 1
+            self.running[method] -= 1
+            self._dispatch(lane)
+
+    def get_stats(self):
+        """Returns queue depth, running count and wait times per method."""
+        result = {}
+        for method, stats in self.stats.iteritems():
+            result[method] = dict(stats, running=self.running.get(method, 0))
+        return result
+
+
+_dispatch_pools = weakref.WeakKeyDictionary()
+
+
+def get_dispatch_pool(proxy):
+    """Return the DispatchPool shared by all the consumers of proxy."""
+    pool = _dispatch_pools.get(proxy)
+    if pool is None:
+        pool = _dispatch_pools[proxy] = DispatchPool(proxy)
+    return pool
+
+
+def get_dispatch_stats():
+    """Returns the dispatch stats of every pool in this process by method."""
+    result = {}
+    for pool in _dispatch_pools.values():
+        for method, stats in pool.get_stats().iteritems():
+            if method not in result:
+                result[method] = stats
+                continue
+            total = result[method]
+            for key in ('queued', 'calls', 'wait_total', 'running'):
+                total[key] += stats[key]
+            total['wait_max'] = max(total['wait_max'], stats['wait_max'])
+    return result
@@ -34,7 +34,6 @@ import uuid
 from carrot import connection as carrot_connection
 from carrot import messaging
 import eventlet
-from eventlet import greenpool
 from eventlet import pools
 from eventlet import queue
 import greenlet
@@ -43,6 +42,8 @@ from nova import context
 from nova import exception
 from nova import fakerabbit
 from nova import flags
+from nova.rpc import common as rpc_common
+from nova.rpc import metrics
 from nova.rpc.common import RemoteError, LOG
 
 # Needed for tests
@@ -234,7 +235,8 @@ class AdapterConsumer(Consumer):
     def __init__(self, connection=None, topic='broadcast', proxy=None):
         LOG.debug(_('Initing the Adapter Consumer for %s') % topic)
         self.proxy = proxy
-        self.pool = greenpool.GreenPool(FLAGS.rpc_thread_pool_size)
+        self.rpc_topic = topic
+        self.pool = rpc_common.get_dispatch_pool(proxy)
         super(AdapterConsumer, self).__init__(connection=connection,
                                               topic=topic)
         self.register_callback(self.process_data)
@@ -252,15 +254,16 @@ class AdapterConsumer(Consumer):
         Example: {'method': 'echo', 'args': {'value': 42}}
 
         """
-        LOG.debug(_('received %s') % message_data)
+        LOG.debug(_('received %s'), message_data)
+        sent_at = message_data.pop('_sent_at', None)
         # This will be popped off in _unpack_context
         msg_id = message_data.get('_msg_id', None)
         ctxt = _unpack_context(message_data)
 
         method = message_data.get('method')
         args = message_data.get('args', {})
-        message.ack()
         if not method:
+            message.ack()
             # NOTE(vish): we may not want to ack here, but that means that bad
             #             messages stay in the queue indefinitely, so for now
             #             we just log the message and send an error string
@@ -270,7 +273,14 @@ class AdapterConsumer(Consumer):
                 msg_reply(msg_id,
                           _('No method for message: %s') % message_data)
             return
-        self.pool.spawn_n(self._process_data, msg_id, ctxt, method, args)
+        if not self.pool.dispatch(method, self._process_data, msg_id, ctxt,
+                                  method, args):
+            message.requeue()
+            return
+        message.ack()
+        if sent_at:
+            metrics.record('queue', self.rpc_topic, method,
+                           time.time() - sent_at)
 
     @exception.wrap_exception()
     def _process_data(self, msg_id, ctxt, method, args):
@@ -280,6 +290,7 @@ class AdapterConsumer(Consumer):
 
         node_func = getattr(self.proxy, str(method))
         node_args = dict((str(k), v) for k, v in args.iteritems())
+        start = time.time()
         # NOTE(vish): magic is fun!
         try:
             rval = node_func(context=ctxt, **node_args)
@@ -287,19 +298,22 @@ class AdapterConsumer(Consumer):
                 # Check if the result was a generator
                 if isinstance(rval, types.GeneratorType):
                     for x in rval:
-                        msg_reply(msg_id, x, None)
+                        msg_reply(msg_id, x, None, ctxt.reply_key)
                 else:
-                    msg_reply(msg_id, rval, None)
+                    msg_reply(msg_id, rval, None, ctxt.reply_key)
 
                 # This final None tells multicall that it is done.
-                msg_reply(msg_id, None, None)
+                msg_reply(msg_id, None, None, ctxt.reply_key)
             elif isinstance(rval, types.GeneratorType):
                 # NOTE(vish): this iterates through the generator
                 list(rval)
         except Exception as e:
             LOG.exception('Exception during message handling')
             if msg_id:
-                msg_reply(msg_id, None, sys.exc_info())
+                msg_reply(msg_id, None, sys.exc_info(), ctxt.reply_key)
+        finally:
+            metrics.record('handler', self.rpc_topic, method,
+                           time.time() - start)
         return
 
 
@@ -447,10 +461,11 @@ class DirectPublisher(Publisher):
         super(DirectPublisher, self).__init__(connection=connection)
 
 
-def msg_reply(msg_id, reply=None, failure=None):
+def msg_reply(msg_id, reply=None, failure=None, reply_key=None):
     """Sends a reply or an error on the channel signified by msg_id.
 
-    Failure should be a sys.exc_info() tuple.
+    Failure should be a sys.exc_info() tuple.  reply_key tags the reply
+    with its target when msg_id is shared by a scatter_gather.
 
     """
     if failure:
@@ -460,15 +475,19 @@ def msg_reply(msg_id, reply=None, failure=None):
         LOG.error(tb)
         failure = (failure[0].__name__, str(failure[1]), tb)
 
+    extra = {}
+    if reply_key:
+        extra['reply_key'] = reply_key
     with ConnectionPool.item() as conn:
         publisher = DirectPublisher(connection=conn, msg_id=msg_id)
         try:
-            publisher.send({'result': reply, 'failure': failure})
+            publisher.send(dict(extra, result=reply, failure=failure))
         except TypeError:
             publisher.send(
-                    {'result': dict((k, repr(v))
-                                    for k, v in reply.__dict__.iteritems()),
-                     'failure': failure})
+                    dict(extra,
+                         result=dict((k, repr(v))
+                                     for k, v in reply.__dict__.iteritems()),
+                         failure=failure))
 
         publisher.close()
 
@@ -484,6 +503,7 @@ def _unpack_context(msg):
             value = msg.pop(key)
             context_dict[key[9:]] = value
     context_dict['msg_id'] = msg.pop('_msg_id', None)
+    context_dict['reply_key'] = msg.pop('_reply_key', None)
     LOG.debug(_('unpacked context: %s'), context_dict)
     return RpcContext.from_dict(context_dict)
 
@@ -496,19 +516,24 @@ def _pack_context(msg, context):
     more arguments in rabbit messages, we may want to do the same
     for args at some point.
 
+    The send time goes along too, so consumers can measure queue latency.
+
     """
     context_d = dict([('_context_%s' % key, value)
                       for (key, value) in context.to_dict().iteritems()])
     msg.update(context_d)
+    msg['_sent_at'] = time.time()
 
 
 class RpcContext(context.RequestContext):
     def __init__(self, *args, **kwargs):
         msg_id = kwargs.pop('msg_id', None)
         self.msg_id = msg_id
+        self.reply_key = kwargs.pop('reply_key', None)
         super(RpcContext, self).__init__(*args, **kwargs)
 
     def reply(self, *args, **kwargs):
+        kwargs.setdefault('reply_key', self.reply_key)
         msg_reply(self.msg_id, *args, **kwargs)
 
 
@@ -575,6 +600,37 @@ class MulticallWaiter(object):
             yield result
 
 
+class ScatterGatherWaiter(rpc_common.ScatterGatherWaiter):
+    def __init__(self, consumer, topics, timeout=None, target_timeout=None):
+        super(ScatterGatherWaiter, self).__init__(topics, timeout,
+                                                  target_timeout)
+        self._consumer = consumer
+        self._consumer.register_callback(self)
+        self._fetcher = eventlet.spawn(self._fetch)
+
+    def _fetch(self):
+        """Polls the shared reply queue, feeding replies to __call__."""
+        try:
+            while True:
+                self._consumer.fetch(enable_callbacks=True)
+                time.sleep(0.01)
+        except greenlet.GreenletExit:
+            return
+
+    def close(self):
+        super(ScatterGatherWaiter, self).close()
+        if self._consumer:
+            self._fetcher.kill()
+            self._consumer.close()
+            ConnectionPool.put(self._consumer.connection)
+            self._consumer = None
+
+    def __call__(self, data, message):
+        """Acks message and queues the reply."""
+        message.ack()
+        super(ScatterGatherWaiter, self).__call__(data)
+
+
 def create_connection(new=True):
     """Create a connection"""
     return Connection.instance(new=new)
@@ -590,6 +646,33 @@ def call(context, topic, msg):
     return rv[-1]
 
 
+def scatter_gather(context, topics, msg, timeout=None, target_timeout=None):
+    """Sends a message to many topics and gathers the replies.
+
+    All targets reply on a single shared queue.  Returns a
+    ScatterGatherWaiter that yields (topic, result) as targets finish.
+
+    """
+    LOG.debug(_('Making scatter-gather call on %d topics ...'), len(topics))
+    msg_id = uuid.uuid4().hex
+    msg.update({'_msg_id': msg_id})
+    LOG.debug(_('MSG_ID is %s') % (msg_id))
+    _pack_context(msg, context)
+
+    con_conn = ConnectionPool.get()
+    consumer = DirectConsumer(connection=con_conn, msg_id=msg_id)
+    wait_msg = ScatterGatherWaiter(consumer, topics, timeout, target_timeout)
+    try:
+        for topic in topics:
+            publisher = TopicPublisher(connection=con_conn, topic=topic)
+            publisher.send(dict(msg, _reply_key=topic))
+            publisher.close()
+    except Exception:
+        wait_msg.close()
+        raise
+    return wait_msg
+
+
 def cast(context, topic, msg):
     """Sends a message on a topic without waiting for a response."""
     LOG.debug(_('Making asynchronous cast on %s...'), topic)
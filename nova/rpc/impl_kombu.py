@@ -26,13 +26,14 @@ import types
 import uuid
 
 import eventlet
-from eventlet import greenpool
 from eventlet import pools
 import greenlet
 
 from nova import context
 from nova import exception
 from nova import flags
+from nova.rpc import common as rpc_common
+from nova.rpc import metrics
 from nova.rpc.common import RemoteError, LOG
 
 # Needed for tests
@@ -80,7 +81,7 @@ class ConsumerBase(object):
         a message is read.
 
         Messages will automatically be acked if the callback doesn't
-        raise an exception
+        raise an exception, or requeued if the callback returns False
         """
 
         options = {'consumer_tag': self.tag}
@@ -91,8 +92,10 @@ class ConsumerBase(object):
 
         def _callback(raw_message):
             message = self.channel.message_to_python(raw_message)
-            callback(message.payload)
-            message.ack()
+            if callback(message.payload) is False:
+                message.requeue()
+            else:
+                message.ack()
 
         self.queue.consume(*args, callback=_callback, **options)
 
@@ -348,15 +351,19 @@ class Connection(object):
             sys.exit(1)
         LOG.info(_('Connected to AMQP server on %(hostname)s:%(port)d' %
                 self.params))
-        self.channel = self.connection.channel()
-        # work around 'memory' transport bug in 1.1.3
-        if self.memory_transport:
-            self.channel._new_queue('ae.undeliver')
+        self._open_channel()
         for consumer in self.consumers:
             consumer.reconnect(self.channel)
         if self.consumers:
             LOG.debug(_("Re-established AMQP queues"))
 
+    def _open_channel(self):
+        """Open a new channel on the connection"""
+        self.channel = self.connection.channel()
+        # work around 'memory' transport bug in 1.1.3
+        if self.memory_transport:
+            self.channel._new_queue('ae.undeliver')
+
     def get_channel(self):
         """Convenience call for bin/clear_rabbit_queues"""
         return self.channel
@@ -380,10 +387,7 @@ class Connection(object):
         """Reset a connection so it can be used again"""
         self.cancel_consumer_thread()
         self.channel.close()
-        self.channel = self.connection.channel()
-        # work around 'memory' transport bug in 1.1.3
-        if self.memory_transport:
-            self.channel._new_queue('ae.undeliver')
+        self._open_channel()
         self.consumers = []
 
     def declare_consumer(self, consumer_cls, topic, callback):
@@ -491,9 +495,9 @@ class Connection(object):
     def create_consumer(self, topic, proxy, fanout=False):
         """Create a consumer that calls a method in a proxy object"""
         if fanout:
-            self.declare_fanout_consumer(topic, ProxyCallback(proxy))
+            self.declare_fanout_consumer(topic, ProxyCallback(proxy, topic))
         else:
-            self.declare_topic_consumer(topic, ProxyCallback(proxy))
+            self.declare_topic_consumer(topic, ProxyCallback(proxy, topic))
 
 
 class Pool(pools.Pool):
@@ -580,9 +584,10 @@ class ConnectionContext(object):
 class ProxyCallback(object):
     """Calls methods on a proxy object based on method and args."""
 
-    def __init__(self, proxy):
+    def __init__(self, proxy, topic=None):
         self.proxy = proxy
-        self.pool = greenpool.GreenPool(FLAGS.rpc_thread_pool_size)
+        self.topic = topic
+        self.pool = rpc_common.get_dispatch_pool(proxy)
 
     def __call__(self, message_data):
         """Consumer callback to call a method on a proxy object.
@@ -596,8 +601,12 @@ class ProxyCallback(object):
 
         Example: {'method': 'echo', 'args': {'value': 42}}
 
+        Returns False if the dispatch pool's backlog is full, so the
+        message is requeued.
+
         """
-        LOG.debug(_('received %s') % message_data)
+        LOG.debug(_('received %s'), message_data)
+        sent_at = message_data.pop('_sent_at', None)
         ctxt = _unpack_context(message_data)
         method = message_data.get('method')
         args = message_data.get('args', {})
@@ -605,7 +614,11 @@ class ProxyCallback(object):
             LOG.warn(_('no method for message: %s') % message_data)
             ctxt.reply(_('No method for message: %s') % message_data)
             return
-        self.pool.spawn_n(self._process_data, ctxt, method, args)
+        if not self.pool.dispatch(method, self._process_data, ctxt, method,
+                                  args):
+            return False
+        if sent_at:
+            metrics.record('queue', self.topic, method, time.time() - sent_at)
 
     @exception.wrap_exception()
     def _process_data(self, ctxt, method, args):
@@ -615,6 +628,7 @@ class ProxyCallback(object):
 
         node_func = getattr(self.proxy, str(method))
         node_args = dict((str(k), v) for k, v in args.iteritems())
+        start = time.time()
         # NOTE(vish): magic is fun!
         try:
             rval = node_func(context=ctxt, **node_args)
@@ -629,6 +643,8 @@ class ProxyCallback(object):
         except Exception as e:
             LOG.exception('Exception during message handling')
             ctxt.reply(None, sys.exc_info())
+        finally:
+            metrics.record('handler', self.topic, method, time.time() - start)
         return
 
 
@@ -643,6 +659,7 @@ def _unpack_context(msg):
             value = msg.pop(key)
             context_dict[key[9:]] = value
     context_dict['msg_id'] = msg.pop('_msg_id', None)
+    context_dict['reply_key'] = msg.pop('_reply_key', None)
     LOG.debug(_('unpacked context: %s'), context_dict)
     return RpcContext.from_dict(context_dict)
 
@@ -655,10 +672,13 @@ def _pack_context(msg, context):
     more arguments in rabbit messages, we may want to do the same
     for args at some point.
 
+    The send time goes along too, so consumers can measure queue latency.
+
     """
     context_d = dict([('_context_%s' % key, value)
                       for (key, value) in context.to_dict().iteritems()])
     msg.update(context_d)
+    msg['_sent_at'] = time.time()
 
 
 class RpcContext(context.RequestContext):
@@ -666,26 +686,36 @@ class RpcContext(context.RequestContext):
     def __init__(self, *args, **kwargs):
         msg_id = kwargs.pop('msg_id', None)
         self.msg_id = msg_id
+        self.reply_key = kwargs.pop('reply_key', None)
         super(RpcContext, self).__init__(*args, **kwargs)
 
     def reply(self, *args, **kwargs):
         if self.msg_id:
+            kwargs.setdefault('reply_key', self.reply_key)
             msg_reply(self.msg_id, *args, **kwargs)
 
 
 class MulticallWaiter(object):
-    def __init__(self, connection):
+    def __init__(self, connection, topic=None, method=None):
         self._connection = connection
         self._iterator = connection.iterconsume()
         self._result = None
         self._done = False
+        self._topic = topic
+        self._method = method
+        self._started = time.time()
 
     def done(self):
         self._done = True
         self._connection.close()
+        metrics.record('call', self._topic, self._method,
+                       time.time() - self._started)
 
     def __call__(self, data):
         """The consume() callback will call this.  Store the result."""
+        if data.get('sent_at'):
+            metrics.record('reply', self._topic, self._method,
+                           time.time() - data['sent_at'])
         if data['failure']:
             self._result = RemoteError(*data['failure'])
         else:
@@ -707,6 +737,20 @@ class MulticallWaiter(object):
             yield result
 
 
+class ScatterGatherWaiter(rpc_common.ScatterGatherWaiter):
+    def __init__(self, connection, topics, timeout=None,
+                 target_timeout=None):
+        super(ScatterGatherWaiter, self).__init__(topics, timeout,
+                                                  target_timeout)
+        self._connection = connection
+
+    def close(self):
+        super(ScatterGatherWaiter, self).close()
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+
 def create_connection(new=True):
     """Create a connection"""
     return ConnectionContext(pooled=not new)
@@ -725,7 +769,7 @@ def multicall(context, topic, msg):
     _pack_context(msg, context)
 
     conn = ConnectionContext()
-    wait_msg = MulticallWaiter(conn)
+    wait_msg = MulticallWaiter(conn, topic, msg.get('method'))
     conn.declare_direct_consumer(msg_id, wait_msg)
     conn.topic_send(topic, msg)
     return wait_msg
@@ -741,6 +785,32 @@ def call(context, topic, msg):
     return rv[-1]
 
 
+def scatter_gather(context, topics, msg, timeout=None, target_timeout=None):
+    """Sends a message to many topics and gathers the replies.
+
+    All targets reply on a single shared queue.  Returns a
+    ScatterGatherWaiter that yields (topic, result) as targets finish.
+
+    """
+    LOG.debug(_('Making scatter-gather call on %d topics ...'), len(topics))
+    msg_id = uuid.uuid4().hex
+    msg.update({'_msg_id': msg_id})
+    LOG.debug(_('MSG_ID is %s') % (msg_id))
+    _pack_context(msg, context)
+
+    conn = ConnectionContext()
+    wait_msg = ScatterGatherWaiter(conn, topics, timeout, target_timeout)
+    try:
+        conn.declare_direct_consumer(msg_id, wait_msg)
+        for topic in topics:
+            conn.topic_send(topic, dict(msg, _reply_key=topic))
+        conn.consume_in_thread()
+    except Exception:
+        wait_msg.close()
+        raise
+    return wait_msg
+
+
 def cast(context, topic, msg):
     """Sends a message on a topic without waiting for a response."""
     LOG.debug(_('Making asynchronous cast on %s...'), topic)
@@ -757,10 +827,11 @@ def fanout_cast(context, topic, msg):
         conn.fanout_send(topic, msg)
 
 
-def msg_reply(msg_id, reply=None, failure=None):
+def msg_reply(msg_id, reply=None, failure=None, reply_key=None):
     """Sends a reply or an error on the channel signified by msg_id.
 
-    Failure should be a sys.exc_info() tuple.
+    Failure should be a sys.exc_info() tuple.  reply_key tags the reply
+    with its target when msg_id is shared by a scatter_gather.
 
     """
     with ConnectionContext() as conn:
@@ -777,4 +848,7 @@ def msg_reply(msg_id, reply=None, failure=None):
             msg = {'result': dict((k, repr(v))
                             for k, v in reply.__dict__.iteritems()),
                     'failure': failure}
+        if reply_key:
+            msg['reply_key'] = reply_key
+        msg['sent_at'] = time.time()
         conn.direct_send(msg_id, msg)
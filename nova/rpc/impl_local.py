@@ -0,0 +1,325 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""In-process RPC.
+
+Delivers messages straight to the consumers registered in this process
+through greenthread queues, without a broker.  Meant for running every
+service in one process (bin/nova-all), functional tests and benchmarks:
+
+    --rpc_backend=nova.rpc.impl_local
+
+Consumers of a topic share one queue and each drains it into its
+ProxyCallback from its own greenthread, so they compete for messages the
+way they would on a broker.  Fanout consumers get a queue apiece.
+Replies bypass queues entirely and are handed to the waiting caller.
+Messages and replies are round-tripped through JSON unless
+--norpc_local_serialize is given.
+
+"""
+
+import sys
+import time
+import traceback
+import types
+
+import eventlet
+from eventlet import queue
+import greenlet
+
+from nova import context
+from nova import exception
+from nova import flags
+from nova import utils
+from nova.rpc import common as rpc_common
+from nova.rpc import metrics
+from nova.rpc.common import RemoteError, LOG
+
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('rpc_local_serialize', True,
+                     'Round-trip in-process RPC messages through JSON, '
+                     'as a broker would')
+
+# topic -> queue shared by every consumer of the topic.  Like a durable
+# broker queue it outlives its consumers, so messages cast before a
+# service has started are delivered once it does.
+TOPICS = {}
+# topic -> list of queues, one per fanout consumer
+FANOUTS = {}
+
+
+def _serialize(value):
+    if FLAGS.rpc_local_serialize:
+        return utils.loads(utils.dumps(value))
+    return value
+
+
+def _topic_queue(topic):
+    return TOPICS.setdefault(topic, queue.LightQueue())
+
+
+class Consumer(object):
+    """Drains a queue of messages into a ProxyCallback."""
+
+    def __init__(self, topic, proxy, msg_queue):
+        self.topic = topic
+        self.callback = ProxyCallback(proxy, topic)
+        self.queue = msg_queue
+        self.thread = None
+
+    def consume(self):
+        while True:
+            msg, reply_fn = self.queue.get()
+            # The callback unpacks a copy, so a message it turns away can
+            # go round again behind whatever is already queued.
+            if self.callback(dict(msg), reply_fn) is False:
+                self.queue.put((msg, reply_fn))
+                eventlet.sleep(0.01)
+
+    def start(self):
+        def _consumer_thread():
+            try:
+                self.consume()
+            except greenlet.GreenletExit:
+                return
+        if self.thread is None:
+            self.thread = eventlet.spawn(_consumer_thread)
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.kill()
+            try:
+                self.thread.wait()
+            except greenlet.GreenletExit:
+                pass
+            self.thread = None
+
+
+class Connection(object):
+    """Registers consumers with the in-process topic tables."""
+
+    def __init__(self):
+        self.consumers = []
+        self.fanout_queues = []
+
+    def create_consumer(self, topic, proxy, fanout=False):
+        """Create a consumer that calls methods in the proxy"""
+        if fanout:
+            msg_queue = queue.LightQueue()
+            FANOUTS.setdefault(topic, []).append(msg_queue)
+            self.fanout_queues.append((topic, msg_queue))
+        else:
+            msg_queue = _topic_queue(topic)
+        self.consumers.append(Consumer(topic, proxy, msg_queue))
+
+    def consume_in_thread(self):
+        """Drain every consumer's queue in its own greenthread"""
+        for consumer in self.consumers:
+            consumer.start()
+
+    def close(self):
+        for consumer in self.consumers:
+            consumer.stop()
+        for topic, msg_queue in self.fanout_queues:
+            queues = FANOUTS.get(topic, [])
+            if msg_queue in queues:
+                queues.remove(msg_queue)
+        self.consumers = []
+        self.fanout_queues = []
+
+
+class ProxyCallback(object):
+    """Calls methods on a proxy object based on method and args."""
+
+    def __init__(self, proxy, topic=None):
+        self.proxy = proxy
+        self.topic = topic
+        self.pool = rpc_common.get_dispatch_pool(proxy)
+
+    def __call__(self, message_data, reply_fn=None):
+        """Unpack the message and fire off a thread to call the proxy.
+
+        Returns False if the dispatch pool's backlog is full.
+        """
+        LOG.debug(_('received %s'), message_data)
+        sent_at = message_data.pop('_sent_at', None)
+        ctxt = _unpack_context(message_data, reply_fn)
+        method = message_data.get('method')
+        args = message_data.get('args', {})
+        if not method:
+            LOG.warn(_('no method for message: %s') % message_data)
+            ctxt.reply(_('No method for message: %s') % message_data)
+            return
+        if not self.pool.dispatch(method, self._process_data, ctxt, method,
+                                  args):
+            return False
+        if sent_at:
+            metrics.record('queue', self.topic, method, time.time() - sent_at)
+
+    @exception.wrap_exception()
+    def _process_data(self, ctxt, method, args):
+        """Thread that looks for a method on the proxy object and calls it."""
+        node_func = getattr(self.proxy, str(method))
+        node_args = dict((str(k), v) for k, v in args.iteritems())
+        start = time.time()
+        try:
+            rval = node_func(context=ctxt, **node_args)
+            if isinstance(rval, types.GeneratorType):
+                for x in rval:
+                    ctxt.reply(x, None)
+            else:
+                ctxt.reply(rval, None)
+            # This final None tells multicall that it is done.
+            ctxt.reply(None, None)
+        except Exception:
+            LOG.exception('Exception during message handling')
+            ctxt.reply(None, sys.exc_info())
+        finally:
+            metrics.record('handler', self.topic, method, time.time() - start)
+
+
+def _unpack_context(msg, reply_fn):
+    """Unpack context from msg."""
+    context_dict = {}
+    for key in list(msg.keys()):
+        key = str(key)
+        if key.startswith('_context_'):
+            value = msg.pop(key)
+            context_dict[key[9:]] = value
+    context_dict['reply_fn'] = reply_fn
+    context_dict['reply_key'] = msg.pop('_reply_key', None)
+    return RpcContext.from_dict(context_dict)
+
+
+def _pack_context(msg, context):
+    """Pack context and the send time into msg."""
+    context_d = dict([('_context_%s' % key, value)
+                      for (key, value) in context.to_dict().iteritems()])
+    msg.update(context_d)
+    msg['_sent_at'] = time.time()
+
+
+class RpcContext(context.RequestContext):
+    """Context that supports replying to a rpc.call"""
+    def __init__(self, *args, **kwargs):
+        self.reply_fn = kwargs.pop('reply_fn', None)
+        self.reply_key = kwargs.pop('reply_key', None)
+        super(RpcContext, self).__init__(*args, **kwargs)
+
+    def reply(self, reply=None, failure=None):
+        if not self.reply_fn:
+            return
+        if failure:
+            message = str(failure[1])
+            tb = traceback.format_exception(*failure)
+            LOG.error(_("Returning exception %s to caller"), message)
+            LOG.error(tb)
+            failure = (failure[0].__name__, str(failure[1]), tb)
+        msg = {'result': _serialize(reply), 'failure': failure}
+        if self.reply_key:
+            msg['reply_key'] = self.reply_key
+        msg['sent_at'] = time.time()
+        self.reply_fn(msg)
+
+
+class MulticallWaiter(object):
+    def __init__(self, topic=None, method=None):
+        self._results = queue.LightQueue()
+        self._topic = topic
+        self._method = method
+        self._started = time.time()
+
+    def __call__(self, data):
+        """The ProxyCallback will call this.  Store the result."""
+        self._results.put(data)
+
+    def _record(self, kind, since):
+        metrics.record(kind, self._topic, self._method, time.time() - since)
+
+    def __iter__(self):
+        """Return a result until we get a 'None' response from consumer"""
+        while True:
+            data = self._results.get()
+            self._record('reply', data['sent_at'])
+            if data['failure']:
+                self._record('call', self._started)
+                raise RemoteError(*data['failure'])
+            if data['result'] is None:
+                self._record('call', self._started)
+                raise StopIteration
+            yield data['result']
+
+
+def _send(topic, msg, reply_fn=None):
+    """Queue msg for the next free consumer of topic."""
+    _topic_queue(topic).put((_serialize(msg), reply_fn))
+
+
+def create_connection(new=True):
+    """Create a connection"""
+    return Connection()
+
+
+def multicall(context, topic, msg):
+    """Make a call that returns multiple times."""
+    LOG.debug(_('Making asynchronous call on %s ...'), topic)
+    _pack_context(msg, context)
+    wait_msg = MulticallWaiter(topic, msg.get('method'))
+    _send(topic, msg, wait_msg)
+    return wait_msg
+
+
+def call(context, topic, msg):
+    """Sends a message on a topic and wait for a response."""
+    rv = multicall(context, topic, msg)
+    # NOTE(vish): return the last result from the multicall
+    rv = list(rv)
+    if not rv:
+        return
+    return rv[-1]
+
+
+def scatter_gather(context, topics, msg, timeout=None, target_timeout=None):
+    """Sends a message to many topics and gathers the replies."""
+    LOG.debug(_('Making scatter-gather call on %d topics ...'), len(topics))
+    _pack_context(msg, context)
+    wait_msg = rpc_common.ScatterGatherWaiter(topics, timeout,
+                                              target_timeout)
+    for topic in topics:
+        _send(topic, dict(msg, _reply_key=topic), wait_msg)
+    return wait_msg
+
+
+def cast(context, topic, msg):
+    """Sends a message on a topic without waiting for a response."""
+    LOG.debug(_('Making asynchronous cast on %s...'), topic)
+    _pack_context(msg, context)
+    _send(topic, msg)
+
+
+def fanout_cast(context, topic, msg):
+    """Sends a message to every fanout consumer of a topic."""
+    LOG.debug(_('Making asynchronous fanout cast...'))
+    _pack_context(msg, context)
+    for msg_queue in FANOUTS.get(topic, []):
+        msg_queue.put((_serialize(dict(msg)), None))
+
+
+def reset_all():
+    """Drop every queued message.  Used by tests."""
+    TOPICS.clear()
+    FANOUTS.clear()
@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""RPC latency histograms.
+
+Latencies are kept per (kind, topic, method) in fixed-bucket histograms:
+
+    queue    from the sender publishing a message to a consumer receiving it
+    handler  running the manager method, including iterating a generator
+    reply    from the handler publishing a reply to the caller receiving it
+    call     from the caller publishing to it receiving the final reply
+
+queue and reply latencies compare clocks on two hosts, so they are only
+as good as the hosts' time sync.
+
+Every manager answers get_rpc_metrics over rpc, and if --rpc_metrics_file
+is set the histograms are also dumped there as JSON every
+--rpc_metrics_interval seconds.
+
+"""
+
+import bisect
+import os
+
+from nova import flags
+from nova import log as logging
+from nova import utils
+
+
+LOG = logging.getLogger('nova.rpc.metrics')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('rpc_metrics', True,
+                     'Record RPC latency histograms')
+flags.DEFINE_string('rpc_metrics_file', None,
+                    'File to periodically dump RPC latency histograms to')
+flags.DEFINE_integer('rpc_metrics_interval', 60,
+                     'Seconds between dumps of RPC latency histograms')
+
+# Upper bounds of the histogram buckets in seconds.  A final bucket
+# catches everything slower than the last bound.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+KINDS = ('queue', 'handler', 'reply', 'call')
+
+
+class Histogram(object):
+    """Counts of samples falling into each of BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        value = max(value, 0.0)
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return {'buckets': list(BUCKETS),
+                'counts': list(self.counts),
+                'count': self.count,
+                'sum': self.total,
+                'max': self.max}
+
+
+_histograms = {}
+_dumper = None
+
+
+def record(kind, topic, method, seconds):
+    """Add a latency sample for method on topic."""
+    if not FLAGS.rpc_metrics or not method:
+        return
+    key = (kind, topic, method)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram()
+    histogram.record(seconds)
+
+
+def get_metrics():
+    """Return the histograms as {kind: {topic: {method: histogram}}}."""
+    result = dict((kind, {}) for kind in KINDS)
+    for (kind, topic, method), histogram in _histograms.items():
+        methods = result[kind].setdefault(topic or '', {})
+        methods[method] = histogram.to_dict()
+    return result
+
+
+def reset():
+    _histograms.clear()
+
+
+def dump(path):
+    """Write the histograms to path as JSON, replacing it atomically."""
+    tmp_path = '%s.tmp' % path
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(utils.dumps(get_metrics()))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        LOG.exception(_('Failed to dump rpc metrics to %s'), path)
+
+
+def start_dumper():
+    """Start dumping to --rpc_metrics_file, once per process."""
+    global _dumper
+    if not FLAGS.rpc_metrics_file or _dumper is not None:
+        return
+    _dumper = utils.LoopingCall(dump, FLAGS.rpc_metrics_file)
+    _dumper.start(interval=FLAGS.rpc_metrics_interval, now=False)
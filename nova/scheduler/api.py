@@ -96,12 +96,17 @@ def select(context, specs=None):
             params={"request_spec": specs})
 
 
-def update_service_capabilities(context, service_name, host, capabilities):
+def update_service_capabilities(context, service_name, host, capabilities,
+                                seq=None, delta=False, removed=None):
     """Send an update to all the scheduler services informing them
-       of the capabilities of this service."""
+       of the capabilities of this service.
+
+       With delta=True, capabilities holds only the changed keys and
+       removed lists the keys that went away since update seq - 1."""
     kwargs = dict(method='update_service_capabilities',
                   args=dict(service_name=service_name, host=host,
-                            capabilities=capabilities))
+                            capabilities=capabilities, seq=seq,
+                            delta=delta, removed=removed))
     return rpc.fanout_cast(context, 'scheduler', kwargs)
 
 
@@ -53,7 +53,8 @@ class SchedulerManager(manager.Manager):
         """Converts all method calls to use the schedule method"""
         return functools.partial(self._schedule, key)
 
-    def periodic_tasks(self, context=None):
+    @manager.periodic_task
+    def _poll_child_zones(self, context):
         """Poll child zones periodically to get status."""
         self.zone_manager.ping(context)
 
@@ -70,12 +71,21 @@ class SchedulerManager(manager.Manager):
         return self.zone_manager.get_zone_capabilities(context)
 
     def update_service_capabilities(self, context=None, service_name=None,
-                                                host=None, capabilities=None):
+                                                host=None, capabilities=None,
+                                                seq=None, delta=False,
+                                                removed=None):
         """Process a capability update from a service node."""
         if not capabilities:
             capabilities = {}
-        self.zone_manager.update_service_capabilities(service_name,
-                            host, capabilities)
+        needs_resync = self.zone_manager.update_service_capabilities(
+                            service_name, host, capabilities,
+                            seq=seq, delta=delta, removed=removed)
+        if needs_resync:
+            LOG.info(_("Missed a capability update from %(service_name)s on "
+                       "%(host)s, requesting a snapshot") % locals())
+            rpc.cast(context,
+                     db.queue_get_for(context, service_name, host),
+                     {"method": "resync_service_capabilities"})
 
     def select(self, context=None, *args, **kwargs):
         """Select a list of hosts best matching the provided specs."""
@@ -117,6 +117,8 @@ class ZoneManager(object):
         self.last_zone_db_check = datetime.datetime.min
         self.zone_states = {}  # { <zone_id> : ZoneState }
         self.service_states = {}  # { <host> : { <service> : { cap k : v }}}
+        self.service_seqs = {}  # { (<host>, <service>) : <update seq> }
+        self.resyncs_requested = set()  # { (<host>, <service>) }
         self.green_pool = greenpool.GreenPool()
 
     def get_zone_list(self):
@@ -202,14 +204,37 @@ class ZoneManager(object):
             self._refresh_from_db(context)
         self._poll_zones(context)
 
-    def update_service_capabilities(self, service_name, host, capabilities):
-        """Update the per-service capabilities based on this notification."""
+    def update_service_capabilities(self, service_name, host, capabilities,
+                                    seq=None, delta=False, removed=None):
+        """Update the per-service capabilities based on this notification.
+
+        A delta is applied on top of what we have only if it directly
+        follows the last update we saw.  Otherwise it is dropped and True
+        is returned, once per gap, to say a full snapshot is needed.
+        """
         logging.debug(_("Received %(service_name)s service update from "
                 "%(host)s.") % locals())
+        key = (host, service_name)
         service_caps = self.service_states.get(host, {})
+        if delta:
+            last_seq = self.service_seqs.get(key)
+            if (service_name not in service_caps or last_seq is None or
+                seq != last_seq + 1):
+                if key in self.resyncs_requested:
+                    return False
+                self.resyncs_requested.add(key)
+                return True
+            service_caps[service_name].update(capabilities)
+            for cap in removed or []:
+                service_caps[service_name].pop(cap, None)
+            capabilities = service_caps[service_name]
+        else:
+            self.resyncs_requested.discard(key)
         capabilities["timestamp"] = utils.utcnow()  # Reported time
         service_caps[service_name] = capabilities
         self.service_states[host] = service_caps
+        self.service_seqs[key] = seq
+        return False
 
     def host_service_caps_stale(self, host, service):
         """Check if host service capabilites are not recent enough."""
@@ -226,5 +251,6 @@ class ZoneManager(object):
             service_caps = self.service_states[host]
             for service in services:
                 del service_caps[service]
+                self.service_seqs.pop((host, service), None)
                 if len(service_caps) == 0:  # Delete host if no services
                     del self.service_states[host]
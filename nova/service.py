@@ -31,6 +31,7 @@ from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import rpc
+from nova.rpc import metrics
 from nova import utils
 from nova import version
 from nova import wsgi
@@ -166,6 +167,7 @@ class Service(object):
 
         # Consume from all consumers in a thread
         self.conn.consume_in_thread()
+        metrics.start_dumper()
 
         if self.report_interval:
             pulse = utils.LoopingCall(self.report_state)
@@ -251,8 +253,8 @@ class Service(object):
                 pass
 
     def periodic_tasks(self):
-        """Tasks to be run at a periodic interval."""
-        self.manager.periodic_tasks(context.get_admin_context())
+        """Start the manager's periodic tasks that are due."""
+        self.manager.run_periodic_tasks(context.get_admin_context())
 
     def report_state(self):
         """Update the state of this service in the datastore."""
@@ -0,0 +1,76 @@
+#   Copyright 2011 OpenStack LLC.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import json
+import webob
+
+from nova import compute
+from nova import exception
+from nova import test
+from nova.tests.api.openstack import fakes
+
+
+def fake_get(self, context, instance_id):
+    if instance_id == 'missing':
+        raise exception.InstanceNotFound(instance_id=instance_id)
+    return {'id': 1}
+
+
+def fake_get_console_output(self, context, instance_id, length=None):
+    lines = ['line %d\n' % i for i in xrange(5)]
+    if length is not None:
+        lines = lines[len(lines) - length:]
+    return ''.join(lines)
+
+
+class ConsoleOutputTest(test.TestCase):
+    def setUp(self):
+        super(ConsoleOutputTest, self).setUp()
+        self.stubs.Set(compute.api.API, "get", fake_get)
+        self.stubs.Set(compute.api.API, "get_console_output",
+                       fake_get_console_output)
+
+    def _get_console_output(self, body, instance_id='test_inst'):
+        req = webob.Request.blank('/v1.1/123/servers/%s/action' %
+                                  instance_id)
+        req.method = "POST"
+        req.body = json.dumps(body)
+        req.headers["content-type"] = "application/json"
+        return req.get_response(fakes.wsgi_app())
+
+    def test_get_console_output(self):
+        resp = self._get_console_output({'os-getConsoleOutput': {}})
+        self.assertEqual(resp.status_int, 200)
+        output = json.loads(resp.body)['output']
+        self.assertEqual(len(output.splitlines()), 5)
+
+    def test_get_console_output_tail(self):
+        resp = self._get_console_output(
+                {'os-getConsoleOutput': {'length': 2}})
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(json.loads(resp.body)['output'],
+                         'line 3\nline 4\n')
+
+    def test_get_console_output_invalid_length(self):
+        resp = self._get_console_output(
+                {'os-getConsoleOutput': {'length': 'many'}})
+        self.assertEqual(resp.status_int, 400)
+        resp = self._get_console_output(
+                {'os-getConsoleOutput': {'length': -1}})
+        self.assertEqual(resp.status_int, 400)
+
+    def test_get_console_output_missing_instance(self):
+        resp = self._get_console_output({'os-getConsoleOutput': {}},
+                                        instance_id='missing')
+        self.assertEqual(resp.status_int, 404)
@@ -0,0 +1,78 @@
+#   Copyright 2011 OpenStack LLC.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import json
+import webob
+
+from nova import compute
+from nova import flags
+from nova import test
+from nova.tests.api.openstack import fakes
+
+FLAGS = flags.FLAGS
+
+
+def prefetch_images(self, context, image_ids, hosts=None,
+                    availability_zone=None, instance_type_id=None):
+    return hosts or ['host1', 'host2']
+
+
+def get_prefetch_status(self, context, host):
+    return {'1': {'state': 'done'}}
+
+
+class ImagePrefetchTest(test.TestCase):
+    def setUp(self):
+        super(ImagePrefetchTest, self).setUp()
+        self.flags(allow_admin_api=True)
+        self.stubs.Set(compute.api.API, "prefetch_images", prefetch_images)
+        self.stubs.Set(compute.api.API, "get_prefetch_status",
+                       get_prefetch_status)
+
+    def _request(self, path, body=None):
+        req = webob.Request.blank('/v1.1/123/os-image-prefetch%s' % path)
+        if body is not None:
+            req.method = "POST"
+            req.body = json.dumps(body)
+            req.headers["content-type"] = "application/json"
+        return req.get_response(fakes.wsgi_app())
+
+    def test_prefetch(self):
+        body = {"prefetch": {"images": ["1", "2"], "hosts": ["host1"]}}
+        resp = self._request('', body)
+        self.assertEqual(resp.status_int, 200)
+        prefetch = json.loads(resp.body)['prefetch']
+        self.assertEqual(prefetch['images'], ["1", "2"])
+        self.assertEqual(prefetch['hosts'], ["host1"])
+
+    def test_prefetch_without_images(self):
+        resp = self._request('', {"prefetch": {"hosts": ["host1"]}})
+        self.assertEqual(resp.status_int, 400)
+
+    def test_prefetch_with_invalid_flavor(self):
+        body = {"prefetch": {"images": ["1"], "flavor_id": "9999"}}
+        resp = self._request('', body)
+        self.assertEqual(resp.status_int, 400)
+
+    def test_prefetch_status(self):
+        resp = self._request('/host1')
+        self.assertEqual(resp.status_int, 200)
+        prefetch = json.loads(resp.body)['prefetch']
+        self.assertEqual(prefetch['host'], 'host1')
+        self.assertEqual(prefetch['images']['1']['state'], 'done')
+
+    def test_prefetch_requires_admin_api(self):
+        self.flags(allow_admin_api=False)
+        resp = self._request('/host1')
+        self.assertEqual(resp.status_int, 404)
@@ -87,6 +87,7 @@ class ExtensionControllerTest(test.TestCase):
         self.flags(osapi_extensions_path=ext_path)
         self.ext_list = [
             "AdminActions",
+            "ConsoleOutput",
             "Createserverext",
             "DeferredDelete",
             "DiskConfig",
@@ -95,6 +96,7 @@ class ExtensionControllerTest(test.TestCase):
             "Floating_ips",
             "Fox In Socks",
             "Hosts",
+            "ImagePrefetch",
             "Keypairs",
             "Multinic",
             "Quotas",
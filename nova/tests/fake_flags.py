@@ -39,3 +39,5 @@ FLAGS['verbose'].SetDefault(True)
 FLAGS['sqlite_db'].SetDefault("tests.sqlite")
 FLAGS['use_ipv6'].SetDefault(True)
 FLAGS['flat_network_bridge'].SetDefault('br100')
+flags.DECLARE('periodic_task_jitter', 'nova.manager')
+FLAGS['periodic_task_jitter'].SetDefault(0)
@@ -21,6 +21,9 @@ Tests For Compute
 """
 
 from copy import copy
+import datetime
+import eventlet
+from eventlet import event
 import mox
 
 from nova import compute
@@ -37,6 +40,7 @@ import nova
 
 from nova.compute import instance_types
 from nova.compute import manager as compute_manager
+from nova.compute import pipeline
 from nova.compute import power_state
 from nova.compute import task_states
 from nova.compute import vm_states
@@ -44,6 +48,7 @@ from nova.db.sqlalchemy import models
 from nova.image import fake as fake_image
 from nova.notifier import test_notifier
 from nova.tests import fake_network
+from nova.virt import driver
 
 
 LOG = logging.getLogger('nova.tests.compute')
@@ -92,7 +97,7 @@ def rpc_cast_wrapper(context, topic, msg):
     rpc_call_wrapper(context, topic, msg, do_cast=True)
 
 
-def nop_report_driver_status(self):
+def nop_report_driver_status(self, context):
     pass
 
 
@@ -293,6 +298,114 @@ class ComputeTestCase(test.TestCase):
         LOG.info(_("After terminating instances: %s"), instances)
         self.assertEqual(len(instances), 0)
 
+    def test_run_instance_goes_through_boot_stages(self):
+        """Each boot passes once through every stage of the pipeline"""
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+
+        stats = self.compute.get_boot_pipeline_stats(self.context)
+        self.assertEqual(sorted(stats.keys()), sorted(pipeline.STAGES))
+        for stage in stats.values():
+            self.assertEqual(stage['calls'], 1)
+            self.assertEqual(stage['failures'], 0)
+            self.assertEqual(stage['running'], 0)
+        self.compute.terminate_instance(self.context, instance_id)
+
+    def test_boot_stage_queues_over_limit(self):
+        """A stage runs no more than its limit at once and queues the rest"""
+        stage = pipeline.Stage('image', 1)
+        release = event.Event()
+        first = eventlet.spawn(stage.run, release.wait)
+        second = eventlet.spawn(stage.run, lambda: 'done')
+        eventlet.sleep(0)
+        self.assertEqual(stage.running, 1)
+        self.assertEqual(stage.waiting, 1)
+
+        release.send()
+        first.wait()
+        result, seconds = second.wait()
+        self.assertEqual(result, 'done')
+        self.assertEqual(stage.get_stats()['calls'], 2)
+        self.assertTrue(stage.wait_max > 0)
+
+    def test_prefetch_images(self):
+        """Prefetched images are cached through the driver in the background"""
+        cached = []
+
+        def fake_cache_image(context, instance, block_device_info=None):
+            cached.append(instance)
+
+        self.stubs.Set(self.compute.driver, 'cache_image', fake_cache_image)
+        self.compute.prefetch_images(self.context, ['1'])
+        status = self.compute.get_prefetch_status(self.context)
+        self.assertEqual(status['1']['state'], 'queued')
+
+        self.compute._prefetch_pool.waitall()
+        status = self.compute.get_prefetch_status(self.context)
+        self.assertEqual(status['1']['state'], 'done')
+        self.assertEqual(len(cached), 1)
+        self.assertEqual(cached[0]['image_ref'], '1')
+        self.assertEqual(cached[0]['kernel_id'], 1)
+        default_type = instance_types.get_default_instance_type()
+        self.assertEqual(cached[0]['instance_type_id'], default_type['id'])
+
+    def test_prefetch_images_skips_images_in_progress(self):
+        """An image already being prefetched is not fetched again"""
+        cached = []
+        self.stubs.Set(self.compute.driver, 'cache_image',
+                       lambda context, instance: cached.append(instance))
+        self.compute.prefetch_images(self.context, ['1'])
+        self.compute.prefetch_images(self.context, ['1'])
+        self.compute._prefetch_pool.waitall()
+        self.assertEqual(len(cached), 1)
+
+    def test_prefetch_image_failure_is_reported(self):
+        def fake_cache_image(context, instance):
+            raise exception.ImageUnacceptable(image_id='1', reason='bad')
+
+        self.stubs.Set(self.compute.driver, 'cache_image', fake_cache_image)
+        self.compute.prefetch_images(self.context, ['1'])
+        self.compute._prefetch_pool.waitall()
+        status = self.compute.get_prefetch_status(self.context)
+        self.assertEqual(status['1']['state'], 'error')
+        self.assertTrue('bad' in status['1']['error'])
+
+    def test_get_nbd_stats(self):
+        """nbd pool counters come from the driver"""
+        self.assertEqual(self.compute.get_nbd_stats(self.context), {})
+        self.stubs.Set(self.compute.driver, 'get_nbd_stats',
+                       lambda: {'in_use': 1})
+        self.assertEqual(self.compute.get_nbd_stats(self.context),
+                         {'in_use': 1})
+
+    def test_prefetch_status_expires(self):
+        """Finished prefetches are forgotten after the status ttl"""
+        self.flags(image_prefetch_status_ttl=60)
+        self.stubs.Set(self.compute.driver, 'cache_image',
+                       lambda context, instance: None)
+        self.compute.prefetch_images(self.context, ['1'])
+        self.compute._prefetch_pool.waitall()
+        status = self.compute.get_prefetch_status(self.context)
+        self.assertEqual(status['1']['state'], 'done')
+
+        later = datetime.datetime.utcnow() + datetime.timedelta(seconds=61)
+        self.stubs.Set(utils, 'utcnow', lambda: later)
+        self.assertEqual(self.compute.get_prefetch_status(self.context), {})
+
+    def test_api_prefetch_images_targets_availability_zone(self):
+        for host, zone in (('host1', 'zone1'), ('host2', 'zone2')):
+            db.service_create(self.context.elevated(),
+                              {'host': host, 'binary': 'nova-compute',
+                               'topic': 'compute', 'report_count': 0,
+                               'availability_zone': zone})
+        casts = []
+        self.stubs.Set(rpc, 'cast',
+                       lambda context, topic, msg: casts.append(topic))
+        hosts = self.compute_api.prefetch_images(self.context, ['1'],
+                                                 availability_zone='zone2')
+        self.assertEqual(hosts, ['host2'])
+        self.assertEqual(casts, ['compute.host2'])
+
     def test_run_terminate_timestamps(self):
         """Make sure timestamps are set for launched and destroyed"""
         instance_id = self._create_instance()
@@ -429,6 +542,21 @@ class ComputeTestCase(test.TestCase):
         self.assert_(console)
         self.compute.terminate_instance(self.context, instance_id)
 
+    def test_console_output_tail(self):
+        """Make sure only the last lines of console output are sent"""
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+
+        self.stubs.Set(self.compute.driver, 'get_console_output',
+                       lambda instance, length: 'one\ntwo\nthree\n')
+        console = self.compute.get_console_output(self.context,
+                                                  instance_id, length=2)
+        self.assertEqual(console, 'two\nthree\n')
+        console = self.compute.get_console_output(self.context,
+                                                  instance_id, length=0)
+        self.assertEqual(console, '')
+        self.compute.terminate_instance(self.context, instance_id)
+
     def test_ajax_console(self):
         """Make sure we can get console output from instance"""
         instance_id = self._create_instance()
@@ -568,6 +696,77 @@ class ComputeTestCase(test.TestCase):
 
         self.compute.terminate_instance(self.context, instance_id)
 
+    def test_lock_not_read_for_admin(self):
+        """admins skip the lock check without reading the lock state"""
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+
+        def fake_get_lock(*args, **kwargs):
+            self.fail(_("lock state should not be read from the db"))
+
+        self.stubs.Set(self.compute, 'get_lock', fake_get_lock)
+        admin_context = context.get_admin_context()
+        ret_val = self.compute.reboot_instance(admin_context, instance_id)
+        self.assertEqual(ret_val, None)
+
+        self.stubs.UnsetAll()
+        self.compute.terminate_instance(self.context, instance_id)
+
+    def _count_instance_gets(self):
+        """Count instance reads made through the compute manager's db."""
+        calls = []
+        real_instance_get = self.compute.db.instance_get
+
+        def fake_instance_get(*args, **kwargs):
+            calls.append(args)
+            return real_instance_get(*args, **kwargs)
+
+        self.stubs.Set(self.compute.db, 'instance_get', fake_instance_get)
+        return calls
+
+    def test_sent_lock_state_spares_db_reads(self):
+        """non-admin actions use the lock state sent by the api"""
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+        non_admin_context = context.RequestContext(None, None, False, False)
+
+        calls = self._count_instance_gets()
+        ret_val = self.compute.reboot_instance(non_admin_context, instance_id,
+                                               instance_locked=True)
+        self.assertEqual(ret_val, False)
+        self.assertEqual(len(calls), 0)
+
+        ret_val = self.compute.reboot_instance(non_admin_context, instance_id,
+                                               instance_locked=False)
+        self.assertEqual(ret_val, None)
+        sent_reads = len(calls)
+
+        del calls[:]
+        ret_val = self.compute.reboot_instance(non_admin_context, instance_id)
+        self.assertEqual(ret_val, None)
+        self.assertEqual(len(calls), sent_reads + 1)
+
+        self.stubs.UnsetAll()
+        self.compute.terminate_instance(self.context, instance_id)
+
+    def test_api_sends_lock_state(self):
+        """the api passes the lock state it read along to compute"""
+        instance_id = self._create_instance({'host': FLAGS.host,
+                                             'locked': True})
+        casts = []
+
+        def fake_cast(context, topic, msg):
+            casts.append(msg)
+
+        self.stubs.Set(rpc, 'cast', fake_cast)
+        self.compute_api.pause(self.context, instance_id)
+        self.assertEqual(casts[0]['args'], {'instance_id': instance_id,
+                                            'instance_locked': True})
+
+        self.flags(compute_send_lock_state=False)
+        self.compute_api.pause(self.context, instance_id)
+        self.assertEqual(casts[1]['args'], {'instance_id': instance_id})
+
     def test_finish_resize(self):
         """Contrived test to ensure finish_resize doesn't raise anything"""
 
@@ -1486,6 +1685,93 @@ class ComputeTestCase(test.TestCase):
         self.assertEqual(i_ref['name'], i_ref['uuid'])
         db.instance_destroy(self.context, i_ref['id'])
 
+    def test_sync_power_states_only_every_interval(self):
+        """Full power state sync is rate limited"""
+        self.flags(sync_power_state_interval=600)
+        instance_id = self._create_instance({
+                'host': self.compute.host,
+                'power_state': power_state.RUNNING})
+        self.stubs.Set(self.compute.driver, 'list_instances_detail',
+                       lambda: [])
+        self.compute.periodic_tasks(context.get_admin_context())
+        instance = db.instance_get(self.context, instance_id)
+        self.assertEqual(instance['power_state'], power_state.NOSTATE)
+
+        db.instance_update(self.context, instance_id,
+                           {'power_state': power_state.RUNNING})
+        self.compute.periodic_tasks(context.get_admin_context())
+        instance = db.instance_get(self.context, instance_id)
+        self.assertEqual(instance['power_state'], power_state.RUNNING)
+        db.instance_destroy(self.context, instance_id)
+
+    def test_periodic_tasks_share_host_snapshot(self):
+        """Host instances are fetched once per periodic cycle"""
+        calls = []
+        real_get_all_by_host = self.compute.db.instance_get_all_by_host
+
+        def fake_get_all_by_host(context, host):
+            calls.append(host)
+            return real_get_all_by_host(context, host)
+
+        self.stubs.Set(self.compute.db, 'instance_get_all_by_host',
+                       fake_get_all_by_host)
+        self.flags(sync_power_state_interval=0)
+        self.compute.periodic_tasks(context.get_admin_context())
+        self.assertEqual(calls, [self.compute.host])
+        self.compute.periodic_tasks(context.get_admin_context())
+        self.assertEqual(len(calls), 2)
+
+    def test_host_snapshot_dropped_after_cycle(self):
+        """Calls outside a periodic cycle don't get its stale snapshot"""
+        self.flags(sync_power_state_interval=0)
+        self.compute.periodic_tasks(context.get_admin_context())
+        self.assertEqual(self.compute._host_snapshot, None)
+        instance_id = self._create_instance({'host': self.compute.host})
+        snapshot = self.compute._get_host_snapshot(self.context.elevated())
+        self.assertEqual([i['id'] for i in snapshot.db_instances],
+                         [instance_id])
+        db.instance_destroy(self.context, instance_id)
+
+    def test_power_state_event_updates_instance(self):
+        """Driver events update only instances whose state changed"""
+        instance_id = self._create_instance({
+                'host': self.compute.host,
+                'power_state': power_state.RUNNING})
+        self.stubs.Set(self.compute.driver, 'list_instances_detail',
+                lambda: [driver.InstanceInfo(name, power_state.RUNNING)])
+        name = db.instance_get(self.context, instance_id)['name']
+        self.compute._sync_power_states(self.context.elevated())
+
+        updates = []
+        real_update = self.compute._instance_update
+
+        def fake_instance_update(context, instance_id, **kwargs):
+            updates.append(kwargs)
+            return real_update(context, instance_id, **kwargs)
+
+        self.stubs.Set(self.compute, '_instance_update', fake_instance_update)
+        self.compute._handle_power_state_event(name, power_state.RUNNING)
+        self.assertEqual(updates, [])
+        self.compute._handle_power_state_event(name, power_state.SHUTOFF)
+        self.assertEqual(updates, [{'power_state': power_state.SHUTOFF}])
+        instance = db.instance_get(self.context, instance_id)
+        self.assertEqual(instance['power_state'], power_state.SHUTOFF)
+        self.compute._handle_power_state_event(name, power_state.SHUTOFF)
+        self.assertEqual(len(updates), 1)
+        db.instance_destroy(self.context, instance_id)
+
+    def test_power_state_event_for_unknown_instance(self):
+        """Events for instances the manager doesn't know are ignored"""
+        updates = []
+
+        def fake_instance_update(context, instance_id, **kwargs):
+            updates.append(instance_id)
+
+        self.stubs.Set(self.compute, '_instance_update', fake_instance_update)
+        self.compute._handle_power_state_event('instance-unknown',
+                                               power_state.SHUTOFF)
+        self.assertEqual(updates, [])
+
 
 class ComputeTestMinRamMinDisk(test.TestCase):
     def setUp(self):
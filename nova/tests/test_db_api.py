@@ -147,3 +147,37 @@ class DbApiTestCase(test.TestCase):
         results = db.instance_get_all_hung_in_rebooting(ctxt, 10)
         self.assertEqual(0, len(results))
         db.instance_update(ctxt, instance.id, {"task_state": None})
+
+    def test_bw_usage_update_bulk(self):
+        ctxt = context.get_admin_context()
+        start_period = datetime.datetime(2011, 10, 1)
+        db.bw_usage_update(ctxt, 1, 'net1', start_period, 10, 20)
+        db.bw_usage_update(ctxt, 2, 'net1', start_period, 30, 40)
+        unchanged = db.bw_usage_get_by_instance(ctxt, 2, start_period)[0]
+
+        db.bw_usage_update_bulk(ctxt, start_period,
+                [{'instance_id': 1, 'network_label': 'net1',
+                  'bw_in': 11, 'bw_out': 21},
+                 {'instance_id': 1, 'network_label': 'net2',
+                  'bw_in': 1, 'bw_out': 2},
+                 {'instance_id': 2, 'network_label': 'net1',
+                  'bw_in': 30, 'bw_out': 40}])
+
+        usages = db.bw_usage_get_by_instance(ctxt, 1, start_period)
+        counters = sorted((u.network_label, u.bw_in, u.bw_out)
+                          for u in usages)
+        self.assertEqual(counters, [('net1', 11, 21), ('net2', 1, 2)])
+        usage = db.bw_usage_get_by_instance(ctxt, 2, start_period)[0]
+        self.assertEqual(usage.last_refreshed, unchanged.last_refreshed)
+
+    def test_bw_usage_update_bulk_merges_repeated_usages(self):
+        ctxt = context.get_admin_context()
+        start_period = datetime.datetime(2011, 10, 1)
+        db.bw_usage_update_bulk(ctxt, start_period,
+                [{'instance_id': 1, 'network_label': 'net1',
+                  'bw_in': 1, 'bw_out': 2},
+                 {'instance_id': 1, 'network_label': 'net1',
+                  'bw_in': 3, 'bw_out': 4}])
+
+        usages = db.bw_usage_get_by_instance(ctxt, 1, start_period)
+        self.assertEqual([(u.bw_in, u.bw_out) for u in usages], [(3, 4)])
@@ -19,6 +19,7 @@
 
 import os
 
+from nova import exception
 from nova import test
 from nova.network import linux_net
 
@@ -162,3 +163,120 @@ class IptablesManagerTestCase(test.TestCase):
             self.assertTrue('-A %s -j run_tests.py-%s' \
                             % (chain, chain) in new_lines,
                             "Built-in chain %s not wrapped" % (chain,))
+
+    def _fake_execute(self, *cmd, **kwargs):
+        self.executed.append((cmd, kwargs.get('process_input')))
+        if cmd[0].endswith('-save'):
+            if cmd[-1] == 'nat':
+                return '\n'.join(self.sample_nat), ''
+            return '\n'.join(self.sample_filter), ''
+        if self.fail_noflush and '--noflush' in cmd:
+            raise exception.ProcessExecutionError(cmd=' '.join(cmd))
+        return '', ''
+
+    def _stub_execute(self):
+        self.flags(use_ipv6=False, iptables_resync_interval=0)
+        self.executed = []
+        self.fail_noflush = False
+        self.manager.execute = self._fake_execute
+
+    def test_unchanged_tables_are_skipped(self):
+        self._stub_execute()
+        self.manager.apply()
+        self.assertEqual(len(self.executed), 4)
+        self.executed = []
+        self.manager.apply()
+        self.assertEqual(self.executed, [])
+
+    def test_changed_chains_are_restored_alone(self):
+        self._stub_execute()
+        self.manager.apply()
+        self.executed = []
+
+        table = self.manager.ipv4['filter']
+        table.add_chain('inst-1')
+        table.add_rule('inst-1', '-j DROP')
+        table.add_rule('local', '-d 10.0.0.2 -j $inst-1')
+        self.manager.apply()
+        self.assertEqual(len(self.executed), 1)
+        cmd, lines = self.executed[0]
+        self.assertEqual(cmd, ('iptables-restore', '--noflush'))
+        lines = lines.split('\n')
+        self.assertEqual(lines[0], '*filter')
+        self.assertEqual(sorted(lines[1:3]),
+                         [':run_tests.py-inst-1 - [0:0]',
+                          ':run_tests.py-local - [0:0]'])
+        self.assertTrue('-A run_tests.py-inst-1 -j DROP' in lines)
+        self.assertTrue('-A run_tests.py-local -d 10.0.0.2 '
+                        '-j run_tests.py-inst-1' in lines)
+        self.assertFalse([line for line in lines if 'INPUT' in line])
+
+        self.executed = []
+        table.remove_chain('inst-1')
+        self.manager.apply()
+        lines = self.executed[0][1].split('\n')
+        self.assertEqual(lines[1:3], [':run_tests.py-local - [0:0]',
+                                      ':run_tests.py-inst-1 - [0:0]'])
+        self.assertTrue('-X run_tests.py-inst-1' in lines)
+
+    def test_unwrapped_changes_restore_table(self):
+        self._stub_execute()
+        self.manager.apply()
+        self.executed = []
+        self.manager.ipv4['nat'].add_rule('PREROUTING', '-j ACCEPT',
+                                          wrap=False)
+        self.manager.apply()
+        self.assertEqual([cmd for cmd, _input in self.executed],
+                         [('iptables-save', '-t', 'nat'),
+                          ('iptables-restore',)])
+
+    def test_drift_restores_table(self):
+        self._stub_execute()
+        self.manager.apply()
+        self.executed = []
+        self.fail_noflush = True
+        self.manager.ipv4['filter'].add_rule('local', '-j DROP')
+        self.manager.apply()
+        self.assertEqual([cmd for cmd, _input in self.executed],
+                         [('iptables-restore', '--noflush'),
+                          ('iptables-save', '-t', 'filter'),
+                          ('iptables-restore',)])
+
+    def test_resync_restores_every_table(self):
+        self._stub_execute()
+        self.manager.apply()
+        self.executed = []
+        self.manager.resync()
+        self.manager.apply()
+        self.assertEqual(len(self.executed), 4)
+
+    def test_deferred_applies_are_coalesced(self):
+        self._stub_execute()
+        self.flags(iptables_apply_delay=0)
+        table = self.manager.ipv4['filter']
+        for i in xrange(3):
+            table.add_rule('local', '-d 10.0.0.%d -j DROP' % i)
+            self.manager.defer_apply()
+        self.assertEqual(self.executed, [])
+        self.manager.defer_apply(wait=True)
+        self.assertEqual(len(self.executed), 4)
+
+    def test_deferred_apply_errors_reach_waiters(self):
+        self.flags(iptables_apply_delay=0)
+
+        def fake_apply():
+            raise exception.ProcessExecutionError(cmd='iptables-restore')
+
+        self.stubs.Set(self.manager, 'apply', fake_apply)
+        self.assertRaises(exception.ProcessExecutionError,
+                          self.manager.defer_apply, wait=True)
+
+    def test_floating_forward_waits_for_apply(self):
+        self.flags(iptables_apply_delay=0)
+        applied = []
+        self.stubs.Set(linux_net, 'iptables_manager', self.manager)
+        self.stubs.Set(self.manager, 'apply', lambda: applied.append(True))
+        linux_net.ensure_floating_forward('1.2.3.4', '10.0.0.2')
+        self.assertEqual(applied, [True])
+        linux_net.remove_floating_forward('1.2.3.4', '10.0.0.2')
+        self.assertEqual(applied, [True, True])
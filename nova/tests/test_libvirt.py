@@ -16,12 +16,16 @@
 
 import copy
 import eventlet
+import hashlib
 import mox
 import os
 import re
 import shutil
+import struct
 import sys
 import tempfile
+import time
+import zlib
 
 from xml.etree.ElementTree import fromstring as xml_to_tree
 from xml.dom.minidom import parseString as xml_to_dom
@@ -30,6 +34,7 @@ from nova import context
 from nova import db
 from nova import exception
 from nova import flags
+import nova.image
 from nova import log as logging
 from nova import test
 from nova import utils
@@ -37,8 +42,16 @@ from nova.api.ec2 import cloud
 from nova.compute import power_state
 from nova.compute import vm_states
 from nova.virt import driver
+from nova.virt import images
 from nova.virt.libvirt import connection
+from nova.virt.libvirt import consolelog
+from nova.virt.libvirt import domainstats
+from nova.virt.libvirt import domainxml
 from nova.virt.libvirt import firewall
+from nova.virt.libvirt import imagecache
+from nova.virt.libvirt import migration
+from nova.virt.libvirt import proxy
+from nova.virt.libvirt import qcow2
 from nova.virt.libvirt import volume
 from nova.volume import driver as volume_driver
 from nova.tests import fake_network
@@ -90,6 +103,12 @@ class FakeVirtDomain(object):
     def XMLDesc(self, *args):
         return self._fake_dom_xml
 
+    def UUIDString(self):
+        return 'fake-uuid'
+
+    def ID(self):
+        return 1
+
 
 class LibvirtVolumeTestCase(test.TestCase):
 
@@ -214,6 +233,637 @@ class CacheConcurrencyTestCase(test.TestCase):
             eventlet.sleep(0)
 
 
+class ImageCacheManagerTestCase(test.TestCase):
+    def setUp(self):
+        super(ImageCacheManagerTestCase, self).setUp()
+        self.instances_path = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.instances_path, '_base')
+        os.mkdir(self.base_dir)
+        self.manager = imagecache.ImageCacheManager(self.instances_path)
+        self.flags(image_cache_max_unused_age=3600,
+                   image_cache_min_unused_age=600,
+                   image_cache_max_size_gb=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.instances_path)
+        super(ImageCacheManagerTestCase, self).tearDown()
+
+    def _make_base(self, name, idle, size=1):
+        path = os.path.join(self.base_dir, name)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        used_at = time.time() - idle
+        os.utime(path, (used_at, used_at))
+
+    def _make_disk(self, instance_name, backing_name):
+        instance_dir = os.path.join(self.instances_path, instance_name)
+        os.mkdir(instance_dir)
+        backing_file = os.path.join(self.base_dir, backing_name)
+        header = struct.pack('>4sIQI', imagecache.QCOW2_MAGIC, 2, 32,
+                             len(backing_file))
+        with open(os.path.join(instance_dir, 'disk'), 'w') as f:
+            f.write(header + '\0' * (32 - len(header)) + backing_file)
+
+    def _exists(self, name):
+        return os.path.exists(os.path.join(self.base_dir, name))
+
+    def test_get_backing_file(self):
+        self._make_disk('instance-00000001', 'abc')
+        disk = os.path.join(self.instances_path, 'instance-00000001', 'disk')
+        self.assertEqual(imagecache.get_backing_file(disk),
+                         os.path.join(self.base_dir, 'abc'))
+        self._make_base('raw', 0)
+        raw = os.path.join(self.base_dir, 'raw')
+        self.assertEqual(imagecache.get_backing_file(raw), None)
+
+    def test_removes_only_old_unused_images(self):
+        self._make_base('backing', 7200)
+        self._make_disk('instance-00000001', 'backing')
+        self._make_base('%08x' % 3, 7200)
+        self._make_base('old', 7200)
+        self._make_base('new', 60)
+        self._make_base('old.part', 7200)
+        instances = [{'kernel_id': 3, 'ramdisk_id': None, 'image_ref': 1}]
+
+        report = self.manager.verify_base_images(instances)
+        self.assertEqual(report['in_use'], ['00000003', 'backing'])
+        self.assertEqual(report['removed'], ['old'])
+        self.assertEqual(report['kept'], ['new'])
+        self.assertFalse(self._exists('old'))
+        for name in ('backing', '00000003', 'new', 'old.part'):
+            self.assertTrue(self._exists(name))
+
+    def test_non_integer_image_ref_is_skipped(self):
+        self._make_base('%08x' % 3, 7200)
+        instances = [{'id': 1, 'kernel_id': 'aki-xyz', 'ramdisk_id': None,
+                      'image_ref': None},
+                     {'id': 2, 'kernel_id': 3, 'ramdisk_id': None,
+                      'image_ref': None}]
+        report = self.manager.verify_base_images(instances, dry_run=True)
+        self.assertEqual(report['in_use'], ['00000003'])
+
+    def test_dry_run_removes_nothing(self):
+        self._make_base('old', 7200)
+        report = self.manager.verify_base_images([], dry_run=True)
+        self.assertEqual(report['removed'], ['old'])
+        self.assertTrue(self._exists('old'))
+
+    def test_size_budget_removes_least_recently_used(self):
+        self.flags(image_cache_max_unused_age=0, image_cache_max_size_gb=1)
+        gb = 1024 * 1024 * 1024
+        self.stubs.Set(self.manager, '_list_base_images',
+                       lambda: {'oldest': (gb / 2, 2000),
+                                'older': (gb / 2, 3000),
+                                'recent': (gb / 2, time.time())})
+        report = self.manager.verify_base_images([], dry_run=True)
+        self.assertEqual(report['removed'], ['oldest'])
+        self.assertEqual(report['size_after'], gb)
+
+
+class FakeLibvirtObject(object):
+    def __init__(self):
+        self.name = 'fake'
+
+    def lookupByName(self, name):
+        return FakeLibvirtObject()
+
+    def listAllDomains(self):
+        return [FakeLibvirtObject()]
+
+    def XMLDesc(self, flags):
+        return '<domain/>'
+
+    def destroy(self):
+        time.sleep(0.5)
+
+    def migrateToURI(self, *args):
+        time.sleep(0.5)
+
+    def create(self):
+        raise IOError()
+
+
+class ThreadPoolProxyTestCase(test.TestCase):
+    def setUp(self):
+        super(ThreadPoolProxyTestCase, self).setUp()
+        self.pool = proxy.CallPool(max_calls=1, timeout=0.1)
+        self.conn = proxy.ThreadPoolProxy(FakeLibvirtObject(), self.pool)
+
+    def test_results_are_proxied(self):
+        dom = self.conn.lookupByName('instance-00000001')
+        self.assertTrue(isinstance(dom, proxy.ThreadPoolProxy))
+        self.assertEqual(dom.XMLDesc(0), '<domain/>')
+        self.assertEqual(dom.name, 'fake')
+
+    def test_calls_run_in_native_threads(self):
+        """Other greenthreads run while a call blocks"""
+        ran_at = []
+
+        def other():
+            eventlet.sleep(0.1)
+            ran_at.append(time.time())
+
+        eventlet.spawn(other)
+        self.pool.timeout = 0
+        self.conn.destroy()
+        self.assertTrue(ran_at[0] < time.time() - 0.2)
+
+    def test_slow_call_times_out(self):
+        self.assertRaises(exception.HypervisorCallTimeout,
+                          self.conn.destroy)
+        self.assertEqual(self.pool.get_stats()['destroy']['timeouts'], 1)
+
+    def test_migration_is_not_timed_out(self):
+        self.conn.migrateToURI('qemu+tcp://dest/system')
+        stats = self.pool.get_stats()['migrateToURI']
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertTrue(stats['max'] >= 0.5)
+
+    def test_listed_objects_are_proxied(self):
+        domains = self.conn.listAllDomains()
+        self.assertTrue(isinstance(domains[0], proxy.ThreadPoolProxy))
+
+    def test_failures_are_counted(self):
+        self.assertRaises(IOError, self.conn.create)
+        stats = self.pool.get_stats()['create']
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['failures'], 1)
+
+
+class DomainXMLCacheTestCase(test.TestCase):
+    xml = """
+        <domain type='kvm'>
+            <devices>
+                <disk type='file' device='disk'>
+                    <driver name='qemu' type='qcow2'/>
+                    <source file='/instances/instance-00000001/disk'/>
+                    <target dev='vda' bus='virtio'/>
+                </disk>
+                <disk type='block' device='disk'>
+                    <source dev='/dev/sdb'/>
+                    <target dev='vdb' bus='virtio'/>
+                </disk>
+                <interface type='bridge'>
+                    <mac address='02:16:3e:00:00:01'/>
+                    <target dev='vnet0'/>
+                </interface>
+                <serial type='pty'>
+                    <source path='/dev/pts/3'/>
+                </serial>
+                <graphics type='vnc' port='5900'/>
+            </devices>
+        </domain>
+    """
+
+    def setUp(self):
+        super(DomainXMLCacheTestCase, self).setUp()
+        self.cache = domainxml.DomainXMLCache()
+        self.dom = FakeVirtDomain(self.xml)
+        self.calls = 0
+
+        def fake_xml_desc(flags):
+            self.calls += 1
+            return self.xml
+
+        self.dom.XMLDesc = fake_xml_desc
+
+    def test_accessors(self):
+        parsed = self.cache.get(self.dom)
+        self.assertEqual(parsed.get_disk_targets(), ['vda', 'vdb'])
+        disks = parsed.get_disks()
+        self.assertEqual(disks[0]['source'],
+                         '/instances/instance-00000001/disk')
+        self.assertEqual(disks[0]['driver_type'], 'qcow2')
+        self.assertEqual(disks[1]['type'], 'block')
+        self.assertEqual(disks[1]['source'], '/dev/sdb')
+        self.assertEqual(parsed.get_interfaces(),
+                         [{'type': 'bridge', 'target': 'vnet0',
+                           'mac': '02:16:3e:00:00:01'}])
+        self.assertEqual(parsed.get_graphics_port('vnc'), '5900')
+        self.assertEqual(parsed.get_serial_pty(), '/dev/pts/3')
+        disk = xml_to_tree(parsed.get_disk_xml('vdb'))
+        self.assertEqual(disk.find('source').get('dev'), '/dev/sdb')
+        self.assertEqual(parsed.get_disk_xml('vdz'), None)
+
+    def test_xml_is_parsed_once(self):
+        self.cache.get(self.dom)
+        self.cache.get(self.dom)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.get_stats(),
+                         {'domains': 1, 'hits': 1, 'misses': 1})
+
+    def test_invalidate(self):
+        self.cache.get(self.dom)
+        self.cache.invalidate_domain(self.dom)
+        self.cache.get(self.dom)
+        self.assertEqual(self.calls, 2)
+
+    def test_restarted_domain_is_parsed_again(self):
+        self.cache.get(self.dom)
+        self.dom.ID = lambda: 2
+        self.cache.get(self.dom)
+        self.assertEqual(self.calls, 2)
+
+
+class FakeHostConnection(object):
+    """Fake LibvirtConnection for testing HostState."""
+
+    def __init__(self):
+        self._conn = self
+        self.updates = 0
+
+    def getCapabilities(self):
+        return "<capabilities><host><uuid>fake-host-uuid</uuid></host>" \
+               "</capabilities>"
+
+    def get_memory_mb_total(self):
+        self.updates += 1
+        return 4096
+
+    def get_memory_mb_used(self):
+        return 1024
+
+    def get_local_gb_total(self):
+        return 100
+
+    def get_local_gb_used(self):
+        return 40
+
+    def get_vcpu_total(self):
+        return 8
+
+    def get_vcpu_used(self):
+        return 3
+
+    def get_hypervisor_type(self):
+        return 'QEMU'
+
+    def get_hypervisor_version(self):
+        return 12003
+
+    def get_cpu_info(self):
+        return utils.dumps({'arch': 'x86_64'})
+
+
+class HostStateTestCase(test.TestCase):
+    def setUp(self):
+        super(HostStateTestCase, self).setUp()
+        self.conn = FakeHostConnection()
+        self.host_state = connection.HostState(self.conn)
+
+    def test_host_state(self):
+        stats = self.host_state.get_host_stats()
+        gb = 1024 * 1024 * 1024
+        self.assertEqual(stats['host_memory_total'], 4 * gb)
+        self.assertEqual(stats['host_memory_free'], 3 * gb)
+        self.assertEqual(stats['disk_total'], 100 * gb)
+        self.assertEqual(stats['disk_used'], 40 * gb)
+        self.assertEqual(stats['disk_available'], 60 * gb)
+        self.assertEqual(stats['vcpus'], 8)
+        self.assertEqual(stats['vcpus_used'], 3)
+        self.assertEqual(stats['hypervisor_type'], 'QEMU')
+        self.assertEqual(stats['host_uuid'], 'fake-host-uuid')
+        self.assertEqual(stats['host_cpu_info'], {'arch': 'x86_64'})
+
+    def test_stats_are_reused(self):
+        self.flags(libvirt_host_stats_max_age=60)
+        self.host_state.get_host_stats()
+        self.host_state.get_host_stats()
+        self.assertEqual(self.conn.updates, 1)
+        self.host_state.get_host_stats(refresh=True)
+        self.assertEqual(self.conn.updates, 2)
+
+    def test_stats_expire(self):
+        self.flags(libvirt_host_stats_max_age=0)
+        self.host_state.get_host_stats()
+        self.host_state._updated_at -= 1
+        self.host_state.get_host_stats()
+        self.assertEqual(self.conn.updates, 2)
+
+
+class FakeLibvirtError(Exception):
+    def __init__(self, code):
+        super(FakeLibvirtError, self).__init__(code)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+class FakeLibvirtModule(object):
+    libvirtError = FakeLibvirtError
+
+
+class FakeStatsDomain(FakeVirtDomain):
+    def __init__(self, name, vcpus):
+        super(FakeStatsDomain, self).__init__("""
+            <domain type='kvm'>
+                <devices>
+                    <disk type='file'><target dev='vda'/></disk>
+                    <interface type='bridge'><target dev='vnet0'/></interface>
+                </devices>
+            </domain>""")
+        self._name = name
+        self.vcpus = vcpus
+
+    def name(self):
+        return self._name
+
+    def info(self):
+        return [power_state.RUNNING, 2048, 1024, self.vcpus, 100]
+
+    def blockStats(self, disk):
+        return (1, 512, 2, 1024, -1)
+
+    def interfaceStats(self, interface):
+        return (10, 1, 0, 0, 20, 2, 0, 0)
+
+
+class FakeStatsConnection(object):
+    """Old libvirt, with neither bulk API."""
+
+    def __init__(self):
+        self.domains = [FakeStatsDomain('instance-00000001', 1),
+                        FakeStatsDomain('instance-00000002', 4)]
+        self.lookups = 0
+
+    def listDomainsID(self):
+        return range(len(self.domains))
+
+    def lookupByID(self, domain_id):
+        self.lookups += 1
+        return self.domains[domain_id]
+
+
+class FakeBulkStatsConnection(FakeStatsConnection):
+    def __init__(self, error=None):
+        super(FakeBulkStatsConnection, self).__init__()
+        self.error = error
+
+    def getAllDomainStats(self, stats, flags):
+        if self.error:
+            raise self.error
+        return [(self.domains[0],
+                 {'state.state': power_state.RUNNING,
+                  'balloon.maximum': 2048,
+                  'balloon.current': 1024,
+                  'vcpu.current': 2,
+                  'cpu.time': 100,
+                  'block.count': 1,
+                  'block.0.name': 'vda',
+                  'block.0.rd.reqs': 1,
+                  'block.0.rd.bytes': 512,
+                  'block.0.wr.reqs': 2,
+                  'block.0.wr.bytes': 1024,
+                  'net.count': 0})]
+
+
+class DomainStatsCollectorTestCase(test.TestCase):
+    def setUp(self):
+        super(DomainStatsCollectorTestCase, self).setUp()
+        self.collector = domainstats.DomainStatsCollector(
+                domainxml.DomainXMLCache(), FakeLibvirtModule)
+
+    def test_per_domain_fallback(self):
+        conn = FakeStatsConnection()
+        snapshot = self.collector.collect(conn, devices=True)
+        self.assertEqual(sorted(snapshot.domains),
+                         ['instance-00000001', 'instance-00000002'])
+        self.assertEqual(snapshot.vcpus_used, 5)
+        stats = snapshot.domains['instance-00000001']
+        self.assertEqual(stats.state, power_state.RUNNING)
+        self.assertEqual(stats.block, {'vda': (1, 512, 2, 1024, -1)})
+        self.assertEqual(stats.interfaces,
+                         {'vnet0': (10, 1, 0, 0, 20, 2, 0, 0)})
+
+    def test_bulk_stats(self):
+        conn = FakeBulkStatsConnection()
+        snapshot = self.collector.collect(conn, devices=True)
+        self.assertEqual(conn.lookups, 0)
+        self.assertEqual(snapshot.vcpus_used, 2)
+        stats = snapshot.domains['instance-00000001']
+        self.assertEqual(stats.mem, 1024)
+        self.assertEqual(stats.block, {'vda': (1, 512, 2, 1024, -1)})
+        self.assertEqual(stats.interfaces, {})
+
+    def test_unsupported_bulk_stats_are_not_retried(self):
+        conn = FakeBulkStatsConnection(
+                FakeLibvirtError(domainstats.VIR_ERR_NO_SUPPORT))
+        self.assertEqual(self.collector.collect(conn).vcpus_used, 5)
+        conn.error = None
+        self.assertEqual(self.collector.collect(conn).vcpus_used, 5)
+
+    def test_failed_bulk_stats_are_retried(self):
+        conn = FakeBulkStatsConnection(FakeLibvirtError(1))
+        self.assertEqual(self.collector.collect(conn).vcpus_used, 5)
+        conn.error = None
+        self.assertEqual(self.collector.collect(conn).vcpus_used, 2)
+
+
+class FakeMigratingDomain(object):
+    def __init__(self, job_infos):
+        self.job_infos = job_infos
+        self.aborted = False
+
+    def jobInfo(self):
+        return self.job_infos.pop(0)
+
+    def abortJob(self):
+        self.aborted = True
+
+
+class MigrationMonitorTestCase(test.TestCase):
+    @staticmethod
+    def _job_info(data_processed, data_remaining, mem_processed,
+                  mem_remaining):
+        return [1, 5000, 0, data_processed + data_remaining, data_processed,
+                data_remaining, 0, mem_processed, mem_remaining, 0, 0, 0]
+
+    def test_progress_is_recorded(self):
+        domain = FakeMigratingDomain([self._job_info(100, 900, 100, 900),
+                                      self._job_info(500, 600, 500, 600)])
+        monitor = migration.MigrationMonitor('instance-00000001', domain)
+        monitor.poll()
+        monitor._sample = (monitor._sample[0] - 2,) + monitor._sample[1:]
+        monitor.poll()
+        self.assertEqual(monitor.progress['data_processed'], 500)
+        self.assertEqual(monitor.progress['data_remaining'], 600)
+        self.assertEqual(monitor.progress['elapsed'], 5)
+        # 400 bytes were copied and 300 fewer remain, so 100 were dirtied.
+        self.assertTrue(45 < monitor.progress['dirty_rate'] <= 50)
+        self.assertFalse(domain.aborted)
+
+    def test_stuck_migration_is_aborted(self):
+        domain = FakeMigratingDomain([self._job_info(100, 900, 100, 900),
+                                      self._job_info(800, 950, 800, 950)])
+        monitor = migration.MigrationMonitor('instance-00000001', domain,
+                                             progress_timeout=10)
+        monitor.poll()
+        monitor._progress_at -= 11
+        monitor.poll()
+        self.assertTrue(monitor.aborted)
+        self.assertTrue(domain.aborted)
+
+    def test_wait_returns_migration_result(self):
+        domain = FakeMigratingDomain([])
+        monitor = migration.MigrationMonitor('instance-00000001', domain)
+        job = eventlet.spawn(lambda: 'migrated')
+        self.assertEqual(monitor.wait(job, interval=0), 'migrated')
+
+
+class QCow2SnapshotReaderTestCase(test.TestCase):
+    cluster = 512
+
+    def setUp(self):
+        super(QCow2SnapshotReaderTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'disk')
+        self.backing_path = os.path.join(self.tmpdir, 'base')
+        self.size = 5 * self.cluster - 100
+        with open(self.backing_path, 'wb') as f:
+            f.write('b' * 3 * self.cluster + 'd' * 100)
+        self._write_image()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(QCow2SnapshotReaderTestCase, self).tearDown()
+
+    def _snapshot_entry(self, l1_offset, name, extra=''):
+        entry = (qcow2.SNAPSHOT_HEADER.pack(l1_offset, 1, 1, len(name), 0, 0,
+                                            0, 0, len(extra)) +
+                 extra + '1' + name)
+        return entry + '\0' * (-len(entry) % 8)
+
+    def _write_image(self, incompatible_features=0):
+        """Write a v3 image whose snapshot covers every kind of cluster.
+
+        Guest cluster 0 is allocated, 1 and 3 come from the backing file,
+        2 is compressed and 4 is a zero cluster.
+        """
+        image = ['\0' * self.cluster for _i in xrange(6)]
+        image[0] = ((qcow2.HEADER.pack(imagecache.QCOW2_MAGIC, 3, 200,
+                                       len(self.backing_path), 9,
+                                       8 * self.cluster, 0, 1, 1024, 0, 0, 2,
+                                       512) +
+                     qcow2.INCOMPATIBLE_FEATURES.pack(incompatible_features)
+                     ).ljust(200, '\0') +
+                    self.backing_path).ljust(self.cluster, '\0')
+        image[1] = (self._snapshot_entry(0, 'other') +
+                    self._snapshot_entry(1024, 'snap',
+                                         struct.pack('>QQ', 0, self.size))
+                    ).ljust(self.cluster, '\0')
+        image[2] = struct.pack('>Q', 1536).ljust(self.cluster, '\0')
+        image[3] = struct.pack('>5Q', 2048, 0, qcow2.COMPRESSED | 2560, 0,
+                               qcow2.ZERO).ljust(self.cluster, '\0')
+        image[4] = 'a' * self.cluster
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+        image[5] = (compressor.compress('c' * self.cluster) +
+                    compressor.flush()).ljust(self.cluster, '\0')
+        with open(self.path, 'wb') as f:
+            f.write(''.join(image))
+
+    def test_snapshot_reads_as_raw_image(self):
+        reader = qcow2.SnapshotReader(self.path, 'snap')
+        try:
+            self.assertEqual(reader.size, self.size)
+            chunks = []
+            while True:
+                chunk = reader.read()
+                if not chunk:
+                    break
+                self.assertTrue(len(chunk) <= self.cluster)
+                chunks.append(chunk)
+        finally:
+            reader.close()
+        expected = ('a' * self.cluster + 'b' * self.cluster +
+                    'c' * self.cluster + 'd' * 100 +
+                    '\0' * (self.cluster - 100) + '\0' * (self.cluster - 100))
+        self.assertEqual(''.join(chunks), expected)
+
+    def test_reads_are_not_cluster_aligned(self):
+        reader = qcow2.SnapshotReader(self.path, 'snap')
+        try:
+            self.assertEqual(reader.read(700), 'a' * 512 + 'b' * 188)
+            self.assertEqual(reader.read(400), 'b' * 324 + 'c' * 76)
+        finally:
+            reader.close()
+
+    def test_incompatible_features_are_not_streamable(self):
+        self._write_image(incompatible_features=qcow2.DIRTY)
+        qcow2.SnapshotReader(self.path, 'snap').close()
+        # External data file, then extended L2 entries.
+        for feature in (1 << 2, 1 << 4):
+            self._write_image(incompatible_features=feature)
+            self.assertRaises(exception.SnapshotNotStreamable,
+                              qcow2.SnapshotReader, self.path, 'snap')
+
+    def test_missing_snapshot_is_not_streamable(self):
+        self.assertRaises(exception.SnapshotNotStreamable,
+                          qcow2.SnapshotReader, self.path, 'missing')
+
+    def test_raw_image_is_not_streamable(self):
+        self.assertRaises(exception.SnapshotNotStreamable,
+                          qcow2.SnapshotReader, self.backing_path, 'snap')
+        self.assertRaises(exception.SnapshotNotStreamable,
+                          qcow2.SnapshotReader,
+                          os.path.join(self.tmpdir, 'nonexistent'), 'snap')
+
+
+class ConsoleLogTestCase(test.TestCase):
+    def setUp(self):
+        super(ConsoleLogTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'console.log')
+        self.lines = ['line %d\n' % i for i in xrange(2000)]
+        with open(self.path, 'w') as log:
+            log.write(''.join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ConsoleLogTestCase, self).tearDown()
+
+    def test_tail_returns_last_lines(self):
+        self.assertEqual(consolelog.tail(self.path, 3),
+                         ''.join(self.lines[-3:]))
+        self.assertEqual(consolelog.tail(self.path, 0), '')
+
+    def test_tail_is_capped(self):
+        output = consolelog.tail(self.path, max_bytes=100)
+        self.assertEqual(len(output), 100)
+        self.assertTrue(''.join(self.lines).endswith(output))
+
+    def test_tail_of_missing_log(self):
+        self.assertEqual(consolelog.tail(self.path + '.missing', 10), '')
+
+    def test_rotated_log_is_tailed_across_backup(self):
+        self.assertTrue(consolelog.needs_rotation(self.path, 16384))
+        consolelog.rotate(self.path, 16384)
+        with open(consolelog.backup_path(self.path)) as backup:
+            self.assertEqual(len(backup.read()), 16384)
+        # qemu carries on writing at its old offset after the truncation.
+        with open(self.path, 'r+') as log:
+            log.seek(len(''.join(self.lines)))
+            log.write('new line\n')
+        self.assertFalse(consolelog.needs_rotation(self.path, 16384))
+        self.assertEqual(consolelog.tail(self.path, 3),
+                         ''.join(self.lines[-2:]) + 'new line\n')
+
+    def test_guest_nuls_are_not_taken_for_the_hole(self):
+        consolelog.rotate(self.path, 16384)
+        with open(self.path, 'r+') as log:
+            log.seek(len(''.join(self.lines)))
+            log.write('\0' * 5000 + 'new line\n')
+        self.assertEqual(consolelog.tail(self.path, 2),
+                         self.lines[-1] + '\0' * 5000 + 'new line\n')
+
+    def test_stale_hole_is_ignored(self):
+        consolelog.rotate(self.path, 16384)
+        # A new qemu writes the log from the start.
+        with open(self.path, 'w') as log:
+            log.write('boot\n')
+        self.assertEqual(consolelog.tail(self.path, 1), 'boot\n')
+
+
 class FakeVolumeDriver(object):
     def __init__(self, *args, **kwargs):
         pass
@@ -898,6 +1548,109 @@ class LibvirtConnTestCase(test.TestCase):
         # Restore FLAGS.instances_path
         FLAGS.instances_path = store
 
+    def test_create_image(self):
+        """Creates the disks of an instance from the image service"""
+        tmpdir = tempfile.mkdtemp()
+        self.flags(instances_path=tmpdir,
+                   image_service='nova.image.fake.FakeImageService')
+        commands = []
+
+        def fake_execute(*cmd, **kwargs):
+            commands.append(cmd)
+            if cmd[0] == 'mkdir':
+                os.makedirs(cmd[-1])
+            elif 'info' in cmd:
+                return 'file format: raw\n', ''
+            return '', ''
+
+        def fake_fetch(context, image_href, path, user_id, project_id):
+            # The fake image service has the metadata but no image data.
+            image_service, image_id = nova.image.get_image_service(
+                    context, image_href)
+            with open(path, 'w') as image_file:
+                image_file.write('image %s' % image_id)
+            return image_service.show(context, image_id)
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.stubs.Set(images, 'fetch', fake_fetch)
+        instance_ref = db.instance_create(self.context, self.test_instance)
+        conn = connection.LibvirtConnection(False)
+        try:
+            conn._create_image(self.context, instance_ref, '<domain/>',
+                               network_info=[])
+            base = os.path.join(tmpdir, '_base',
+                                hashlib.sha1('123456').hexdigest())
+            self.assertTrue(os.path.exists(base))
+            disk_path = os.path.join(tmpdir, instance_ref['name'], 'disk')
+            self.assertTrue([cmd for cmd in commands
+                             if cmd[:2] == ('qemu-img', 'create') and
+                                cmd[-1] == disk_path])
+        finally:
+            shutil.rmtree(tmpdir)
+            db.instance_destroy(self.context, instance_ref['id'])
+
+    def test_snapshot_skips_disks_without_source(self):
+        """Snapshots the first disk that has a source"""
+        self.flags(image_service='nova.image.fake.FakeImageService')
+        fake_xml = """
+            <domain type='kvm'>
+                <devices>
+                    <disk type='file' device='cdrom'>
+                        <target dev='hdc'/>
+                    </disk>
+                    <disk type='file' device='disk'>
+                        <source file='disk-file'/>
+                        <target dev='vda'/>
+                    </disk>
+                </devices>
+            </domain>
+        """
+        commands = []
+
+        def fake_execute(*cmd, **kwargs):
+            commands.append(cmd)
+            open(cmd[-1], 'a').close()
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        image_service = utils.import_object(FLAGS.image_service)
+        instance_ref = db.instance_create(self.context, self.test_instance)
+        recv_meta = image_service.create(self.context, {'name': 'test-snap'})
+        conn = connection.LibvirtConnection(False)
+        self.stubs.Set(conn, '_lookup_by_name',
+                       lambda name: FakeVirtDomain(fake_xml))
+        try:
+            conn.snapshot(self.context, instance_ref, recv_meta['id'])
+            self.assertEqual(commands[0][:2], ('qemu-img', 'convert'))
+            self.assertEqual(commands[0][-2], 'disk-file')
+        finally:
+            db.instance_destroy(self.context, instance_ref['id'])
+
+    def test_pre_block_migration_waits_for_all_fetches(self):
+        """A failed fetch is raised only once the others have finished"""
+        tmpdir = tempfile.mkdtemp()
+        self.flags(instances_path=tmpdir)
+        instance_ref = db.instance_create(self.context, self.test_instance)
+        finished = []
+
+        def fake_cache_base_image(fn, fname, **kwargs):
+            if fname == 'bad':
+                raise exception.ImageNotFound(image_id=fname)
+            eventlet.sleep(0.01)
+            finished.append(fname)
+
+        conn = connection.LibvirtConnection(False)
+        self.stubs.Set(conn, '_cache_base_image', fake_cache_base_image)
+        disk_info = [{'path': 'disk', 'local_gb': '10G', 'type': 'qcow2',
+                      'backing_file': name} for name in ('bad', 'good')]
+        try:
+            self.assertRaises(exception.ImageNotFound,
+                              conn.pre_block_migration, self.context,
+                              instance_ref, utils.dumps(disk_info))
+            self.assertEqual(finished, ['good'])
+        finally:
+            shutil.rmtree(tmpdir)
+            db.instance_destroy(self.context, instance_ref['id'])
+
     def test_get_instance_disk_info_works_correctly(self):
         """Confirms pre_block_migration works correctly."""
         # Skip if non-libvirt environment
@@ -924,7 +1677,11 @@ class LibvirtConnTestCase(test.TestCase):
 
         # Preparing mocks
         vdmock = self.mox.CreateMock(libvirt.virDomain)
+        self.mox.StubOutWithMock(vdmock, "UUIDString")
+        self.mox.StubOutWithMock(vdmock, "ID")
         self.mox.StubOutWithMock(vdmock, "XMLDesc")
+        vdmock.UUIDString().AndReturn('fake-uuid')
+        vdmock.ID().AndReturn(1)
         vdmock.XMLDesc(0).AndReturn(dummyxml)
 
         def fake_lookup(instance_name):
@@ -1256,6 +2013,7 @@ class IptablesFirewallTestCase(test.TestCase):
 
         from nova.network import linux_net
         linux_net.iptables_manager.execute = fake_iptables_execute
+        linux_net.iptables_manager.resync()
 
         network_info = _fake_network_info(self.stubs, 1)
         self.stubs.Set(db, 'instance_get_fixed_addresses', get_fixed_ips)
@@ -0,0 +1,150 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Unit Tests for the base manager classes
+"""
+
+import eventlet
+from eventlet import event
+
+from nova import context
+from nova import manager
+from nova import test
+from nova.scheduler import api as scheduler_api
+
+
+class FakeManager(manager.Manager):
+    def __init__(self, *args, **kwargs):
+        self.calls = []
+        super(FakeManager, self).__init__(*args, **kwargs)
+
+    @manager.periodic_task
+    def _every_tick(self, context):
+        self.calls.append('every_tick')
+
+    @manager.periodic_task(interval=600)
+    def _slow(self, context):
+        self.calls.append('slow')
+
+    @manager.periodic_task(interval=600)
+    def _broken(self, context):
+        raise Exception('boom')
+
+
+class PeriodicTaskTestCase(test.TestCase):
+    """Test scheduling of periodic tasks"""
+
+    def setUp(self):
+        super(PeriodicTaskTestCase, self).setUp()
+        self.flags(periodic_task_jitter=0)
+        self.context = context.get_admin_context()
+
+    def test_tasks_run_at_their_interval(self):
+        fake_manager = FakeManager(host='host1')
+        errors = fake_manager.periodic_tasks(self.context)
+        fake_manager.periodic_tasks(self.context)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(sorted(fake_manager.calls),
+                         ['every_tick', 'every_tick', 'slow'])
+        stats = fake_manager.get_periodic_task_stats(self.context)
+        self.assertEqual(stats['_every_tick']['runs'], 2)
+        self.assertEqual(stats['_slow']['runs'], 1)
+        self.assertEqual(stats['_broken']['failures'], 1)
+
+    def test_interval_override(self):
+        self.flags(periodic_task_intervals=['_every_tick=-1', '_slow=0'])
+        fake_manager = FakeManager(host='host1')
+        fake_manager.periodic_tasks(self.context)
+        fake_manager.periodic_tasks(self.context)
+        self.assertEqual(fake_manager.calls, ['slow', 'slow'])
+
+    def test_invalid_interval_override_uses_default(self):
+        self.flags(periodic_task_intervals=['_slow=often'])
+        fake_manager = FakeManager(host='host1')
+        fake_manager.periodic_tasks(self.context)
+        fake_manager.periodic_tasks(self.context)
+        self.assertEqual(sorted(fake_manager.calls),
+                         ['every_tick', 'every_tick', 'slow'])
+        stats = fake_manager.get_periodic_task_stats(self.context)
+        self.assertEqual(stats['_slow']['interval'], 600)
+
+    def test_running_task_is_skipped(self):
+        fake_manager = FakeManager(host='host1')
+        release = event.Event()
+        self.stubs.Set(fake_manager, '_every_tick',
+                       lambda context: release.wait())
+        fake_manager.run_periodic_tasks(self.context)
+        fake_manager.periodic_tasks(self.context)
+        stats = fake_manager.get_periodic_task_stats(self.context)
+        self.assertTrue(stats['_every_tick']['running'])
+        self.assertEqual(stats['_every_tick']['skips'], 1)
+        release.send()
+        eventlet.sleep(0)
+        fake_manager.periodic_tasks(self.context)
+        stats = fake_manager.get_periodic_task_stats(self.context)
+        self.assertEqual(stats['_every_tick']['runs'], 2)
+
+
+class SchedulerDependentManagerTestCase(test.TestCase):
+    """Test capability publishing to the schedulers"""
+
+    def setUp(self):
+        super(SchedulerDependentManagerTestCase, self).setUp()
+        self.flags(capability_snapshot_interval=2)
+        self.published = []
+
+        def fake_update(context, service_name, host, capabilities,
+                        seq=None, delta=False, removed=None):
+            self.published.append((capabilities, seq, delta, removed))
+
+        self.stubs.Set(scheduler_api, 'update_service_capabilities',
+                       fake_update)
+        self.manager = manager.SchedulerDependentManager(
+                host='host1', service_name='compute')
+        self.context = context.get_admin_context()
+
+    def test_nothing_published_without_capabilities(self):
+        self.manager.periodic_tasks(self.context)
+        self.assertEqual(self.published, [])
+
+    def test_deltas_between_snapshots(self):
+        self.manager.update_service_capabilities(dict(a=1, b=2, c=3))
+        self.manager.periodic_tasks(self.context)
+        self.manager.update_service_capabilities(dict(a=1, b=5))
+        self.manager.periodic_tasks(self.context)
+        self.manager.periodic_tasks(self.context)
+        self.manager.periodic_tasks(self.context)
+        self.assertEqual(self.published,
+                         [(dict(a=1, b=2, c=3), 1, False, None),
+                          (dict(b=5), 2, True, ['c']),
+                          ({}, 3, True, []),
+                          (dict(a=1, b=5), 4, False, None)])
+
+    def test_changes_in_place_are_seen(self):
+        caps = dict(stats=dict(free=10))
+        self.manager.update_service_capabilities(caps)
+        self.manager.periodic_tasks(self.context)
+        caps['stats']['free'] = 5
+        self.manager.periodic_tasks(self.context)
+        self.assertEqual(self.published[1],
+                         (dict(stats=dict(free=5)), 2, True, []))
+
+    def test_resync_sends_snapshot(self):
+        self.manager.update_service_capabilities(dict(a=1, b=2))
+        self.manager.periodic_tasks(self.context)
+        self.manager.resync_service_capabilities(self.context)
+        self.manager.periodic_tasks(self.context)
+        self.assertEqual(self.published[1], (dict(a=1, b=2), 2, False, None))
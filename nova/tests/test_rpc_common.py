@@ -19,8 +19,13 @@
 Unit Tests for remote procedure calls shared between all implementations
 """
 
+import eventlet
+from eventlet import event
+
 from nova import context
 from nova import log as logging
+from nova.rpc import common as rpc_common
+from nova.rpc import metrics
 from nova.rpc.common import RemoteError
 from nova import test
 
@@ -90,6 +95,14 @@ class _BaseRpcTestCase(test.TestCase):
         for i, x in enumerate(result):
             self.assertEqual(value + i, x)
 
+    def test_call_records_metrics(self):
+        metrics.reset()
+        self.rpc.call(self.context, 'test', {"method": "echo",
+                                             "args": {"value": 42}})
+        recorded = metrics.get_metrics()
+        self.assertEqual(recorded['queue']['test']['echo']['count'], 1)
+        self.assertEqual(recorded['handler']['test']['echo']['count'], 1)
+
     def test_context_passed(self):
         """Makes sure a context is passed through rpc call."""
         value = 42
@@ -122,6 +135,56 @@ class _BaseRpcTestCase(test.TestCase):
         except RemoteError as exc:
             self.assertEqual(int(exc.value), value)
 
+    def test_scatter_gather(self):
+        conn = self.rpc.create_connection(True)
+        conn.create_consumer('test.other', TestReceiver(), False)
+        conn.consume_in_thread()
+        value = 42
+        result = self.rpc.scatter_gather(self.context,
+                                         ['test', 'test.other'],
+                                         {"method": "echo_three_times",
+                                          "args": {"value": value}},
+                                         timeout=10)
+        replies = dict(result)
+        conn.close()
+        self.assertEqual(replies, {'test': value + 2,
+                                   'test.other': value + 2})
+        self.assertEqual(result.timed_out, [])
+
+    def test_scatter_gather_exception(self):
+        value = 42
+        result = self.rpc.scatter_gather(self.context, ['test'],
+                                         {"method": "fail",
+                                          "args": {"value": value}},
+                                         timeout=10)
+        replies = dict(result)
+        self.assertTrue(isinstance(replies['test'], RemoteError))
+        self.assertEqual(int(replies['test'].value), value)
+
+    def test_scatter_gather_timeout(self):
+        value = 42
+        result = self.rpc.scatter_gather(self.context,
+                                         ['test', 'test.nobody'],
+                                         {"method": "echo",
+                                          "args": {"value": value}},
+                                         timeout=10,
+                                         target_timeout={'test.nobody': 0.5})
+        replies = list(result)
+        self.assertEqual(replies[0], ('test', value))
+        self.assertEqual(replies[1][0], 'test.nobody')
+        self.assertTrue(isinstance(replies[1][1], rpc_common.Timeout))
+        self.assertEqual(result.timed_out, ['test.nobody'])
+
+    def test_scatter_gather_close(self):
+        """A waiter closed before any reply is read yields nothing."""
+        result = self.rpc.scatter_gather(self.context, ['test'],
+                                         {"method": "echo",
+                                          "args": {"value": 42}},
+                                         timeout=10)
+        result.close()
+        result.close()
+        self.assertEqual(list(result), [])
+
     def test_nested_calls(self):
         """Test that we can do an rpc.call inside another call."""
         class Nested(object):
@@ -187,3 +250,76 @@ class TestReceiver(object):
     def fail(context, value):
         """Raises an exception with the value sent in."""
         raise Exception(value)
+
+
+class DispatchPoolTestCase(test.TestCase):
+    """Test the lanes and limits rpc handlers are dispatched through."""
+
+    class Proxy(object):
+        rpc_priority_methods = ('fast',)
+        rpc_method_concurrency = {'slow': 1}
+
+    def setUp(self):
+        super(DispatchPoolTestCase, self).setUp()
+        self.flags(rpc_thread_pool_size=2)
+        self.pool = rpc_common.DispatchPool(self.Proxy())
+        self.release = event.Event()
+        self.ran = []
+
+    def _handler(self, name):
+        self.ran.append(name)
+        self.release.wait()
+
+    def test_method_concurrency_limit(self):
+        for i in range(3):
+            self.pool.dispatch('slow', self._handler, 'slow')
+        eventlet.sleep(0)
+        self.assertEqual(self.ran, ['slow'])
+        stats = self.pool.get_stats()['slow']
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['queued'], 2)
+
+        self.release.send()
+        eventlet.sleep(0.1)
+        self.assertEqual(self.ran, ['slow', 'slow', 'slow'])
+        stats = self.pool.get_stats()['slow']
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['calls'], 3)
+
+    def test_priority_lane_not_blocked_by_full_pool(self):
+        self.pool.dispatch('other', self._handler, 'other')
+        self.pool.dispatch('other', self._handler, 'other')
+        self.pool.dispatch('other', self._handler, 'other')
+        self.pool.dispatch('fast', self.ran.append, 'fast')
+        eventlet.sleep(0)
+        self.assertEqual(self.ran, ['other', 'other', 'fast'])
+        self.assertEqual(self.pool.get_stats()['other']['queued'], 1)
+        self.release.send()
+
+    def test_priority_lane_not_blocked_by_full_backlog(self):
+        self.flags(rpc_backlog_size=1)
+        pool = rpc_common.DispatchPool(self.Proxy())
+        for i in range(3):
+            self.assertTrue(pool.dispatch('other', self._handler, 'other'))
+        # The normal backlog is now full, so one more normal message is
+        # turned away, but a priority message still runs.
+        self.assertFalse(pool.dispatch('other', self._handler, 'other'))
+        self.assertTrue(pool.dispatch('fast', self.ran.append, 'fast'))
+        eventlet.sleep(0)
+        self.assertEqual(self.ran, ['other', 'other', 'fast'])
+        self.release.send()
+
+    def test_consumers_of_a_proxy_share_a_pool(self):
+        proxy = self.Proxy()
+        pool = rpc_common.get_dispatch_pool(proxy)
+        self.assertTrue(rpc_common.get_dispatch_pool(proxy) is pool)
+        self.assertFalse(rpc_common.get_dispatch_pool(self.Proxy()) is pool)
+
+    def test_get_dispatch_stats(self):
+        pools = [rpc_common.get_dispatch_pool(self.Proxy()) for i in range(2)]
+        for pool in pools:
+            pool.dispatch('fast', self.ran.append, 'fast')
+        eventlet.sleep(0)
+        stats = rpc_common.get_dispatch_stats()['fast']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['running'], 0)
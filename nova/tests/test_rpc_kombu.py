@@ -47,6 +47,17 @@ class RpcKombuTestCase(test_rpc_common._BaseRpcTestCase):
         conn_context.close()
         self.assertEqual(conn1, conn2)
 
+    def test_scatter_gather_close_releases_connection(self):
+        """Closing a waiter puts its connection back in the pool."""
+        free = impl_kombu.ConnectionPool.free()
+        result = self.rpc.scatter_gather(self.context, ['test'],
+                                         {"method": "echo",
+                                          "args": {"value": 42}},
+                                         timeout=10)
+        self.assertEqual(impl_kombu.ConnectionPool.free(), free - 1)
+        result.close()
+        self.assertEqual(impl_kombu.ConnectionPool.free(), free)
+
     def test_topic_send_receive(self):
         """Test sending to a topic exchange/queue"""
 
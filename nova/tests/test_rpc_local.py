@@ -0,0 +1,128 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Unit Tests for remote procedure calls using the in-process backend
+"""
+
+import datetime
+
+from eventlet import event
+from eventlet import queue
+
+from nova import log as logging
+from nova.rpc import impl_local
+from nova.tests import test_rpc_common
+
+
+LOG = logging.getLogger('nova.tests.rpc')
+
+
+class RpcLocalTestCase(test_rpc_common._BaseRpcTestCase):
+    def setUp(self):
+        self.rpc = impl_local
+        super(RpcLocalTestCase, self).setUp()
+
+    def tearDown(self):
+        super(RpcLocalTestCase, self).tearDown()
+        impl_local.reset_all()
+
+    def test_cast_before_consumer(self):
+        """A cast is held until a consumer for its topic shows up."""
+        received = queue.LightQueue()
+
+        class Receiver(object):
+            @staticmethod
+            def echo(context, value):
+                received.put(value)
+
+        self.rpc.cast(self.context, 'late', {"method": "echo",
+                                             "args": {"value": 42}})
+        conn = self.rpc.create_connection(True)
+        conn.create_consumer('late', Receiver(), False)
+        conn.consume_in_thread()
+        self.assertEqual(received.get(timeout=5), 42)
+        conn.close()
+
+    def test_full_backlog_does_not_hold_up_priority(self):
+        """Priority casts are read while the normal backlog is full."""
+        self.flags(rpc_thread_pool_size=1, rpc_backlog_size=1)
+        release = event.Event()
+        received = queue.LightQueue()
+
+        class Receiver(object):
+            rpc_priority_methods = ('fast',)
+
+            @staticmethod
+            def slow(context, value):
+                received.put(value)
+                release.wait()
+
+            @staticmethod
+            def fast(context, value):
+                received.put(value)
+
+        conn = self.rpc.create_connection(True)
+        conn.create_consumer('lanes', Receiver(), False)
+        conn.consume_in_thread()
+        # One slow cast runs, one waits in the backlog and the third is
+        # turned away, which must not stop the consumer reading.
+        for value in range(3):
+            self.rpc.cast(self.context, 'lanes', {"method": "slow",
+                                                  "args": {"value": value}})
+        self.rpc.cast(self.context, 'lanes', {"method": "fast",
+                                              "args": {"value": 'fast'}})
+        self.assertEqual(received.get(timeout=5), 0)
+        self.assertEqual(received.get(timeout=5), 'fast')
+
+        release.send()
+        self.assertEqual(sorted([received.get(timeout=5),
+                                 received.get(timeout=5)]), [1, 2])
+        conn.close()
+
+    def test_fanout_cast(self):
+        received = queue.LightQueue()
+
+        class Receiver(object):
+            @staticmethod
+            def echo(context, value):
+                received.put(value)
+
+        conns = []
+        for i in range(2):
+            conn = self.rpc.create_connection(True)
+            conn.create_consumer('fan', Receiver(), True)
+            conn.consume_in_thread()
+            conns.append(conn)
+        self.rpc.fanout_cast(self.context, 'fan', {"method": "echo",
+                                                   "args": {"value": 42}})
+        self.assertEqual(received.get(timeout=5), 42)
+        self.assertEqual(received.get(timeout=5), 42)
+        for conn in conns:
+            conn.close()
+        self.assertEqual(impl_local.FANOUTS['fan'], [])
+
+    def test_call_serializes_by_default(self):
+        now = datetime.datetime(2011, 1, 1, 12, 0, 0)
+        result = self.rpc.call(self.context, 'test', {"method": "echo",
+                                                      "args": {"value": now}})
+        self.assertEqual(result, '2011-01-01 12:00:00')
+
+    def test_call_without_serialization(self):
+        self.flags(rpc_local_serialize=False)
+        now = datetime.datetime(2011, 1, 1, 12, 0, 0)
+        result = self.rpc.call(self.context, 'test', {"method": "echo",
+                                                      "args": {"value": now}})
+        self.assertEqual(result, now)
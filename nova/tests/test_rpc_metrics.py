@@ -0,0 +1,80 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Unit Tests for rpc latency histograms
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from nova import test
+from nova.rpc import metrics
+
+
+class RpcMetricsTestCase(test.TestCase):
+    def setUp(self):
+        super(RpcMetricsTestCase, self).setUp()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        super(RpcMetricsTestCase, self).tearDown()
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram()
+        histogram.record(0.0005)
+        histogram.record(0.001)
+        histogram.record(0.3)
+        histogram.record(100)
+        result = histogram.to_dict()
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(result['max'], 100)
+        self.assertEqual(result['counts'][0], 2)
+        self.assertEqual(result['counts'][metrics.BUCKETS.index(0.5)], 1)
+        self.assertEqual(result['counts'][-1], 1)
+        self.assertEqual(len(result['counts']), len(result['buckets']) + 1)
+
+    def test_record_by_kind_topic_and_method(self):
+        metrics.record('handler', 'compute.host1', 'run_instance', 2.0)
+        metrics.record('handler', 'compute.host1', 'run_instance', 3.0)
+        metrics.record('queue', 'compute', 'get_lock', 0.01)
+        result = metrics.get_metrics()
+        run = result['handler']['compute.host1']['run_instance']
+        self.assertEqual(run['count'], 2)
+        self.assertEqual(run['sum'], 5.0)
+        self.assertEqual(result['queue']['compute']['get_lock']['count'], 1)
+        self.assertEqual(result['call'], {})
+
+    def test_record_disabled(self):
+        self.flags(rpc_metrics=False)
+        metrics.record('handler', 'compute', 'run_instance', 2.0)
+        self.assertEqual(metrics.get_metrics()['handler'], {})
+
+    def test_dump(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'rpc_metrics.json')
+            metrics.record('call', 'network', 'allocate_for_instance', 0.2)
+            metrics.dump(path)
+            with open(path) as f:
+                dumped = json.load(f)
+            call = dumped['call']['network']['allocate_for_instance']
+            self.assertEqual(call['count'], 1)
+            self.assertFalse(os.path.exists('%s.tmp' % path))
+        finally:
+            shutil.rmtree(tmpdir)
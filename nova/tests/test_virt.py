@@ -15,9 +15,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+import os
+import shutil
+import StringIO
+import tempfile
+
+import eventlet
+
+from nova import exception
 from nova import flags
+import nova.image
 from nova import test
+from nova import utils
+from nova.virt import disk
 from nova.virt import driver
+from nova.virt import images
 
 FLAGS = flags.FLAGS
 
@@ -81,3 +94,152 @@ class TestVirtDriver(test.TestCase):
                                                 'swap_size': 0}))
         self.assertTrue(driver.swap_is_usable({'device_name': '/dev/sdb',
                                                 'swap_size': 1}))
+
+
+class TestDisk(test.TestCase):
+    def test_clone_copies_sparse(self):
+        commands = []
+        self.stubs.Set(utils, 'execute', lambda *cmd: commands.append(cmd))
+        disk.clone('base', 'disk')
+        self.assertEqual(commands, [('cp', '--reflink=auto',
+                                     '--sparse=always', 'base', 'disk')])
+
+    def test_clone_falls_back_to_plain_copy(self):
+        commands = []
+
+        def fake_execute(*cmd):
+            commands.append(cmd)
+            if '--reflink=auto' in cmd:
+                raise exception.ProcessExecutionError()
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        disk.clone('base', 'disk')
+        self.assertEqual(commands[-1], ('cp', 'base', 'disk'))
+
+
+class TestNbdPool(test.TestCase):
+    def setUp(self):
+        super(TestNbdPool, self).setUp()
+        self.flags(nbd_reap_leaked_devices=False, instances_path='/instances')
+        self.pool = disk.NbdPool(1)
+        self.pids = {}
+        self.commands = []
+        self.stubs.Set(self.pool, '_pid', self.pids.get)
+        self.stubs.Set(utils, 'execute', self.fake_execute)
+
+    def fake_execute(self, *cmd, **kwargs):
+        self.commands.append(cmd)
+        if cmd[:2] == ('qemu-nbd', '-c'):
+            self.pids[cmd[2]] = 1234
+        elif cmd[:2] == ('qemu-nbd', '-d'):
+            self.pids.pop(cmd[2], None)
+
+    def test_connect_and_disconnect(self):
+        device = self.pool.connect('disk')
+        self.assertEqual(device, '/dev/nbd0')
+        self.assertEqual(self.pool.get_stats()['in_use'], 1)
+        self.pool.disconnect(device)
+        self.assertEqual(self.pool.get_stats()['in_use'], 0)
+        self.assertEqual(self.commands[-1], ('qemu-nbd', '-d', '/dev/nbd0'))
+
+    def test_waits_for_free_device(self):
+        device = self.pool.connect('disk')
+        waiter = eventlet.spawn(self.pool.connect, 'other')
+        eventlet.sleep(0)
+        self.assertEqual(self.pool.get_stats()['waits'], 1)
+        self.pool.disconnect(device)
+        self.assertEqual(waiter.wait(), device)
+
+    def test_device_that_does_not_show_up_is_freed(self):
+        self.flags(timeout_nbd=0)
+        self.stubs.Set(utils, 'execute', lambda *cmd, **kwargs: None)
+        self.assertRaises(exception.Error, self.pool.connect, 'disk')
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.stubs.Set(utils, 'execute', self.fake_execute)
+        self.assertEqual(self.pool.connect('disk'), '/dev/nbd0')
+
+    def test_reap_leaked_devices(self):
+        self.pool = disk.NbdPool(3)
+        self.pids.update({'/dev/nbd0': 10, '/dev/nbd1': 11, '/dev/nbd2': 12})
+        cmdlines = {
+            10: ['qemu-nbd', '-c', '/dev/nbd0', '/instances/i-1/disk'],
+            11: ['qemu-nbd', '-c', '/dev/nbd1', '/instances/i-2/disk'],
+            12: ['qemu-nbd', '-c', '/dev/nbd2', '/elsewhere/disk']}
+        self.stubs.Set(self.pool, '_pid', self.pids.get)
+        self.stubs.Set(self.pool, '_cmdline', cmdlines.get)
+        self.stubs.Set(self.pool, '_mounted_devices',
+                       lambda: ['/dev/mapper/nbd1p1'])
+        self.pool.reap_leaked()
+        self.assertEqual(self.commands, [('qemu-nbd', '-d', '/dev/nbd0')])
+        self.assertEqual(self.pool.get_stats()['leaked'], 1)
+
+
+class FakeImageService(object):
+    def __init__(self, chunks, checksum):
+        self.chunks = chunks
+        self.checksum = checksum
+
+    def get(self, context, image_id, data):
+        for chunk in self.chunks:
+            data.write(chunk)
+        return {'id': image_id, 'checksum': self.checksum}
+
+
+class TestImageFetch(test.TestCase):
+    def setUp(self):
+        super(TestImageFetch, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'image')
+        self.chunks = ['a' * 3, 'b' * 7, 'c' * 5]
+        self.data = ''.join(self.chunks)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestImageFetch, self).tearDown()
+
+    def _stub_image_service(self, checksum):
+        service = FakeImageService(self.chunks, checksum)
+        self.stubs.Set(nova.image, 'get_image_service',
+                       lambda context, image_href: (service, image_href))
+
+    def test_writer_writes_aligned_blocks(self):
+        image_file = StringIO.StringIO()
+        writes = []
+        self.stubs.Set(image_file, 'write', writes.append)
+        writer = images.ImageWriter(image_file, write_size=4)
+        for chunk in self.chunks:
+            writer.write(chunk)
+        writer.flush()
+        self.assertEqual([len(data) % 4 for data in writes[:-1]],
+                         [0] * (len(writes) - 1))
+        self.assertEqual(''.join(writes), self.data)
+        self.assertEqual(writer.size, len(self.data))
+        self.assertEqual(writer.md5.hexdigest(),
+                         hashlib.md5(self.data).hexdigest())
+
+    def test_upload_reader_caps_reads(self):
+        reader = images.UploadReader(StringIO.StringIO(self.data), '1',
+                                     len(self.data), chunk_size=4)
+        chunks = []
+        while True:
+            chunk = reader.read(1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(max(len(chunk) for chunk in chunks), 4)
+        self.assertEqual(''.join(chunks), self.data)
+        self.assertEqual(reader.size, len(self.data))
+
+    def test_fetch_verifies_checksum(self):
+        self._stub_image_service(hashlib.md5(self.data).hexdigest())
+        images.fetch(None, '1', self.path, None, None)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_fetch_rejects_bad_checksum(self):
+        self._stub_image_service('0' * 32)
+        self.assertRaises(exception.ImageUnacceptable, images.fetch,
+                          None, '1', self.path, None, None)
+        self.assertFalse(os.path.exists(self.path))
@@ -24,7 +24,9 @@ from nova import flags
 from nova import image
 from nova import log as logging
 from nova import test
+from nova.compute import power_state
 from nova.tests import utils as test_utils
+from nova.virt import driver
 
 libvirt = None
 FLAGS = flags.FLAGS
@@ -83,6 +85,27 @@ class _VirtDriverTestCase(test.TestCase):
         domains_details = self.connection.list_instances_detail()
         self.assertIn(instance_ref['name'], [i.name for i in domains_details])
 
+    @catch_notimplementederror
+    def test_power_state_poller(self):
+        instance_ref = test_utils.get_test_instance()
+        network_info = test_utils.get_test_network_info()
+        self.connection.destroy(instance_ref, network_info)
+        events = []
+
+        def fake_callback(name, state):
+            events.append((name, state))
+
+        poller = driver.PowerStatePoller(self.connection, fake_callback)
+        poller.poll()
+        self.connection.spawn(self.ctxt, instance_ref, network_info)
+        poller.poll()
+        poller.poll()
+        self.connection.destroy(instance_ref, network_info)
+        poller.poll()
+        self.assertEqual(events,
+                         [(instance_ref['name'], power_state.RUNNING),
+                          (instance_ref['name'], power_state.NOSTATE)])
+
     @catch_notimplementederror
     def test_snapshot_not_running(self):
         instance_ref = test_utils.get_test_instance()
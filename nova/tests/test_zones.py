@@ -104,6 +104,41 @@ class ZoneManagerTestCase(test.TestCase):
                                      svc1_c=(5, 5), svc10_a=(99, 99),
                                      svc10_b=(99, 99)))
 
+    def test_service_capabilities_delta(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2, c=3),
+                                       seq=1)
+        needs_resync = zm.update_service_capabilities("svc1", "host1",
+                                                      dict(b=5), seq=2,
+                                                      delta=True,
+                                                      removed=['c'])
+        self.assertFalse(needs_resync)
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(1, 1), svc1_b=(5, 5)))
+
+    def test_service_capabilities_delta_gap(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1), seq=1)
+        self.assertTrue(zm.update_service_capabilities(
+                "svc1", "host1", dict(a=3), seq=3, delta=True))
+        # Only ask once per gap, and drop deltas until a snapshot arrives
+        self.assertFalse(zm.update_service_capabilities(
+                "svc1", "host1", dict(a=4), seq=4, delta=True))
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(1, 1)))
+
+        zm.update_service_capabilities("svc1", "host1", dict(a=5), seq=5)
+        self.assertFalse(zm.update_service_capabilities(
+                "svc1", "host1", dict(a=6), seq=6, delta=True))
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(6, 6)))
+
+    def test_service_capabilities_delta_unknown_host(self):
+        zm = zone_manager.ZoneManager()
+        self.assertTrue(zm.update_service_capabilities(
+                "svc1", "host1", dict(a=3), seq=7, delta=True))
+        self.assertEquals(zm.get_zone_capabilities(None), {})
+
     def test_refresh_from_db_replace_existing(self):
         zm = zone_manager.ZoneManager()
         zone_state = zone_manager.ZoneState()
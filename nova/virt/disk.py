@@ -30,6 +30,8 @@ import os
 import tempfile
 import time
 
+from eventlet import semaphore
+
 from nova import context
 from nova import db
 from nova import exception
@@ -51,6 +53,9 @@ flags.DEFINE_integer('timeout_nbd', 10,
                      'time to wait for a NBD device coming up')
 flags.DEFINE_integer('max_nbd_devices', 16,
                      'maximum number of possible nbd devices')
+flags.DEFINE_boolean('nbd_reap_leaked_devices', True,
+                     'Disconnect nbd devices that qemu-nbd left attached to'
+                     ' instance disks when nova-compute stopped uncleanly')
 
 # NOTE(yamahata): DEFINE_list() doesn't work because the command may
 #                 include ','. For example,
@@ -94,6 +99,22 @@ def mkfs(os_type, fs_label, target):
         utils.execute(*mkfs_command.split())
 
 
+def clone(src, dest):
+    """Copy a disk image without copying its unallocated blocks.
+
+    cp --reflink=auto shares the blocks of src with dest on filesystems
+    that can (btrfs, XFS with reflinks, OCFS2).  Elsewhere it copies only
+    the data regions of src, and --sparse=always keeps any hole in src a
+    hole in dest, so a mostly empty image copies in a fraction of its size.
+    """
+    try:
+        utils.execute('cp', '--reflink=auto', '--sparse=always', src, dest)
+    except exception.ProcessExecutionError:
+        # NOTE: cp older than coreutils 7.5 does not know --reflink.
+        LOG.warn(_('Sparse copy of %s failed, copying it in full'), src)
+        utils.execute('cp', src, dest)
+
+
 def extend(image, size):
     """Increase image to size"""
     file_size = os.path.getsize(image)
@@ -206,15 +227,7 @@ def _link_device(image, nbd):
     """Link image to device using loopback or nbd"""
 
     if nbd:
-        device = _allocate_device()
-        utils.execute('qemu-nbd', '-c', device, image, run_as_root=True)
-        # NOTE(vish): this forks into another process, so give it a chance
-        #             to set up before continuuing
-        for i in xrange(FLAGS.timeout_nbd):
-            if os.path.exists("/sys/block/%s/pid" % os.path.basename(device)):
-                return device
-            time.sleep(1)
-        raise exception.Error(_('nbd device %s did not show up') % device)
+        return _get_nbd_pool().connect(image)
     else:
         out, err = utils.execute('losetup', '--find', '--show', image,
                                  run_as_root=True)
@@ -227,31 +240,165 @@ def _link_device(image, nbd):
 def _unlink_device(device, nbd):
     """Unlink image from device using loopback or nbd"""
     if nbd:
-        utils.execute('qemu-nbd', '-d', device, run_as_root=True)
-        _free_device(device)
+        _get_nbd_pool().disconnect(device)
     else:
         utils.execute('losetup', '--detach', device, run_as_root=True)
 
 
-_DEVICES = ['/dev/nbd%s' % i for i in xrange(FLAGS.max_nbd_devices)]
+class NbdPool(object):
+    """Hands out the nbd devices of this host.
+
+    Free and in use devices are tracked in memory, and a caller waits
+    for a device to come free rather than failing while all of them are
+    in use, so up to --max_nbd_devices injections run at once.  A device
+    is connected once qemu-nbd has forked and its pid shows up in sysfs,
+    which is polled every POLL_INTERVAL seconds.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, size):
+        self.devices = ['/dev/nbd%s' % i for i in xrange(size)]
+        self._free = list(reversed(self.devices))
+        self._in_use = {}
+        self._semaphore = semaphore.Semaphore(size)
+        self._reaped = False
+        self.connects = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.leaked = 0
+
+    @staticmethod
+    def _pid(device):
+        """Return the pid of the qemu-nbd serving device, or None."""
+        try:
+            with open('/sys/block/%s/pid' % os.path.basename(device)) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def _cmdline(pid):
+        try:
+            with open('/proc/%d/cmdline' % pid) as f:
+                return f.read().split('\0')
+        except IOError:
+            return []
+
+    @staticmethod
+    def _mounted_devices():
+        with open('/proc/mounts') as f:
+            return [line.split()[0] for line in f if line.strip()]
+
+    def reap_leaked(self):
+        """Disconnect devices left attached to instance disks by a crash.
+
+        Only devices served by a qemu-nbd of an image under
+        --instances_path that nothing has mounted are disconnected.
+        """
+        mounted = self._mounted_devices()
+        for device in self.devices:
+            pid = self._pid(device)
+            if device in self._in_use or pid is None:
+                continue
+            cmdline = self._cmdline(pid)
+            if not cmdline or 'qemu-nbd' not in os.path.basename(cmdline[0]):
+                continue
+            if not any(arg.startswith(FLAGS.instances_path)
+                       for arg in cmdline[1:]):
+                continue
+            partitions = '/dev/mapper/%sp' % os.path.basename(device)
+            if any(mount == device or mount.startswith(partitions)
+                   for mount in mounted):
+                continue
+            LOG.warn(_('Disconnecting leaked nbd device %s'), device)
+            try:
+                utils.execute('qemu-nbd', '-d', device, run_as_root=True)
+                self.leaked += 1
+            except exception.ProcessExecutionError, e:
+                LOG.warn(_('Failed to disconnect %(device)s: %(e)s'),
+                         locals())
+
+    def _acquire(self):
+        if not self._reaped and FLAGS.nbd_reap_leaked_devices:
+            self._reaped = True
+            self.reap_leaked()
+        if self._semaphore.locked():
+            self.waits += 1
+            started = time.time()
+            self._semaphore.acquire()
+            self.wait_time += time.time() - started
+        else:
+            self._semaphore.acquire()
+        # Devices other tools connected are skipped but stay free, so
+        # they are tried again next time.
+        for device in reversed(self._free):
+            if self._pid(device) is None:
+                self._free.remove(device)
+                return device
+        self._semaphore.release()
+        raise exception.Error(_('No free nbd devices'))
+
+    def _release(self, device):
+        if self._in_use.pop(device, None) is None:
+            return
+        self._free.append(device)
+        self._semaphore.release()
+
+    def connect(self, image):
+        """Connect image to a free nbd device and return the device."""
+        device = self._acquire()
+        self._in_use[device] = image
+        try:
+            utils.execute('qemu-nbd', '-c', device, image, run_as_root=True)
+            # qemu-nbd forks into another process, so give it a chance
+            # to set up before continuing.
+            deadline = time.time() + FLAGS.timeout_nbd
+            while self._pid(device) is None:
+                if time.time() > deadline:
+                    self.timeouts += 1
+                    raise exception.Error(_('nbd device %s did not show up')
+                                          % device)
+                time.sleep(self.POLL_INTERVAL)
+        except Exception:
+            if self._pid(device) is None:
+                self._release(device)
+            else:
+                self.disconnect(device)
+            raise
+        self.connects += 1
+        return device
+
+    def disconnect(self, device):
+        try:
+            utils.execute('qemu-nbd', '-d', device, run_as_root=True)
+        finally:
+            self._release(device)
+
+    def get_stats(self):
+        return {'size': len(self.devices),
+                'in_use': len(self._in_use),
+                'connects': self.connects,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+                'leaked': self.leaked}
+
 
+_NBD_POOL = None
 
-def _allocate_device():
-    # NOTE(vish): This assumes no other processes are allocating nbd devices.
-    #             It may race cause a race condition if multiple
-    #             workers are running on a given machine.
 
-    while True:
-        if not _DEVICES:
-            raise exception.Error(_('No free nbd devices'))
-        device = _DEVICES.pop()
-        if not os.path.exists("/sys/block/%s/pid" % os.path.basename(device)):
-            break
-    return device
+def _get_nbd_pool():
+    global _NBD_POOL
+    if _NBD_POOL is None:
+        _NBD_POOL = NbdPool(FLAGS.max_nbd_devices)
+    return _NBD_POOL
 
 
-def _free_device(device):
-    _DEVICES.append(device)
+def get_nbd_stats():
+    """Return the counters of the nbd device pool."""
+    return _get_nbd_pool().get_stats()
 
 
 def inject_data_into_fs(fs, key, net, metadata, execute):
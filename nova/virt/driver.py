@@ -22,9 +22,20 @@ Driver base-classes:
     types that support that contract
 """
 
+from nova import flags
+from nova import log as logging
+from nova import utils
 from nova.compute import power_state
 
 
+LOG = logging.getLogger('nova.virt.driver')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('driver_event_poll_interval', 20,
+                     'Seconds between polls of the hypervisor for power '
+                     'state changes, for drivers without native events')
+
+
 class InstanceInfo(object):
     def __init__(self, name, state):
         self.name = name
@@ -59,6 +70,48 @@ def block_device_info_get_mapping(block_device_info):
     return block_device_mapping
 
 
+class PowerStatePoller(object):
+    """Reports power state changes by diffing list_instances_detail.
+
+    The first poll only records a baseline.  After that callback is
+    called as callback(instance_name, state) for every instance whose
+    state differs from the previous poll, and with power_state.NOSTATE
+    for instances that have disappeared.
+
+    """
+
+    def __init__(self, driver, callback):
+        self.driver = driver
+        self.callback = callback
+        self.states = None
+        self._loop = None
+
+    def poll(self):
+        try:
+            infos = self.driver.list_instances_detail()
+        except Exception:
+            LOG.exception(_('Error polling for power state changes'))
+            return
+        states = dict((info.name, info.state) for info in infos)
+        if self.states is not None:
+            for name, state in states.iteritems():
+                if self.states.get(name) != state:
+                    self.callback(name, state)
+            for name in self.states:
+                if name not in states:
+                    self.callback(name, power_state.NOSTATE)
+        self.states = states
+
+    def start(self, interval):
+        self._loop = utils.LoopingCall(self.poll)
+        self._loop.start(interval=interval, now=True)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+
 class ComputeDriver(object):
     """Base class for compute drivers.
 
@@ -100,6 +153,20 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def register_event_listener(self, callback):
+        """Report instance power state changes to callback.
+
+        callback is called from a greenthread as callback(instance_name,
+        state), where state is one of the power_state codes and NOSTATE
+        means the instance no longer exists on the hypervisor.
+
+        Drivers that can subscribe to hypervisor events override this.
+        The default polls list_instances_detail every
+        --driver_event_poll_interval seconds.
+        """
+        self._event_poller = PowerStatePoller(self, callback)
+        self._event_poller.start(FLAGS.driver_event_poll_interval)
+
     def get_info(self, instance_name):
         """Get the current status of an instance, by name (not ID!)
 
@@ -150,6 +217,45 @@ class ComputeDriver(object):
         """
         raise NotImplementedError()
 
+    def get_call_stats(self):
+        """Return latency counters of calls into the hypervisor by method.
+
+        Drivers that do not keep them return an empty dict.
+        """
+        return {}
+
+    def get_migration_progress(self):
+        """Return the progress of running migrations by instance name.
+
+        Drivers that do not track it return an empty dict.
+        """
+        return {}
+
+    def get_nbd_stats(self):
+        """Return the counters of the nbd devices used to edit images.
+
+        Drivers that do not use nbd devices return an empty dict.
+        """
+        return {}
+
+    def manage_image_cache(self, context, instances, dry_run=False):
+        """Remove images from the local cache that no instance uses.
+
+        instances are the instances on this host.  If dry_run is True,
+        only report what would be removed.  Returns a dict describing
+        the cache, or None for drivers without a local image cache.
+        """
+        pass
+
+    def cache_image(self, context, instance, block_device_info=None):
+        """Fetch the images instance boots from into the local cache.
+
+        Called before spawn so image downloads can be limited separately
+        from spawning.  Drivers without a local image cache need not do
+        anything; spawn must still work if this was never called.
+        """
+        pass
+
     def destroy(self, instance, network_info, block_device_info=None,
                 cleanup=True):
         """Destroy (shutdown and delete) the specified instance.
@@ -187,7 +293,13 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, length=None):
+        """Return the console output of instance.
+
+        Drivers that can read just the end of the console return only
+        the last length lines; the compute manager trims the output of
+        the others.
+        """
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
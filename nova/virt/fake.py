@@ -210,7 +210,7 @@ class FakeConnection(driver.ComputeDriver):
     def interface_stats(self, instance_name, iface_id):
         return [0L, 0L, 0L, 0L, 0L, 0L, 0L, 0L]
 
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, length=None):
         return 'FAKE CONSOLE\xffOUTPUT'
 
     def get_ajax_console(self, instance):
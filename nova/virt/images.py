@@ -21,7 +21,9 @@
 Handling of VM disk images.
 """
 
+import hashlib
 import os
+import time
 
 from nova import exception
 from nova import flags
@@ -32,18 +34,125 @@ from nova import utils
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('image_fetch_write_size', 4 * 1024 * 1024,
+                     'Fetched images are written in multiples of this many'
+                     ' bytes')
+flags.DEFINE_integer('image_upload_chunk_size', 1024 * 1024,
+                     'Uploaded images are read in chunks of at most this'
+                     ' many bytes')
+flags.DEFINE_integer('image_upload_progress_interval', 30,
+                     'Seconds between progress reports of an image upload')
 LOG = logging.getLogger('nova.virt.images')
 
 
+class ImageWriter(object):
+    """File-like object an image service writes image data to.
+
+    Gathers the image service's chunks into writes of whole multiples of
+    --image_fetch_write_size and computes the md5 of the data as it goes.
+    """
+
+    def __init__(self, image_file, write_size=None):
+        self.image_file = image_file
+        self.write_size = write_size or FLAGS.image_fetch_write_size
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.write_size:
+            data = ''.join(self._buffer)
+            aligned = len(data) - len(data) % self.write_size
+            self.image_file.write(data[:aligned])
+            self._buffer = [data[aligned:]]
+            self._buffered = len(data) - aligned
+
+    def flush(self):
+        self.image_file.write(''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        self.image_file.flush()
+
+
+class UploadReader(object):
+    """File-like object an image service reads image data from.
+
+    Caps each read at --image_upload_chunk_size bytes, so memory stays
+    bounded whatever size the image service asks for, and logs how much
+    of the image has been uploaded every
+    --image_upload_progress_interval seconds.
+    """
+
+    def __init__(self, image_file, name, total=None, chunk_size=None):
+        self.image_file = image_file
+        self.name = name
+        self.total = total
+        self.chunk_size = chunk_size or FLAGS.image_upload_chunk_size
+        self.size = 0
+        self.started_at = time.time()
+        self._reported_at = self.started_at
+
+    def read(self, size=-1):
+        if size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        data = self.image_file.read(size)
+        self.size += len(data)
+        now = time.time()
+        if not data or \
+           now - self._reported_at >= FLAGS.image_upload_progress_interval:
+            self._reported_at = now
+            self._report(now)
+        return data
+
+    def _report(self, now):
+        elapsed = max(now - self.started_at, 0.001)
+        progress = {'name': self.name, 'size': self.size,
+                    'rate': self.size / elapsed}
+        if self.total:
+            progress['percent'] = self.size * 100 / self.total
+            LOG.info(_('Uploaded %(size)d bytes (%(percent)d%%) of '
+                       '%(name)s at %(rate)d bytes/s'), progress)
+        else:
+            LOG.info(_('Uploaded %(size)d bytes of %(name)s at '
+                       '%(rate)d bytes/s'), progress)
+
+    def close(self):
+        self.image_file.close()
+
+
 def fetch(context, image_href, path, _user_id, _project_id):
+    """Download an image to path, verifying it against its checksum."""
     # TODO(vish): Improve context handling and add owner and auth data
     #             when it is added to glance.  Right now there is no
     #             auth checking in glance, so we assume that access was
     #             checked before we got here.
     (image_service, image_id) = nova.image.get_image_service(context,
                                                              image_href)
+    started_at = time.time()
     with open(path, "wb") as image_file:
-        metadata = image_service.get(context, image_id, image_file)
+        writer = ImageWriter(image_file)
+        metadata = image_service.get(context, image_id, writer)
+        writer.flush()
+        os.fsync(image_file.fileno())
+    elapsed = max(time.time() - started_at, 0.001)
+
+    expected = metadata.get('checksum')
+    actual = writer.md5.hexdigest()
+    if expected and expected != actual:
+        os.unlink(path)
+        raise exception.ImageUnacceptable(image_id=image_href,
+                reason=_("checksum %(actual)s does not match "
+                         "%(expected)s") % locals())
+
+    LOG.info(_("Fetched image %(image_href)s, %(size)d bytes in "
+               "%(elapsed).1f seconds (%(rate)d bytes/s)"),
+             {'image_href': image_href, 'size': writer.size,
+              'elapsed': elapsed, 'rate': writer.size / elapsed})
     return metadata
 
 
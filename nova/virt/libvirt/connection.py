@@ -45,14 +45,16 @@ import os
 import random
 import re
 import shutil
+import socket
 import sys
 import tempfile
 import time
 import uuid
-from xml.dom import minidom
 from xml.etree import ElementTree
 
 from eventlet import greenthread
+from eventlet import hubs
+from eventlet import patcher
 from eventlet import tpool
 
 from nova import block_device
@@ -70,13 +72,24 @@ from nova.compute import power_state
 from nova.virt import disk
 from nova.virt import driver
 from nova.virt import images
+from nova.virt.libvirt import consolelog
+from nova.virt.libvirt import domainstats
+from nova.virt.libvirt import domainxml
+from nova.virt.libvirt import imagecache
+from nova.virt.libvirt import migration
 from nova.virt.libvirt import netutils
+from nova.virt.libvirt import proxy
+from nova.virt.libvirt import qcow2
 
 
 libvirt = None
 libxml2 = None
 Template = None
 
+# libvirt's event loop blocks, so it runs in a real thread.
+native_threading = patcher.original('threading')
+native_Queue = patcher.original('Queue')
+
 
 LOG = logging.getLogger('nova.virt.libvirt_conn')
 
@@ -124,7 +137,8 @@ flags.DEFINE_string('block_migration_flag',
                     "VIR_MIGRATE_NON_SHARED_INC",
                     'Define block migration behavior.')
 flags.DEFINE_integer('live_migration_bandwidth', 0,
-                    'Define live migration behavior')
+                    'Maximum bandwidth of a migration in MiB/s.'
+                    ' Set to 0 for no limit.')
 flags.DEFINE_string('snapshot_image_format', None,
                     'Snapshot image format (valid options are : '
                     'raw, qcow2, vmdk, vdi).'
@@ -147,6 +161,12 @@ flags.DEFINE_string('default_local_format',
 flags.DEFINE_bool('libvirt_use_virtio_for_bridges',
                   False,
                   'Use virtio for bridge interfaces')
+flags.DEFINE_integer('libvirt_domain_stats_max_age', 5,
+                     'Seconds a snapshot of the stats of every domain is'
+                     ' shared by the callers that poll them')
+flags.DEFINE_integer('libvirt_host_stats_max_age', 60,
+                     'Seconds the host stats reported to the schedulers'
+                     ' are reused before they are collected again')
 
 
 def get_connection(read_only):
@@ -185,6 +205,13 @@ class LibvirtConnection(driver.ComputeDriver):
         self.libvirt_xml = open(FLAGS.libvirt_xml_template).read()
         self.cpuinfo_xml = open(FLAGS.cpuinfo_xml_template).read()
         self._wrapped_conn = None
+        self._call_pool = proxy.CallPool()
+        self._domain_xml = domainxml.DomainXMLCache()
+        self._stats_collector = domainstats.DomainStatsCollector(
+                self._domain_xml, libvirt)
+        self._domain_snapshot = None
+        self._migrations = {}
+        self._host_state = None
         self.read_only = read_only
 
         fw_class = utils.import_class(FLAGS.firewall_driver)
@@ -196,18 +223,121 @@ class LibvirtConnection(driver.ComputeDriver):
             driver_class = utils.import_class(driver)
             self.volume_drivers[driver_type] = driver_class(self)
 
+    @property
+    def HostState(self):
+        if not self._host_state:
+            self._host_state = HostState(self)
+        return self._host_state
+
     def init_host(self, host):
         # NOTE(nsokolov): moved instance restarting to ComputeManager
-        pass
+        if FLAGS.console_log_rotate_interval:
+            timer = utils.LoopingCall(self._rotate_console_logs)
+            timer.start(interval=FLAGS.console_log_rotate_interval,
+                        now=False)
+
+    def register_event_listener(self, callback):
+        """Report power state changes from libvirt lifecycle events.
+
+        The libvirt event loop runs in a native thread, which queues the
+        events and wakes a greenthread through a pipe to call callback.
+        Falls back to polling if the bindings lack event support.
+        """
+        if not hasattr(libvirt, 'virEventRegisterDefaultImpl'):
+            LOG.info(_('libvirt has no event support, polling for power '
+                       'state changes instead'))
+            return super(LibvirtConnection, self).register_event_listener(
+                                                                    callback)
+        self._event_callback = callback
+        self._event_queue = native_Queue.Queue()
+        self._event_rfd, self._event_wfd = os.pipe()
+        libvirt.virEventRegisterDefaultImpl()
+
+        event_thread = native_threading.Thread(target=self._run_event_loop)
+        event_thread.setDaemon(True)
+        event_thread.start()
+        greenthread.spawn(self._dispatch_events)
+
+        # The event implementation has to be registered before the
+        # connection that events are subscribed on is opened.
+        self._event_conn = self._connect(self.libvirt_uri, True)
+        self._event_conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_event, None)
+
+    def _run_event_loop(self):
+        """Runs in a native thread."""
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def _lifecycle_event(self, conn, dom, event, detail, opaque):
+        """Called by libvirt in the native event thread."""
+        state = {libvirt.VIR_DOMAIN_EVENT_STARTED: power_state.RUNNING,
+                 libvirt.VIR_DOMAIN_EVENT_SUSPENDED: power_state.PAUSED,
+                 libvirt.VIR_DOMAIN_EVENT_RESUMED: power_state.RUNNING,
+                 libvirt.VIR_DOMAIN_EVENT_STOPPED: power_state.SHUTOFF,
+                 libvirt.VIR_DOMAIN_EVENT_UNDEFINED: power_state.NOSTATE,
+                }.get(event)
+        # Every event, even one without a power state, may have changed
+        # the domain's XML.
+        self._event_queue.put((dom.name(), dom.UUIDString(), state))
+        os.write(self._event_wfd, ' ')
+
+    def _dispatch_events(self):
+        """Hands queued events to the listener from a greenthread."""
+        while True:
+            hubs.trampoline(self._event_rfd, read=True)
+            os.read(self._event_rfd, 512)
+            while True:
+                try:
+                    name, uuid, state = self._event_queue.get_nowait()
+                except native_Queue.Empty:
+                    break
+                self._domain_xml.invalidate(uuid)
+                self._domain_snapshot = None
+                if state is None:
+                    continue
+                try:
+                    self._event_callback(name, state)
+                except Exception:
+                    LOG.exception(_('Error handling power state event for '
+                                    '%s'), name)
 
     def _get_connection(self):
         if not self._wrapped_conn or not self._test_connection():
             LOG.debug(_('Connecting to libvirt: %s'), self.libvirt_uri)
-            self._wrapped_conn = self._connect(self.libvirt_uri,
-                                               self.read_only)
+            self._wrapped_conn = proxy.ThreadPoolProxy(
+                    self._connect(self.libvirt_uri, self.read_only),
+                    self._call_pool)
         return self._wrapped_conn
     _conn = property(_get_connection)
 
+    def get_call_stats(self):
+        """Return the latency counters of libvirt calls by method."""
+        return self._call_pool.get_stats()
+
+    def get_nbd_stats(self):
+        """Return the counters of the nbd device pool."""
+        return disk.get_nbd_stats()
+
+    def get_domain_snapshot(self, devices=False):
+        """Return a recent DomainSnapshot of the running domains.
+
+        Snapshots are shared for --libvirt_domain_stats_max_age seconds.
+        devices asks for block and interface counters as well.
+        """
+        snapshot = self._domain_snapshot
+        if snapshot is None or (devices and not snapshot.devices) or \
+           time.time() - snapshot.taken_at > \
+           FLAGS.libvirt_domain_stats_max_age:
+            snapshot = self._stats_collector.collect(self._conn, devices)
+            self._domain_snapshot = snapshot
+        return snapshot
+
+    def _get_domain_xml(self, virt_dom):
+        """Return the cached parsed XML of a domain."""
+        return self._domain_xml.get(virt_dom)
+
     def _test_connection(self):
         try:
             self._wrapped_conn.getCapabilities()
@@ -244,28 +374,9 @@ class LibvirtConnection(driver.ComputeDriver):
         return [self._conn.lookupByID(x).name()
                 for x in self._conn.listDomainsID()]
 
-    def _map_to_instance_info(self, domain):
-        """Gets info from a virsh domain object into an InstanceInfo"""
-
-        # domain.info() returns a list of:
-        #    state:       one of the state values (virDomainState)
-        #    maxMemory:   the maximum memory used by the domain
-        #    memory:      the current amount of memory used by the domain
-        #    nbVirtCPU:   the number of virtual CPU
-        #    puTime:      the time used by the domain in nanoseconds
-
-        (state, _max_mem, _mem, _num_cpu, _cpu_time) = domain.info()
-        name = domain.name()
-
-        return driver.InstanceInfo(name, state)
-
     def list_instances_detail(self):
-        infos = []
-        for domain_id in self._conn.listDomainsID():
-            domain = self._conn.lookupByID(domain_id)
-            info = self._map_to_instance_info(domain)
-            infos.append(info)
-        return infos
+        return [driver.InstanceInfo(stats.name, stats.state)
+                for stats in self.get_domain_snapshot()]
 
     def plug_vifs(self, instance, network_info):
         """Plugin VIFs into networks."""
@@ -309,6 +420,8 @@ class LibvirtConnection(driver.ComputeDriver):
             # would do better to keep it if cleanup=False (e.g. volumes?)
             # (e.g. #2 - not losing machines on failure)
             virt_dom.undefine()
+            self._domain_xml.invalidate_domain(virt_dom)
+            self._domain_snapshot = None
         except libvirt.libvirtError as e:
             errcode = e.get_error_code()
             LOG.warning(_("Error from libvirt during undefine of "
@@ -378,26 +491,7 @@ class LibvirtConnection(driver.ComputeDriver):
                                         connection_info,
                                         mount_device)
         virt_dom.attachDevice(xml)
-
-    def _get_disk_xml(self, xml, device):
-        """Returns the xml for the disk mounted at device"""
-        try:
-            doc = libxml2.parseDoc(xml)
-        except Exception:
-            return None
-        ctx = doc.xpathNewContext()
-        try:
-            ret = ctx.xpathEval('/domain/devices/disk')
-            for node in ret:
-                for child in node.children:
-                    if child.name == 'target':
-                        if child.prop('dev') == device:
-                            return str(node)
-        finally:
-            if ctx is not None:
-                ctx.xpathFreeContext()
-            if doc is not None:
-                doc.freeDoc()
+        self._domain_xml.invalidate_domain(virt_dom)
 
     @exception.wrap_exception()
     def detach_volume(self, connection_info, instance_name, mountpoint):
@@ -407,10 +501,11 @@ class LibvirtConnection(driver.ComputeDriver):
             #             migration, so we should still logout even if
             #             the instance doesn't exist here anymore.
             virt_dom = self._lookup_by_name(instance_name)
-            xml = self._get_disk_xml(virt_dom.XMLDesc(0), mount_device)
+            xml = self._get_domain_xml(virt_dom).get_disk_xml(mount_device)
             if not xml:
                 raise exception.DiskNotFound(location=mount_device)
             virt_dom.detachDevice(xml)
+            self._domain_xml.invalidate_domain(virt_dom)
         finally:
             self.volume_driver_method('disconnect_volume',
                                       connection_info,
@@ -471,13 +566,42 @@ class LibvirtConnection(driver.ComputeDriver):
         """ % snapshot_name
         snapshot_ptr = virt_dom.snapshotCreateXML(snapshot_xml, 0)
 
-        # Find the disk
-        xml_desc = virt_dom.XMLDesc(0)
-        domain = ElementTree.fromstring(xml_desc)
-        source = domain.find('devices/disk/source')
-        disk_path = source.get('file')
+        # Find the disk, skipping drives with nothing in them such as an
+        # empty cdrom
+        disk_path = [disk['source'] for disk in
+                     self._get_domain_xml(virt_dom).get_disks()
+                     if disk['source']][0]
+
+        try:
+            # A raw snapshot of a qcow2 disk is read straight out of the
+            # disk, which saves a scratch copy of the whole image.
+            if image_format == 'raw' and source_format == 'qcow2':
+                try:
+                    self._upload_snapshot_stream(context, image_service,
+                                                 image_href, metadata,
+                                                 disk_path, snapshot_name)
+                    return
+                except exception.SnapshotNotStreamable, e:
+                    LOG.info(_('%s, exporting it with qemu-img'), e)
+            self._upload_snapshot_export(context, image_service, image_href,
+                                         metadata, disk_path, snapshot_name,
+                                         source_format, image_format)
+        finally:
+            snapshot_ptr.delete(0)
+
+    def _upload_snapshot_stream(self, context, image_service, image_href,
+                                metadata, disk_path, snapshot_name):
+        reader = qcow2.SnapshotReader(disk_path, snapshot_name)
+        try:
+            image_service.update(context, image_href, metadata,
+                                 images.UploadReader(reader, image_href,
+                                                     reader.size))
+        finally:
+            reader.close()
 
-        # Export the snapshot to a raw image
+    def _upload_snapshot_export(self, context, image_service, image_href,
+                                metadata, disk_path, snapshot_name,
+                                source_format, image_format):
         temp_dir = tempfile.mkdtemp()
         try:
             out_path = os.path.join(temp_dir, snapshot_name)
@@ -498,12 +622,11 @@ class LibvirtConnection(driver.ComputeDriver):
                 image_service.update(context,
                                      image_href,
                                      metadata,
-                                     image_file)
-
+                                     images.UploadReader(
+                                            image_file, image_href,
+                                            os.path.getsize(out_path)))
         finally:
-            # Clean up
             shutil.rmtree(temp_dir)
-            snapshot_ptr.delete(0)
 
     @exception.wrap_exception()
     def reboot(self, instance, network_info, reboot_type=None, xml=None):
@@ -688,14 +811,8 @@ class LibvirtConnection(driver.ComputeDriver):
         fp.write(data)
         return fpath
 
-    def _dump_file(self, fpath):
-        fp = open(fpath, 'r+')
-        contents = fp.read()
-        LOG.info(_('Contents of file %(fpath)s: %(contents)r') % locals())
-        return contents
-
     @exception.wrap_exception()
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, length=None):
         console_log = os.path.join(FLAGS.instances_path, instance['name'],
                                    'console.log')
 
@@ -706,14 +823,25 @@ class LibvirtConnection(driver.ComputeDriver):
             virsh_output = utils.execute('virsh', 'ttyconsole',
                                          instance['name'])
             data = self._flush_xen_console(virsh_output)
-            fpath = self._append_to_file(data, console_log)
+            self._append_to_file(data, console_log)
         elif FLAGS.libvirt_type == 'lxc':
             # LXC is also special
             LOG.info(_("Unable to read LXC console"))
-        else:
-            fpath = console_log
 
-        return self._dump_file(fpath)
+        return consolelog.tail(console_log, length)
+
+    def _rotate_console_logs(self):
+        """Rotate the console logs that have grown too large."""
+        for name in self.list_instances():
+            console_log = os.path.join(FLAGS.instances_path, name,
+                                       'console.log')
+            try:
+                if consolelog.needs_rotation(console_log):
+                    utils.execute('chown', os.getuid(), console_log,
+                                  run_as_root=True)
+                    consolelog.rotate(console_log)
+            except Exception:
+                LOG.exception(_('Failed to rotate console log of %s'), name)
 
     @exception.wrap_exception()
     def get_ajax_console(self, instance):
@@ -732,13 +860,7 @@ class LibvirtConnection(driver.ComputeDriver):
 
         def get_pty_for_instance(instance_name):
             virt_dom = self._lookup_by_name(instance_name)
-            xml = virt_dom.XMLDesc(0)
-            dom = minidom.parseString(xml)
-
-            for serial in dom.getElementsByTagName('serial'):
-                if serial.getAttribute('type') == 'pty':
-                    source = serial.getElementsByTagName('source')[0]
-                    return source.getAttribute('path')
+            return self._get_domain_xml(virt_dom).get_serial_pty()
 
         port = get_open_port()
         token = str(uuid.uuid4())
@@ -760,13 +882,7 @@ class LibvirtConnection(driver.ComputeDriver):
     def get_vnc_console(self, instance):
         def get_vnc_port_for_instance(instance_name):
             virt_dom = self._lookup_by_name(instance_name)
-            xml = virt_dom.XMLDesc(0)
-            # TODO: use etree instead of minidom
-            dom = minidom.parseString(xml)
-
-            for graphic in dom.getElementsByTagName('graphics'):
-                if graphic.getAttribute('type') == 'vnc':
-                    return graphic.getAttribute('port')
+            return self._get_domain_xml(virt_dom).get_graphics_port('vnc')
 
         port = get_vnc_port_for_instance(instance['name'])
         token = str(uuid.uuid4())
@@ -791,24 +907,35 @@ class LibvirtConnection(driver.ComputeDriver):
         """
 
         if not os.path.exists(target):
-            base_dir = os.path.join(FLAGS.instances_path, '_base')
-            if not os.path.exists(base_dir):
-                os.mkdir(base_dir)
-            base = os.path.join(base_dir, fname)
-
-            @utils.synchronized(fname)
-            def call_if_not_exists(base, fn, *args, **kwargs):
-                if not os.path.exists(base):
-                    fn(target=base, *args, **kwargs)
-
-            call_if_not_exists(base, fn, *args, **kwargs)
-
+            base = LibvirtConnection._cache_base_image(fn, fname,
+                                                       *args, **kwargs)
             if cow:
                 utils.execute('qemu-img', 'create', '-f', 'qcow2', '-o',
                               'cluster_size=2M,backing_file=%s' % base,
                               target)
             else:
-                utils.execute('cp', base, target)
+                disk.clone(base, target)
+
+    @staticmethod
+    def _cache_base_image(fn, fname, *args, **kwargs):
+        """Create the base image fname with fn unless it exists already.
+
+        Returns the path of the base image.
+        """
+        base_dir = os.path.join(FLAGS.instances_path, '_base')
+        if not os.path.exists(base_dir):
+            os.mkdir(base_dir)
+        base = os.path.join(base_dir, fname)
+
+        @utils.synchronized(fname)
+        def call_if_not_exists(base, fn, *args, **kwargs):
+            if not os.path.exists(base):
+                fn(target=base, *args, **kwargs)
+            else:
+                imagecache.touch(base)
+
+        call_if_not_exists(base, fn, *args, **kwargs)
+        return base
 
     def _fetch_image(self, context, target, image_id, user_id, project_id,
                      size=None):
@@ -836,6 +963,56 @@ class LibvirtConnection(driver.ComputeDriver):
         self._create_local(target, swap_mb, unit='M')
         utils.execute('mkswap', target)
 
+    @staticmethod
+    def _kernel_images(disk_images):
+        """Return the file, base name and image id of a kernel and ramdisk."""
+        images = []
+        if disk_images['kernel_id']:
+            images.append(('kernel', '%08x' % int(disk_images['kernel_id']),
+                           disk_images['kernel_id']))
+            if disk_images['ramdisk_id']:
+                images.append(('ramdisk',
+                               '%08x' % int(disk_images['ramdisk_id']),
+                               disk_images['ramdisk_id']))
+        return images
+
+    @staticmethod
+    def _root_image_fname(inst_type, image_id, suffix=''):
+        """Return the base image name and root size for an instance."""
+        root_fname = hashlib.sha1(image_id).hexdigest()
+        size = FLAGS.minimum_root_size
+        if inst_type['name'] == 'm1.tiny' or suffix == '.rescue':
+            size = None
+            root_fname += "_sm"
+        return root_fname, size
+
+    def cache_image(self, context, instance, block_device_info=None):
+        """Fetch the kernel, ramdisk and root base images of instance."""
+        for _file, fname, image_id in self._kernel_images(instance):
+            self._cache_base_image(self._fetch_image, fname,
+                                   context=context,
+                                   image_id=image_id,
+                                   user_id=instance['user_id'],
+                                   project_id=instance['project_id'])
+        if self._volume_in_mapping(self.default_root_device,
+                                   block_device_info):
+            return
+        inst_type = instance_types.get_instance_type(
+                instance['instance_type_id'])
+        root_fname, size = self._root_image_fname(inst_type,
+                                                  instance['image_ref'])
+        self._cache_base_image(self._fetch_image, root_fname,
+                               context=context,
+                               image_id=instance['image_ref'],
+                               user_id=instance['user_id'],
+                               project_id=instance['project_id'],
+                               size=size)
+
+    def manage_image_cache(self, context, instances, dry_run=False):
+        """Remove base images no longer used by any instance."""
+        manager = imagecache.ImageCacheManager()
+        return manager.verify_base_images(instances, dry_run=dry_run)
+
     def _create_image(self, context, inst, libvirt_xml, suffix='',
                       disk_images=None, network_info=None,
                       block_device_info=None):
@@ -871,34 +1048,20 @@ class LibvirtConnection(driver.ComputeDriver):
                            'kernel_id': inst['kernel_id'],
                            'ramdisk_id': inst['ramdisk_id']}
 
-        if disk_images['kernel_id']:
-            fname = '%08x' % int(disk_images['kernel_id'])
+        for image_file, fname, image_id in self._kernel_images(disk_images):
             self._cache_image(fn=self._fetch_image,
                               context=context,
-                              target=basepath('kernel'),
+                              target=basepath(image_file),
                               fname=fname,
-                              image_id=disk_images['kernel_id'],
+                              image_id=image_id,
                               user_id=inst['user_id'],
                               project_id=inst['project_id'])
-            if disk_images['ramdisk_id']:
-                fname = '%08x' % int(disk_images['ramdisk_id'])
-                self._cache_image(fn=self._fetch_image,
-                                  context=context,
-                                  target=basepath('ramdisk'),
-                                  fname=fname,
-                                  image_id=disk_images['ramdisk_id'],
-                                  user_id=inst['user_id'],
-                                  project_id=inst['project_id'])
-
-        root_fname = hashlib.sha1(disk_images['image_id']).hexdigest()
-        size = FLAGS.minimum_root_size
 
         inst_type_id = inst['instance_type_id']
         inst_type = instance_types.get_instance_type(inst_type_id)
-        if inst_type['name'] == 'm1.tiny' or suffix == '.rescue':
-            size = None
-            root_fname += "_sm"
-
+        root_fname, size = self._root_image_fname(inst_type,
+                                                  disk_images['image_id'],
+                                                  suffix)
         if not self._volume_in_mapping(self.default_root_device,
                                        block_device_info):
             self._cache_image(fn=self._fetch_image,
@@ -1255,6 +1418,8 @@ class LibvirtConnection(driver.ComputeDriver):
             # createXML call creates a transient domain
             domain = self._conn.createXML(xml, launch_flags)
 
+        self._domain_xml.invalidate_domain(domain)
+        self._domain_snapshot = None
         return domain
 
     def get_diagnostics(self, instance_name):
@@ -1268,40 +1433,11 @@ class LibvirtConnection(driver.ComputeDriver):
         Returns a list of all block devices for this domain.
         """
         domain = self._lookup_by_name(instance_name)
-        # TODO(devcamcar): Replace libxml2 with etree.
-        xml = domain.XMLDesc(0)
-        doc = None
-
         try:
-            doc = libxml2.parseDoc(xml)
-        except Exception:
+            return self._get_domain_xml(domain).get_disk_targets()
+        except SyntaxError:
             return []
 
-        ctx = doc.xpathNewContext()
-        disks = []
-
-        try:
-            ret = ctx.xpathEval('/domain/devices/disk')
-
-            for node in ret:
-                devdst = None
-
-                for child in node.children:
-                    if child.name == 'target':
-                        devdst = child.prop('dev')
-
-                if devdst is None:
-                    continue
-
-                disks.append(devdst)
-        finally:
-            if ctx is not None:
-                ctx.xpathFreeContext()
-            if doc is not None:
-                doc.freeDoc()
-
-        return disks
-
     def get_interfaces(self, instance_name):
         """
         Note that this function takes an instance name.
@@ -1309,40 +1445,11 @@ class LibvirtConnection(driver.ComputeDriver):
         Returns a list of all network interfaces for this instance.
         """
         domain = self._lookup_by_name(instance_name)
-        # TODO(devcamcar): Replace libxml2 with etree.
-        xml = domain.XMLDesc(0)
-        doc = None
-
         try:
-            doc = libxml2.parseDoc(xml)
-        except Exception:
+            return self._get_domain_xml(domain).get_interface_targets()
+        except SyntaxError:
             return []
 
-        ctx = doc.xpathNewContext()
-        interfaces = []
-
-        try:
-            ret = ctx.xpathEval('/domain/devices/interface')
-
-            for node in ret:
-                devdst = None
-
-                for child in node.children:
-                    if child.name == 'target':
-                        devdst = child.prop('dev')
-
-                if devdst is None:
-                    continue
-
-                interfaces.append(devdst)
-        finally:
-            if ctx is not None:
-                ctx.xpathFreeContext()
-            if doc is not None:
-                doc.freeDoc()
-
-        return interfaces
-
     def get_vcpu_total(self):
         """Get vcpu number of physical computer.
 
@@ -1394,11 +1501,7 @@ class LibvirtConnection(driver.ComputeDriver):
 
         """
 
-        total = 0
-        for dom_id in self._conn.listDomainsID():
-            dom = self._conn.lookupByID(dom_id)
-            total += len(dom.vcpus()[1])
-        return total
+        return self.get_domain_snapshot().vcpus_used
 
     def get_memory_mb_used(self):
         """Get the free memory size(MB) of physical computer.
@@ -1717,10 +1820,24 @@ class LibvirtConnection(driver.ComputeDriver):
             logical_sum = reduce(lambda x, y: x | y, flagvals)
 
             dom = self._conn.lookupByName(instance_ref.name)
-            dom.migrateToURI(FLAGS.live_migration_uri % dest,
-                             logical_sum,
-                             None,
-                             FLAGS.live_migration_bandwidth)
+            monitor = migration.MigrationMonitor(instance_ref.name, dom)
+            self._migrations[instance_ref.name] = monitor
+            try:
+                job = greenthread.spawn(dom.migrateToURI,
+                                        FLAGS.live_migration_uri % dest,
+                                        logical_sum,
+                                        None,
+                                        FLAGS.live_migration_bandwidth)
+                try:
+                    monitor.wait(job)
+                except Exception:
+                    if monitor.aborted:
+                        raise exception.Error(_('Migration of %s did not '
+                                                'converge and was aborted')
+                                              % instance_ref.name)
+                    raise
+            finally:
+                del self._migrations[instance_ref.name]
 
         except Exception:
             recover_method(ctxt, instance_ref, dest, block_migration)
@@ -1740,6 +1857,16 @@ class LibvirtConnection(driver.ComputeDriver):
         timer.f = wait_for_live_migration
         timer.start(interval=0.5, now=True)
 
+    def get_migration_progress(self):
+        """Return the progress of the running migrations by instance name.
+
+        Each is a dict of the seconds elapsed, the bytes of data in total,
+        transferred and remaining, the bytes of memory remaining and the
+        bytes of memory dirtied per second.
+        """
+        return dict((name, monitor.progress)
+                    for name, monitor in self._migrations.iteritems())
+
     def pre_live_migration(self, block_device_info):
         """Preparation live migration.
 
@@ -1777,6 +1904,55 @@ class LibvirtConnection(driver.ComputeDriver):
             raise exception.DestinationDiskExists(path=instance_dir)
         os.mkdir(instance_dir)
 
+        # Fetch the backing files, kernel and ramdisk all at once before
+        # any disk is created, rather than one after another.
+        fetches = []
+        for backing_file in set(info['backing_file'] for info in disk_info
+                                if info['backing_file']):
+            # Creating backing file follows same way as spawning instances.
+            fetches.append(greenthread.spawn(self._cache_base_image,
+                    fn=self._fetch_image,
+                    fname=backing_file,
+                    context=ctxt,
+                    image_id=instance_ref['image_ref'],
+                    user_id=instance_ref['user_id'],
+                    project_id=instance_ref['project_id'],
+                    size=instance_ref['local_gb']))
+
+        # if image has kernel and ramdisk, just download
+        # following normal way.
+        if instance_ref['kernel_id']:
+            user = manager.AuthManager().get_user(instance_ref['user_id'])
+            project = manager.AuthManager().get_project(
+                instance_ref['project_id'])
+            fetches.append(greenthread.spawn(self._fetch_image,
+                              nova_context.get_admin_context(),
+                              os.path.join(instance_dir, 'kernel'),
+                              instance_ref['kernel_id'],
+                              user,
+                              project))
+            if instance_ref['ramdisk_id']:
+                fetches.append(greenthread.spawn(self._fetch_image,
+                                  nova_context.get_admin_context(),
+                                  os.path.join(instance_dir, 'ramdisk'),
+                                  instance_ref['ramdisk_id'],
+                                  user,
+                                  project))
+        # Let every fetch finish before giving up on any, so none is
+        # left writing into the instance directory behind the error.
+        error = None
+        for fetch in fetches:
+            try:
+                fetch.wait()
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+                else:
+                    LOG.exception(_('Fetch for block migration of %s '
+                                    'failed'), instance_ref['name'])
+        if error is not None:
+            raise error[0], error[1], error[2]
+
         for info in disk_info:
             base = os.path.basename(info['path'])
             # Get image type and create empty disk image, and
@@ -1787,43 +1963,12 @@ class LibvirtConnection(driver.ComputeDriver):
                               instance_disk, info['local_gb'])
 
             else:
-                # Creating backing file follows same way as spawning instances.
                 backing_file = os.path.join(FLAGS.instances_path,
                                             '_base', info['backing_file'])
-
-                if not os.path.exists(backing_file):
-                    self._cache_image(fn=self._fetch_image,
-                        context=ctxt,
-                        target=info['path'],
-                        fname=info['backing_file'],
-                        cow=FLAGS.use_cow_images,
-                        image_id=instance_ref['image_ref'],
-                        user_id=instance_ref['user_id'],
-                        project_id=instance_ref['project_id'],
-                        size=instance_ref['local_gb'])
-
                 utils.execute('qemu-img', 'create', '-f', info['type'],
                           '-o', 'backing_file=%s' % backing_file,
                           instance_disk, info['local_gb'])
 
-        # if image has kernel and ramdisk, just download
-        # following normal way.
-        if instance_ref['kernel_id']:
-            user = manager.AuthManager().get_user(instance_ref['user_id'])
-            project = manager.AuthManager().get_project(
-                instance_ref['project_id'])
-            self._fetch_image(nova_context.get_admin_context(),
-                              os.path.join(instance_dir, 'kernel'),
-                              instance_ref['kernel_id'],
-                              user,
-                              project)
-            if instance_ref['ramdisk_id']:
-                self._fetch_image(nova_context.get_admin_context(),
-                                  os.path.join(instance_dir, 'ramdisk'),
-                                  instance_ref['ramdisk_id'],
-                                  user,
-                                  project)
-
     def post_live_migration_at_destination(self, ctxt,
                                            instance_ref,
                                            network_info,
@@ -1855,6 +2000,7 @@ class LibvirtConnection(driver.ComputeDriver):
             # included in to_xml() result.
             dom = self._lookup_by_name(instance_ref.name)
             self._conn.defineXML(dom.XMLDesc(0))
+            self._domain_xml.invalidate_domain(dom)
 
     def get_instance_disk_info(self, ctxt, instance_ref):
         """Preparation block migration.
@@ -1871,27 +2017,17 @@ class LibvirtConnection(driver.ComputeDriver):
         disk_info = []
 
         virt_dom = self._lookup_by_name(instance_ref.name)
-        xml = virt_dom.XMLDesc(0)
-        doc = libxml2.parseDoc(xml)
-        disk_nodes = doc.xpathEval('//devices/disk')
-        path_nodes = doc.xpathEval('//devices/disk/source')
-        driver_nodes = doc.xpathEval('//devices/disk/driver')
-
-        for cnt, path_node in enumerate(path_nodes):
-            disk_type = disk_nodes[cnt].get_properties().getContent()
-            path = path_node.get_properties().getContent()
+        for disk in self._get_domain_xml(virt_dom).get_disks():
+            path = disk['source']
+            if not path:
+                continue
 
-            if disk_type != 'file':
+            if disk['type'] != 'file':
                 LOG.debug(_('skipping %(path)s since it looks like volume') %
                           locals())
                 continue
 
-            # In case of libvirt.xml, disk type can be obtained
-            # by the below statement.
-            # -> disk_type = driver_nodes[cnt].get_properties().getContent()
-            # but this xml is generated by kvm, format is slightly different.
-            disk_type = \
-                driver_nodes[cnt].get_properties().get_next().getContent()
+            disk_type = disk['driver_type']
             if disk_type == 'raw':
                 size = int(os.path.getsize(path))
                 backing_file = ""
@@ -1931,11 +2067,11 @@ class LibvirtConnection(driver.ComputeDriver):
 
     def update_host_status(self):
         """See xenapi_conn.py implementation."""
-        pass
+        return self.HostState.update_status()
 
     def get_host_stats(self, refresh=False):
         """See xenapi_conn.py implementation."""
-        pass
+        return self.HostState.get_host_stats(refresh=refresh)
 
     def host_power_action(self, host, action):
         """Reboots, shuts down or powers up the host."""
@@ -1944,3 +2080,76 @@ class LibvirtConnection(driver.ComputeDriver):
     def set_host_enabled(self, host, enabled):
         """Sets the specified host's ability to accept new instances."""
         pass
+
+
+class HostState(object):
+    """Manages information about the libvirt host this compute node
+    is running on.
+
+    The stats have the shape of those reported by the XenAPI driver, so
+    the schedulers treat both alike.  They are collected at most every
+    --libvirt_host_stats_max_age seconds unless a refresh is asked for.
+    """
+    def __init__(self, connection):
+        super(HostState, self).__init__()
+        self.connection = connection
+        self._stats = {}
+        self._updated_at = None
+
+    def get_host_stats(self, refresh=False):
+        """Return the current state of the host. If 'refresh' is
+        True, run the update first.
+        """
+        if refresh or self._updated_at is None or \
+           time.time() - self._updated_at > FLAGS.libvirt_host_stats_max_age:
+            self.update_status()
+        return self._stats
+
+    def _get_host_uuid(self):
+        caps = ElementTree.fromstring(self.connection._conn.getCapabilities())
+        return caps.findtext('host/uuid')
+
+    def _get_cpu_info(self):
+        try:
+            return utils.loads(self.connection.get_cpu_info())
+        except exception.InvalidCPUInfo as e:
+            LOG.warn(_("Unable to get cpu info: %s") % e)
+            return {}
+
+    def update_status(self):
+        """Collect the memory, disk and vcpu usage of the host."""
+        LOG.debug(_("Updating host stats"))
+        conn = self.connection
+        try:
+            memory_total = conn.get_memory_mb_total()
+            memory_used = conn.get_memory_mb_used()
+            disk_total = conn.get_local_gb_total()
+            disk_used = conn.get_local_gb_used()
+            hypervisor_type = conn.get_hypervisor_type()
+            data = {'vcpus': conn.get_vcpu_total(),
+                    'vcpus_used': conn.get_vcpu_used(),
+                    'hypervisor_type': hypervisor_type,
+                    'hypervisor_version': conn.get_hypervisor_version(),
+                    'host_uuid': self._get_host_uuid(),
+                    'host_cpu_info': self._get_cpu_info()}
+        except libvirt.libvirtError as e:
+            LOG.error(_("Unable to get updated status: %s") % e)
+            return self._stats
+
+        mb = 1024 * 1024
+        gb = mb * 1024
+        data['host_memory_total'] = memory_total * mb
+        data['host_memory_overhead'] = 0
+        data['host_memory_free'] = (memory_total - memory_used) * mb
+        data['host_memory_free_computed'] = data['host_memory_free']
+        data['disk_total'] = disk_total * gb
+        data['disk_used'] = disk_used * gb
+        data['disk_available'] = (disk_total - disk_used) * gb
+        data['host_hostname'] = socket.gethostname()
+        data['host_name_label'] = FLAGS.host
+        data['host_name-description'] = _('%s host') % hypervisor_type
+        data['host_ip_address'] = FLAGS.my_ip
+        data['host_other_config'] = {}
+        self._stats = data
+        self._updated_at = time.time()
+        return data
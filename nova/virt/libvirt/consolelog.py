@@ -0,0 +1,169 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tails and rotates instance console logs.
+
+tail() reads a console log backwards from its end, so returning the
+last lines of a busy guest's log costs no more than those lines.
+
+qemu keeps console.log open and writes at its own offset, so a log
+cannot be rotated by renaming it.  rotate() copies the end of the log to
+console.log.0 and truncates the log in place instead.  qemu's next write
+then leaves a hole in front of it, which takes no disk space.  rotate()
+records where the hole ends in console.log.hole, and tail() reads the
+log only down to there before reading on into console.log.0.
+
+"""
+
+import errno
+import os
+
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.libvirt.consolelog')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('console_log_max_bytes', 10 * 1024 * 1024,
+                     'Console logs are rotated once they hold this many'
+                     ' bytes. Set to 0 to never rotate them.')
+flags.DEFINE_integer('console_log_rotate_interval', 600,
+                     'Seconds between checks for console logs to rotate.'
+                     ' Set to 0 to never check.')
+flags.DEFINE_integer('console_output_max_bytes', 64 * 1024,
+                     'Most bytes of console output returned for an'
+                     ' instance')
+
+BLOCK_SIZE = 4096
+
+
+def backup_path(path):
+    return path + '.0'
+
+
+def hole_path(path):
+    return path + '.hole'
+
+
+def _hole_end(path, size):
+    """Return where the hole left by the last rotate() of path ends."""
+    try:
+        with open(hole_path(path)) as hole:
+            end = int(hole.read())
+    except (IOError, ValueError):
+        return 0
+    if end > size and size:
+        # The log has been written from the start again since, as by
+        # a new qemu, so the hole is gone.
+        return 0
+    return end
+
+
+def _read_backwards(path, max_bytes, start=None):
+    """Yield the blocks of path from its end, at most max_bytes in all.
+
+    Nothing before offset start is read.  By default that is the end of
+    the hole left by rotate().
+    """
+    try:
+        log = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    with log:
+        log.seek(0, os.SEEK_END)
+        offset = log.tell()
+        if start is None:
+            start = _hole_end(path, offset)
+        while offset > start and max_bytes > 0:
+            size = min(BLOCK_SIZE, offset - start, max_bytes)
+            offset -= size
+            max_bytes -= size
+            log.seek(offset)
+            yield log.read(size)
+
+
+def _tail_blocks(path, max_bytes):
+    """Yield the blocks of the log at path and then of its backup."""
+    for block in _read_backwards(path, max_bytes):
+        max_bytes -= len(block)
+        yield block
+    for block in _read_backwards(backup_path(path), max_bytes):
+        yield block
+
+
+def tail(path, length=None, max_bytes=None):
+    """Return the last length lines of the console log at path.
+
+    All the lines are returned if length is None.  Either way no more
+    than max_bytes bytes are read, which defaults to
+    --console_output_max_bytes.
+    """
+    if max_bytes is None:
+        max_bytes = FLAGS.console_output_max_bytes
+    if length == 0:
+        return ''
+    blocks = []
+    newlines = 0
+    for block in _tail_blocks(path, max_bytes):
+        blocks.append(block)
+        newlines += block.count('\n')
+        # One more newline than lines wanted ends the line before them.
+        if length is not None and newlines > length:
+            break
+    blocks.reverse()
+    data = ''.join(blocks)
+    if length is not None:
+        data = ''.join(data.splitlines(True)[-length:])
+    return data
+
+
+def needs_rotation(path, max_bytes=None):
+    """Whether the console log at path holds max_bytes bytes or more."""
+    if max_bytes is None:
+        max_bytes = FLAGS.console_log_max_bytes
+    if not max_bytes:
+        return False
+    try:
+        # The hole left by an earlier rotation has no blocks.
+        return os.stat(path).st_blocks * 512 >= max_bytes
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+
+
+def rotate(path, max_bytes=None):
+    """Move the end of the console log at path to its backup.
+
+    The last max_bytes bytes of the log replace the backup and the log
+    is truncated.  Output written between the two is lost.
+    """
+    if max_bytes is None:
+        max_bytes = FLAGS.console_log_max_bytes
+    blocks = list(_read_backwards(path, max_bytes))
+    blocks.reverse()
+    with open(backup_path(path), 'wb') as backup:
+        backup.write(''.join(blocks))
+    with open(path, 'r+b') as log:
+        log.seek(0, os.SEEK_END)
+        end = log.tell()
+        log.truncate(0)
+    with open(hole_path(path), 'w') as hole:
+        hole.write(str(end))
+    LOG.info(_('Rotated console log %s'), path)
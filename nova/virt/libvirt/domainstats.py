@@ -0,0 +1,176 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Stats of every running domain, collected in one pass.
+
+Looking each domain up by ID and asking for its info separately costs
+several libvirt round trips per domain on every poll.  The collector
+uses virConnect.getAllDomainStats where libvirt has it, then
+listAllDomains, and only falls back to listDomainsID and lookupByID on
+older libvirt.  Block and interface counters are only gathered when
+asked for, since without getAllDomainStats they take a call per device.
+
+"""
+
+import time
+
+from nova import log as logging
+from nova.compute import power_state
+
+
+LOG = logging.getLogger('nova.virt.libvirt.domainstats')
+
+# Values of the bulk API constants, which older bindings do not define.
+VIR_CONNECT_LIST_DOMAINS_ACTIVE = 1
+VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE = 1
+VIR_DOMAIN_STATS_STATE = 1
+VIR_DOMAIN_STATS_CPU_TOTAL = 2
+VIR_DOMAIN_STATS_BALLOON = 4
+VIR_DOMAIN_STATS_VCPU = 8
+VIR_DOMAIN_STATS_INTERFACE = 16
+VIR_DOMAIN_STATS_BLOCK = 32
+VIR_ERR_NO_SUPPORT = 3
+
+# The fields of virDomain.blockStats and virDomain.interfaceStats, as
+# named by getAllDomainStats.
+BLOCK_FIELDS = ('rd.reqs', 'rd.bytes', 'wr.reqs', 'wr.bytes', 'errs')
+INTERFACE_FIELDS = ('rx.bytes', 'rx.pkts', 'rx.errs', 'rx.drop',
+                    'tx.bytes', 'tx.pkts', 'tx.errs', 'tx.drop')
+
+
+class DomainStats(object):
+    """Stats of one domain, in the units of virDomain.info."""
+
+    def __init__(self, name, state, max_mem, mem, num_cpu, cpu_time):
+        self.name = name
+        self.state = state
+        self.max_mem = max_mem
+        self.mem = mem
+        self.num_cpu = num_cpu
+        self.cpu_time = cpu_time
+        # device -> tuple as returned by blockStats or interfaceStats
+        self.block = {}
+        self.interfaces = {}
+
+
+class DomainSnapshot(object):
+    """Stats of the running domains at one point in time."""
+
+    def __init__(self, domains, devices):
+        self.domains = dict((stats.name, stats) for stats in domains)
+        self.devices = devices
+        self.taken_at = time.time()
+
+    def __iter__(self):
+        return self.domains.itervalues()
+
+    @property
+    def vcpus_used(self):
+        return sum(stats.num_cpu for stats in self)
+
+
+class DomainStatsCollector(object):
+    """Collects DomainSnapshots with the cheapest API libvirt offers.
+
+    domain_xml is the driver's DomainXMLCache and libvirt_module the
+    libvirt bindings.
+    """
+
+    def __init__(self, domain_xml, libvirt_module):
+        self._domain_xml = domain_xml
+        self._libvirt = libvirt_module
+        self._bulk_stats = True
+        self._list_all = True
+
+    def collect(self, conn, devices=False):
+        """Return a DomainSnapshot of the domains running on conn."""
+        if self._bulk_stats and hasattr(conn, 'getAllDomainStats'):
+            try:
+                domains = self._collect_bulk(conn, devices)
+                return DomainSnapshot(domains, devices)
+            except self._libvirt.libvirtError, e:
+                LOG.info(_('Bulk domain stats are unavailable, collecting '
+                           'them per domain: %s'), e)
+                self._bulk_stats = not self._unsupported(e)
+        domains = [self._collect_one(domain, devices)
+                   for domain in self._list_domains(conn)]
+        return DomainSnapshot([stats for stats in domains if stats],
+                              devices)
+
+    @staticmethod
+    def _unsupported(error):
+        """Whether error says the daemon lacks an API the bindings have."""
+        return error.get_error_code() == VIR_ERR_NO_SUPPORT
+
+    def _collect_bulk(self, conn, devices):
+        wanted = (VIR_DOMAIN_STATS_STATE | VIR_DOMAIN_STATS_CPU_TOTAL |
+                  VIR_DOMAIN_STATS_BALLOON | VIR_DOMAIN_STATS_VCPU)
+        if devices:
+            wanted |= VIR_DOMAIN_STATS_INTERFACE | VIR_DOMAIN_STATS_BLOCK
+        records = conn.getAllDomainStats(
+                wanted, VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        return [self._from_record(domain.name(), record)
+                for domain, record in records]
+
+    @staticmethod
+    def _from_record(name, record):
+        stats = DomainStats(name,
+                            record.get('state.state', power_state.NOSTATE),
+                            record.get('balloon.maximum', 0),
+                            record.get('balloon.current', 0),
+                            record.get('vcpu.current', 0),
+                            record.get('cpu.time', 0))
+        for kind, devices, fields in (('block', stats.block, BLOCK_FIELDS),
+                                      ('net', stats.interfaces,
+                                       INTERFACE_FIELDS)):
+            for index in xrange(record.get('%s.count' % kind, 0)):
+                prefix = '%s.%d.' % (kind, index)
+                # libvirt reports -1 for counters it does not keep.
+                devices[record[prefix + 'name']] = tuple(
+                        record.get(prefix + field, -1) for field in fields)
+        return stats
+
+    def _list_domains(self, conn):
+        if self._list_all and hasattr(conn, 'listAllDomains'):
+            try:
+                return conn.listAllDomains(VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+            except self._libvirt.libvirtError, e:
+                LOG.info(_('listAllDomains is unavailable, looking domains '
+                           'up by ID: %s'), e)
+                self._list_all = not self._unsupported(e)
+        domains = []
+        for domain_id in conn.listDomainsID():
+            try:
+                domains.append(conn.lookupByID(domain_id))
+            except self._libvirt.libvirtError:
+                # The domain went away after it was listed.
+                continue
+        return domains
+
+    def _collect_one(self, domain, devices):
+        try:
+            stats = DomainStats(domain.name(), *domain.info())
+            if devices:
+                parsed = self._domain_xml.get(domain)
+                for disk in parsed.get_disk_targets():
+                    stats.block[disk] = domain.blockStats(disk)
+                for interface in parsed.get_interface_targets():
+                    stats.interfaces[interface] = \
+                            domain.interfaceStats(interface)
+        except self._libvirt.libvirtError, e:
+            LOG.debug(_('Skipping stats of a domain that went away: %s'), e)
+            return None
+        return stats
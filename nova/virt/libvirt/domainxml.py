@@ -0,0 +1,137 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Cache of parsed libvirt domain XML.
+
+Fetching and parsing a domain's XML for every disk, interface or console
+lookup adds up when hundreds of domains are polled.  DomainXMLCache
+keeps the parsed description of each domain by UUID.  The driver
+invalidates an entry whenever it defines, undefines or changes the
+devices of a domain, and on lifecycle events.  An entry is also dropped
+when the domain's ID changes, since libvirt assigns a new ID and new
+graphics ports each time a domain starts.
+
+"""
+
+from xml.etree import ElementTree
+
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.libvirt.domainxml')
+
+
+class DomainXML(object):
+    """Typed accessors for the devices in a domain's XML."""
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.tree = ElementTree.fromstring(xml)
+
+    def get_disks(self):
+        """Return a dict of type, target, source and driver_type per disk."""
+        disks = []
+        for node in self.tree.findall('devices/disk'):
+            target = node.find('target')
+            source = node.find('source')
+            driver = node.find('driver')
+            disk = {'type': node.get('type'),
+                    'device': node.get('device'),
+                    'target': target is not None and target.get('dev'),
+                    'source': None,
+                    'driver_type': driver is not None and driver.get('type')}
+            if source is not None:
+                disk['source'] = source.get('file') or source.get('dev')
+            disks.append(disk)
+        return disks
+
+    def get_disk_targets(self):
+        return [disk['target'] for disk in self.get_disks()
+                if disk['target']]
+
+    def get_disk_xml(self, device):
+        """Return the XML of the disk attached as device, or None."""
+        for node in self.tree.findall('devices/disk'):
+            target = node.find('target')
+            if target is not None and target.get('dev') == device:
+                return ElementTree.tostring(node)
+
+    def get_interfaces(self):
+        """Return a dict of type, target and mac per interface."""
+        interfaces = []
+        for node in self.tree.findall('devices/interface'):
+            target = node.find('target')
+            mac = node.find('mac')
+            interfaces.append({
+                    'type': node.get('type'),
+                    'target': target is not None and target.get('dev'),
+                    'mac': mac is not None and mac.get('address')})
+        return interfaces
+
+    def get_interface_targets(self):
+        return [interface['target'] for interface in self.get_interfaces()
+                if interface['target']]
+
+    def get_graphics_port(self, graphics_type='vnc'):
+        """Return the port of the graphics console of graphics_type."""
+        for node in self.tree.findall('devices/graphics'):
+            if node.get('type') == graphics_type:
+                return node.get('port')
+
+    def get_serial_pty(self):
+        """Return the path of the first pty serial console."""
+        for node in self.tree.findall('devices/serial'):
+            if node.get('type') == 'pty':
+                source = node.find('source')
+                if source is not None:
+                    return source.get('path')
+
+
+class DomainXMLCache(object):
+    """Parsed XML of each domain by UUID."""
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, domain):
+        """Return the DomainXML of a libvirt domain."""
+        uuid = domain.UUIDString()
+        domain_id = domain.ID()
+        entry = self._entries.get(uuid)
+        if entry is not None and entry[0] == domain_id:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        parsed = DomainXML(domain.XMLDesc(0))
+        self._entries[uuid] = (domain_id, parsed)
+        return parsed
+
+    def invalidate(self, uuid):
+        if self._entries.pop(uuid, None) is not None:
+            LOG.debug(_('Dropped cached XML of domain %s'), uuid)
+
+    def invalidate_domain(self, domain):
+        self.invalidate(domain.UUIDString())
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        return {'domains': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
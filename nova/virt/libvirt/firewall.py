@@ -534,7 +534,7 @@ class IptablesFirewallDriver(FirewallDriver):
             # NOTE(vish): use the passed info instead of the stored info
             self.network_infos.pop(instance['id'])
             self.remove_filters_for_instance(instance)
-            self.iptables.apply()
+            self.iptables.defer_apply()
             self.nwfilter.unfilter_instance(instance, network_info)
         else:
             LOG.info(_('Attempted to unfilter instance %s which is not '
@@ -544,7 +544,8 @@ class IptablesFirewallDriver(FirewallDriver):
         self.instances[instance['id']] = instance
         self.network_infos[instance['id']] = network_info
         self.add_filters_for_instance(instance)
-        self.iptables.apply()
+        # The instance is not started until its rules are in place.
+        self.iptables.defer_apply(wait=True)
 
     def _create_filter(self, ips, chain_name):
         return ['-d %s -j $%s' % (ip, chain_name) for ip in ips]
@@ -720,11 +721,11 @@ class IptablesFirewallDriver(FirewallDriver):
 
     def refresh_security_group_members(self, security_group):
         self.do_refresh_security_group_rules(security_group)
-        self.iptables.apply()
+        self.iptables.defer_apply()
 
     def refresh_security_group_rules(self, security_group):
         self.do_refresh_security_group_rules(security_group)
-        self.iptables.apply()
+        self.iptables.defer_apply()
 
     @utils.synchronized('iptables', external=True)
     def do_refresh_security_group_rules(self, security_group):
@@ -735,7 +736,7 @@ class IptablesFirewallDriver(FirewallDriver):
     def refresh_provider_fw_rules(self):
         """See class:FirewallDriver: docs."""
         self._do_refresh_provider_fw_rules()
-        self.iptables.apply()
+        self.iptables.defer_apply()
 
     @utils.synchronized('iptables', external=True)
     def _do_refresh_provider_fw_rules(self):
@@ -0,0 +1,221 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Removal of unused base images from the libvirt image cache.
+
+Base images live in $instances_path/_base.  A base image is in use when
+an instance disk under $instances_path has it as its qcow2 backing file,
+or when it is the kernel, ramdisk or root image of an instance on this
+host.  Scanning the instance directories also finds disks of instances
+this host doesn't know about, which matters when instances_path is
+shared.  It doesn't find the kernels and ramdisks of other hosts'
+instances, or base images another host is still building a disk from;
+those are only kept by their mtime, so on shared storage both ages
+below must be well above the time between image cache passes and the
+time a boot takes.
+
+Every use of a base image touches it, so its mtime is when it was last
+used.  Unused base images are removed once they have been unused for
+--image_cache_max_unused_age seconds, and then least recently used
+first while the cache is larger than --image_cache_max_size_gb.
+
+"""
+
+import hashlib
+import os
+import struct
+import time
+
+from nova import flags
+from nova import log as logging
+from nova import utils
+
+
+LOG = logging.getLogger('nova.virt.libvirt.imagecache')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('image_cache_max_unused_age', 86400,
+                     'Seconds after its last use an unused base image is'
+                     ' removed.  Set to 0 to keep them regardless of age.')
+flags.DEFINE_integer('image_cache_max_size_gb', 0,
+                     'Size of the base image cache above which unused base'
+                     ' images are removed least recently used first.'
+                     ' Set to 0 for no limit.')
+flags.DEFINE_integer('image_cache_min_unused_age', 3600,
+                     'Seconds after its last use an unused base image is'
+                     ' safe from removal to keep the cache under its size.')
+
+QCOW2_MAGIC = 'QFI\xfb'
+# Partially downloaded or converted images next to the base images.
+IN_PROGRESS_SUFFIXES = ('.part', '.converted')
+
+
+def get_backing_file(path):
+    """Return the backing file of a qcow2 image, or None.
+
+    Only the image header is read, so this is cheap enough to run over
+    every disk on the host.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(20)
+            if len(header) < 20 or header[:4] != QCOW2_MAGIC:
+                return None
+            offset, size = struct.unpack('>QI', header[8:20])
+            if not offset or not size:
+                return None
+            f.seek(offset)
+            return f.read(size)
+    except IOError:
+        return None
+
+
+def touch(path):
+    """Mark a base image as just used."""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+class ImageCacheManager(object):
+    """Finds and removes unused base images."""
+
+    def __init__(self, instances_path=None):
+        self.instances_path = instances_path or FLAGS.instances_path
+        self.base_dir = os.path.join(self.instances_path, '_base')
+
+    def _list_base_images(self):
+        """Return {name: (size, mtime)} of the finished base images."""
+        images = {}
+        if not os.path.isdir(self.base_dir):
+            return images
+        for name in os.listdir(self.base_dir):
+            if name.endswith(IN_PROGRESS_SUFFIXES):
+                continue
+            path = os.path.join(self.base_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            images[name] = (stat.st_size, stat.st_mtime)
+        return images
+
+    def _backing_images(self):
+        """Return the base image names backing any instance disk."""
+        names = set()
+        for instance_dir in os.listdir(self.instances_path):
+            path = os.path.join(self.instances_path, instance_dir)
+            if instance_dir == '_base' or not os.path.isdir(path):
+                continue
+            for disk in os.listdir(path):
+                backing_file = get_backing_file(os.path.join(path, disk))
+                if backing_file and \
+                   os.path.dirname(backing_file) == self.base_dir:
+                    names.add(os.path.basename(backing_file))
+        return names
+
+    @staticmethod
+    def _instance_images(instances):
+        """Return the kernel, ramdisk and root base image names in use."""
+        names = set()
+        for instance in instances:
+            for image_key in ('kernel_id', 'ramdisk_id'):
+                if instance[image_key]:
+                    try:
+                        names.add('%08x' % int(instance[image_key]))
+                    except ValueError:
+                        LOG.warn(_('Instance %(id)s has a %(image_key)s '
+                                   'that is not an integer: %(ref)s'),
+                                 {'id': instance['id'],
+                                  'image_key': image_key,
+                                  'ref': instance[image_key]})
+            if instance['image_ref']:
+                root = hashlib.sha1(str(instance['image_ref'])).hexdigest()
+                names.add(root)
+                names.add(root + '_sm')
+        return names
+
+    def verify_base_images(self, instances, dry_run=False):
+        """Remove unused base images and report on the cache.
+
+        instances are this host's instances.  Returns a dict of the in
+        use, removed and kept base image names and the cache size in
+        bytes before and after.
+        """
+        now = time.time()
+        images = self._list_base_images()
+        in_use = (self._backing_images() |
+                  self._instance_images(instances)) & set(images)
+        for name in in_use:
+            touch(os.path.join(self.base_dir, name))
+
+        unused = sorted((mtime, name) for name, (size, mtime)
+                        in images.iteritems() if name not in in_use)
+        total = sum(size for size, mtime in images.itervalues())
+        size = total
+        budget = FLAGS.image_cache_max_size_gb * 1024 * 1024 * 1024
+        removed = []
+        for mtime, name in unused:
+            idle = now - mtime
+            if FLAGS.image_cache_max_unused_age and \
+               idle > FLAGS.image_cache_max_unused_age:
+                reason = _('unused for %d seconds') % idle
+            elif budget and size > budget and \
+                 idle > FLAGS.image_cache_min_unused_age:
+                reason = _('cache is %(size)d bytes, over its budget of '
+                           '%(budget)d') % locals()
+            else:
+                continue
+            if dry_run:
+                LOG.info(_('Would remove base image %(name)s, %(reason)s'),
+                         locals())
+            elif not self._remove(name, mtime):
+                continue
+            else:
+                LOG.info(_('Removed base image %(name)s, %(reason)s'),
+                         locals())
+            removed.append(name)
+            size -= images[name][0]
+
+        return {'in_use': sorted(in_use),
+                'removed': removed,
+                'kept': sorted(set(images) - in_use - set(removed)),
+                'size': total,
+                'size_after': size,
+                'dry_run': dry_run}
+
+    def _remove(self, name, mtime):
+        """Remove a base image unless it was used since mtime.
+
+        Takes the lock a spawn holds while fetching or touching the
+        image, so an image is never removed as a spawn starts using it.
+        """
+        path = os.path.join(self.base_dir, name)
+
+        @utils.synchronized(name)
+        def remove_if_unused():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return False
+                os.remove(path)
+                return True
+            except OSError, e:
+                LOG.warn(_('Failed to remove base image %(path)s: %(e)s'),
+                         locals())
+                return False
+
+        return remove_if_unused()
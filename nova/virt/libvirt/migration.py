@@ -0,0 +1,128 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Progress of live and block migrations.
+
+While a migration runs, MigrationMonitor polls the domain's job info
+every --live_migration_monitor_interval seconds.  It records how much
+data has been transferred, how much remains and how fast the guest
+dirties its memory.  A migration whose remaining data has not reached a
+new low for --live_migration_progress_timeout seconds is not converging,
+because the guest dirties memory faster than it is copied, so the job
+is aborted and the caller rolls the migration back.
+
+"""
+
+import time
+
+from eventlet import greenthread
+
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.libvirt.migration')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('live_migration_monitor_interval', 2,
+                     'Seconds between progress checks of a migration')
+flags.DEFINE_integer('live_migration_progress_timeout', 150,
+                     'Seconds a migration may go without its remaining data'
+                     ' reaching a new low before it is aborted.'
+                     ' Set to 0 to never abort.')
+
+VIR_DOMAIN_JOB_NONE = 0
+
+
+class MigrationMonitor(object):
+    """Watches the migration job of one domain."""
+
+    def __init__(self, name, domain, progress_timeout=None):
+        self.name = name
+        self.domain = domain
+        if progress_timeout is None:
+            progress_timeout = FLAGS.live_migration_progress_timeout
+        self.progress_timeout = progress_timeout
+        self.aborted = False
+        self.progress = {'elapsed': 0,
+                         'data_total': 0,
+                         'data_processed': 0,
+                         'data_remaining': 0,
+                         'memory_remaining': 0,
+                         'dirty_rate': 0}
+        self._sample = None
+        self._lowest_remaining = None
+        self._progress_at = time.time()
+
+    def poll(self):
+        """Record the job's progress, aborting the job if it is stuck."""
+        info = self.domain.jobInfo()
+        if info[0] == VIR_DOMAIN_JOB_NONE:
+            return
+        (_type, elapsed, _time_remaining, data_total, data_processed,
+         data_remaining, _mem_total, mem_processed, mem_remaining) = info[:9]
+        now = time.time()
+
+        # Memory the guest dirtied since the last poll is memory that was
+        # copied, or is still to be copied, on top of what remained then.
+        dirty_rate = 0
+        if self._sample:
+            then, then_processed, then_remaining = self._sample
+            dirtied = (mem_processed - then_processed +
+                       mem_remaining - then_remaining)
+            if now > then:
+                dirty_rate = max(0, dirtied) / (now - then)
+        self._sample = (now, mem_processed, mem_remaining)
+        self.progress = {'elapsed': elapsed / 1000.0,
+                         'data_total': data_total,
+                         'data_processed': data_processed,
+                         'data_remaining': data_remaining,
+                         'memory_remaining': mem_remaining,
+                         'dirty_rate': dirty_rate}
+        LOG.info(_('Migration of %(name)s: %(data_processed)d bytes '
+                   'transferred, %(data_remaining)d remaining, memory '
+                   'dirtied at %(dirty_rate)d bytes/s'),
+                 dict(self.progress, name=self.name))
+
+        if self._lowest_remaining is None or \
+           data_remaining < self._lowest_remaining:
+            self._lowest_remaining = data_remaining
+            self._progress_at = now
+        elif self.progress_timeout and \
+             now - self._progress_at > self.progress_timeout:
+            LOG.warn(_('Migration of %(name)s made no progress for '
+                       '%(timeout)d seconds, aborting it'),
+                     {'name': self.name, 'timeout': self.progress_timeout})
+            self.aborted = True
+            self.domain.abortJob()
+
+    def wait(self, migration, interval=None):
+        """Poll until the migration greenthread ends and return its result.
+
+        Errors from polling are logged and do not stop the migration.
+        """
+        if interval is None:
+            interval = FLAGS.live_migration_monitor_interval
+        while not migration.dead:
+            greenthread.sleep(interval)
+            if migration.dead or self.aborted:
+                continue
+            try:
+                self.poll()
+            except Exception:
+                LOG.exception(_('Failed to check migration progress of %s'),
+                              self.name)
+        return migration.wait()
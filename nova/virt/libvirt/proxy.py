@@ -0,0 +1,158 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Runs libvirt calls in native threads.
+
+Calls into the libvirt bindings block in C, which would stop every
+greenthread in nova-compute until they return.  ThreadPoolProxy wraps
+a libvirt connection and sends each method call through eventlet's tpool
+instead, wrapping the domains and other objects it returns the same way.
+
+At most --libvirt_max_concurrent_calls calls run at once.  A call that
+takes longer than --libvirt_call_timeout seconds raises
+HypervisorCallTimeout in the caller; the native call cannot be
+interrupted and keeps its worker until libvirt returns.
+
+"""
+
+import time
+
+import eventlet
+from eventlet import semaphore
+from eventlet import tpool
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.libvirt.proxy')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('libvirt_max_concurrent_calls', 10,
+                     'Maximum libvirt calls to run at once in native threads')
+flags.DEFINE_integer('libvirt_call_timeout', 300,
+                     'Seconds to wait for a libvirt call before giving up'
+                     ' on it. Set to 0 to wait forever.')
+
+# Calls that legitimately take as long as the guest has memory or disk,
+# so they are never timed out.
+UNTIMED_CALLS = ('migrate', 'migrateToURI', 'migrateToURI2', 'save',
+                 'managedSave', 'restore', 'coreDump')
+
+# Results of these types are returned as they are instead of proxied.
+PLAIN_TYPES = (basestring, bool, int, long, float, list, tuple, dict,
+               type(None))
+
+
+class CallStats(object):
+    """Latency counters of one libvirt method."""
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'total': self.total,
+                'max': self.max}
+
+
+class CallPool(object):
+    """Runs a bounded number of calls in native threads."""
+
+    def __init__(self, max_calls=None, timeout=None):
+        if max_calls is None:
+            max_calls = FLAGS.libvirt_max_concurrent_calls
+        if timeout is None:
+            timeout = FLAGS.libvirt_call_timeout
+        self.timeout = timeout
+        self._semaphore = semaphore.Semaphore(max_calls)
+        self.stats = {}
+
+    def _run(self, stats, func, args, kwargs):
+        with self._semaphore:
+            start = time.time()
+            try:
+                return tpool.execute(func, *args, **kwargs)
+            except Exception:
+                stats.failures += 1
+                raise
+            finally:
+                elapsed = time.time() - start
+                stats.calls += 1
+                stats.total += elapsed
+                stats.max = max(stats.max, elapsed)
+
+    def execute(self, name, func, *args, **kwargs):
+        """Call func in a native thread and wait for its result."""
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = CallStats()
+        # The call runs in its own greenthread, which keeps its place in
+        # the pool until libvirt returns even if the caller times out.
+        call = eventlet.spawn(self._run, stats, func, args, kwargs)
+        if not self.timeout or name in UNTIMED_CALLS:
+            return call.wait()
+        timer = eventlet.Timeout(self.timeout)
+        try:
+            return call.wait()
+        except eventlet.Timeout, e:
+            if e is not timer:
+                raise
+            stats.timeouts += 1
+            LOG.error(_('libvirt call %(name)s did not return within '
+                        '%(timeout)d seconds'),
+                      {'name': name, 'timeout': self.timeout})
+            raise exception.HypervisorCallTimeout(method=name,
+                                                  timeout=self.timeout)
+        finally:
+            timer.cancel()
+
+    def get_stats(self):
+        return dict((name, stats.to_dict())
+                    for name, stats in self.stats.iteritems())
+
+
+class ThreadPoolProxy(object):
+    """Calls the methods of a libvirt object through a CallPool."""
+
+    def __init__(self, obj, pool):
+        self._obj = obj
+        self._pool = pool
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._wrap(self._pool.execute(name, attr, *args, **kwargs))
+
+        return call
+
+    def _wrap(self, result):
+        # Lists such as listAllDomains return domains too.
+        if isinstance(result, (list, tuple)):
+            return type(result)(self._wrap(item) for item in result)
+        if isinstance(result, PLAIN_TYPES):
+            return result
+        return ThreadPoolProxy(result, self._pool)
@@ -0,0 +1,180 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 OpenStack, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reads an internal qcow2 snapshot as a raw disk image.
+
+qemu-img convert cannot write to a pipe, so exporting a snapshot with it
+takes a scratch copy of the whole disk.  SnapshotReader instead walks
+the snapshot's L1 and L2 tables and returns the guest data in order, one
+cluster at a time, reading clusters the image does not hold from its raw
+backing file.  Clusters shared with the snapshot are copied on write by
+qemu, so the snapshot reads consistently while the guest runs.
+
+"""
+
+import os
+import struct
+import zlib
+
+from nova import exception
+from nova.virt.libvirt import imagecache
+
+
+HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+# qcow2 v3 follows HEADER with feature bits; a reader must refuse an
+# image with an incompatible feature it does not know.
+INCOMPATIBLE_FEATURES = struct.Struct('>Q')
+# Only the refcounts of a dirty image are stale; its tables are sound.
+DIRTY = 1
+SNAPSHOT_HEADER = struct.Struct('>QIHHIIQII')
+OFFSET_MASK = 0x00fffffffffffe00
+COMPRESSED = 1 << 62
+ZERO = 1
+
+
+class SnapshotReader(object):
+    """File-like reader of the guest data of a qcow2 snapshot."""
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        try:
+            self._image = open(path, 'rb')
+        except IOError, e:
+            self._unstreamable(e)
+        self._backing = None
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+        self._offset = 0
+        self._buffer = ''
+        self._l2_offset = None
+        self._l2 = None
+
+    def _unstreamable(self, reason):
+        raise exception.SnapshotNotStreamable(name=self.name, path=self.path,
+                                              reason=reason)
+
+    def _pread(self, offset, size):
+        self._image.seek(offset)
+        return self._image.read(size)
+
+    def _read_header(self):
+        try:
+            (magic, version, backing_offset, backing_size, cluster_bits,
+             self.size, crypt_method, _l1_size, _l1_offset, _refcount_offset,
+             _refcount_clusters, nb_snapshots, snapshots_offset) = \
+                    HEADER.unpack(self._pread(0, HEADER.size))
+        except (IOError, struct.error), e:
+            self._unstreamable(e)
+        if magic != imagecache.QCOW2_MAGIC or version not in (2, 3):
+            self._unstreamable(_('not a qcow2 image'))
+        if crypt_method:
+            self._unstreamable(_('image is encrypted'))
+        if version >= 3:
+            try:
+                incompatible = INCOMPATIBLE_FEATURES.unpack(self._pread(
+                        HEADER.size, INCOMPATIBLE_FEATURES.size))[0]
+            except (IOError, struct.error), e:
+                self._unstreamable(e)
+            if incompatible & ~DIRTY:
+                # Such as a corrupt image, an external data file, a
+                # compression type other than zlib or extended L2 entries.
+                self._unstreamable(_('image has incompatible features '
+                                     '0x%x') % incompatible)
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self._l2_entries = self.cluster_size / 8
+
+        if backing_offset:
+            backing_file = self._pread(backing_offset, backing_size)
+            try:
+                self._backing = open(backing_file, 'rb')
+                self._backing_size = os.path.getsize(backing_file)
+            except (IOError, OSError), e:
+                self._unstreamable(e)
+            if self._backing.read(4) == imagecache.QCOW2_MAGIC:
+                self._unstreamable(_('backing file is not raw'))
+
+        offset = snapshots_offset
+        for _i in xrange(nb_snapshots):
+            (l1_offset, l1_size, id_size, name_size, _date, _date_ns,
+             _clock, _state_size, extra_size) = \
+                    SNAPSHOT_HEADER.unpack(
+                            self._pread(offset, SNAPSHOT_HEADER.size))
+            extra_offset = offset + SNAPSHOT_HEADER.size
+            name_offset = extra_offset + extra_size + id_size
+            if self._pread(name_offset, name_size) == self.name:
+                if extra_size >= 16:
+                    # qcow2 v3 records the disk size at snapshot time.
+                    self.size = struct.unpack(
+                            '>Q', self._pread(extra_offset + 8, 8))[0]
+                self._l1 = struct.unpack('>%dQ' % l1_size,
+                                         self._pread(l1_offset, l1_size * 8))
+                return
+            entry_size = (SNAPSHOT_HEADER.size + extra_size + id_size +
+                          name_size)
+            offset += entry_size + (-entry_size % 8)
+        self._unstreamable(_('no such snapshot'))
+
+    def _read_cluster(self, index):
+        """Return the guest data of cluster index."""
+        l1_index, l2_index = divmod(index, self._l2_entries)
+        entry = 0
+        if l1_index < len(self._l1) and self._l1[l1_index] & OFFSET_MASK:
+            l2_offset = self._l1[l1_index] & OFFSET_MASK
+            if l2_offset != self._l2_offset:
+                self._l2 = struct.unpack('>%dQ' % self._l2_entries,
+                        self._pread(l2_offset, self.cluster_size))
+                self._l2_offset = l2_offset
+            entry = self._l2[l2_index]
+        if entry & COMPRESSED:
+            shift = 62 - (self.cluster_bits - 8)
+            offset = entry & ((1 << shift) - 1)
+            sectors = ((entry >> shift) &
+                       ((1 << (self.cluster_bits - 8)) - 1)) + 1
+            data = self._pread(offset, sectors * 512 - offset % 512)
+            return zlib.decompressobj(-12).decompress(
+                    data)[:self.cluster_size]
+        if entry & ZERO:
+            return '\0' * self.cluster_size
+        if entry & OFFSET_MASK:
+            return self._pread(entry & OFFSET_MASK, self.cluster_size)
+        guest_offset = index * self.cluster_size
+        if not self._backing or guest_offset >= self._backing_size:
+            return '\0' * self.cluster_size
+        self._backing.seek(guest_offset)
+        data = self._backing.read(self.cluster_size)
+        return data + '\0' * (self.cluster_size - len(data))
+
+    def read(self, size=-1):
+        """Return up to size bytes, or a cluster of data if size is -1."""
+        if size < 0:
+            size = self.cluster_size
+        while len(self._buffer) < size and self._offset < self.size:
+            cluster = self._read_cluster(self._offset / self.cluster_size)
+            cluster = cluster[:self.size - self._offset]
+            self._offset += len(cluster)
+            self._buffer += cluster
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._image.close()
+        if self._backing:
+            self._backing.close()
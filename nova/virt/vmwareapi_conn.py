@@ -166,7 +166,7 @@ class VMWareESXConnection(driver.ComputeDriver):
         """Return data about VM diagnostics."""
         return self._vmops.get_info(instance)
 
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, length=None):
         """Return snapshot of console."""
         return self._vmops.get_console_output(instance)
 
@@ -65,6 +65,7 @@ import urlparse
 import xmlrpclib
 
 from eventlet import event
+from eventlet import greenthread
 from eventlet import tpool
 from eventlet import timeout
 
@@ -74,6 +75,7 @@ from nova import exception
 from nova import utils
 from nova import flags
 from nova import log as logging
+from nova.compute import power_state
 from nova.virt import driver
 from nova.virt.xenapi import vm_utils
 from nova.virt.xenapi.vmops import VMOps
@@ -141,6 +143,9 @@ flags.DEFINE_string('xenapi_remap_vbd_dev_prefix', 'sd',
 flags.DEFINE_integer('xenapi_login_timeout',
                      10,
                      'Timeout in seconds for XenAPI login.')
+flags.DEFINE_float('xenapi_event_timeout',
+                   30.0,
+                   'Seconds a single event.from call waits for VM events')
 
 
 def get_connection(_):
@@ -162,6 +167,7 @@ class XenAPIConnection(driver.ComputeDriver):
 
     def __init__(self, url, user, pw):
         super(XenAPIConnection, self).__init__()
+        self._credentials = (url, user, pw)
         self._session = XenAPISession(url, user, pw)
         self._vmops = VMOps(self._session)
         self._volumeops = VolumeOps(self._session)
@@ -180,6 +186,68 @@ class XenAPIConnection(driver.ComputeDriver):
         #e.g. to do session logout?
         pass
 
+    def register_event_listener(self, callback):
+        """Report power state changes from XenAPI event.from"""
+        self._event_callback = callback
+        greenthread.spawn(self._watch_events)
+
+    def _watch_events(self):
+        """Long-poll event.from for VM changes, falling back to polling
+        list_instances_detail on hosts that don't have it.
+
+        The long poll gets a session of its own, so it never ties up the
+        one other calls are made through.
+        """
+        token = ''
+        names = {}
+        session = None
+        while True:
+            try:
+                if session is None:
+                    session = XenAPISession(*self._credentials)
+                result = session.call_xenapi('event.from', ['vm'], token,
+                                             FLAGS.xenapi_event_timeout)
+            except self._session.XenAPI.Failure, exc:
+                if exc.details and exc.details[0] == 'MESSAGE_METHOD_UNKNOWN':
+                    LOG.info(_('XenAPI has no event.from, polling for power '
+                               'state changes instead'))
+                    super(XenAPIConnection, self).register_event_listener(
+                                                        self._event_callback)
+                    return
+                if exc.details and exc.details[0] == 'EVENTS_LOST':
+                    token = ''
+                    continue
+                LOG.warn(_('Error waiting for XenAPI events: %s'), exc)
+                greenthread.sleep(FLAGS.driver_event_poll_interval)
+                continue
+            except Exception:
+                LOG.exception(_('Error waiting for XenAPI events'))
+                session = None
+                greenthread.sleep(FLAGS.driver_event_poll_interval)
+                continue
+
+            token = result['token']
+            for vm_event in result['events']:
+                self._handle_vm_event(vm_event, names)
+
+    def _handle_vm_event(self, vm_event, names):
+        ref = vm_event['ref']
+        if vm_event['operation'] == 'del':
+            name = names.pop(ref, None)
+            state = power_state.NOSTATE
+        else:
+            rec = vm_event.get('snapshot')
+            if not rec or rec['is_a_template'] or rec['is_control_domain']:
+                return
+            name = names[ref] = rec['name_label']
+            state = vm_utils.XENAPI_POWER_STATE[rec['power_state']]
+        if name is None:
+            return
+        try:
+            self._event_callback(name, state)
+        except Exception:
+            LOG.exception(_('Error handling power state event for %s'), name)
+
     def list_instances(self):
         """List VM instances"""
         return self._vmops.list_instances()
@@ -317,7 +385,7 @@ class XenAPIConnection(driver.ComputeDriver):
                                         bw_out=usage['bw_out']))
         return bwusage
 
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, length=None):
         """Return snapshot of console"""
         return self._vmops.get_console_output(instance)
 